@@ -2,9 +2,12 @@ from flask import Flask, request
 from waitress import serve
 
 from blueprints import endpoints, gis, comments, documents, localization, \
-    gis_import, images
+    gis_import, images, tiles, index_advisor, reclamation
 from config import HOST, PORT, logger
 from db import Session, init_db
+from index_advisor import reset_interrupted_builds
+from jobs import fail_interrupted_jobs
+from tasks import start_background_tasks
 
 app = Flask(__name__)
 app.teardown_request(lambda *args: Session.remove())  # There was a problem with closing sessions
@@ -17,6 +20,9 @@ app.register_blueprint(documents)
 app.register_blueprint(gis_import)
 app.register_blueprint(images)
 app.register_blueprint(localization)
+app.register_blueprint(tiles)
+app.register_blueprint(index_advisor)
+app.register_blueprint(reclamation)
 
 
 @app.after_request
@@ -29,4 +35,7 @@ def after_request(response):
 
 if __name__ == '__main__':
     init_db()
+    fail_interrupted_jobs()
+    reset_interrupted_builds()
+    start_background_tasks()
     serve(app, host=HOST, port=PORT, threads=10)
@@ -0,0 +1,256 @@
+import json
+import re
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+from sqlalchemy.sql import text
+
+from config import BATCH_CHUNK_SIZE
+from db import Session
+from utils import bump_table_version, delete_attachments, release_extent, get_records_box, expand_extent_box
+
+OPERATIONS = ('insert', 'update', 'delete')
+
+# Dates and times are accepted in ISO 8601, the text is checked before Postgres parses it
+ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}(:?\d{2})?)?')
+
+
+class BatchError(Exception):
+    """The batch can not be applied. errors - list of {"index": ..., "message": ...}"""
+
+    def __init__(self, errors):
+        super().__init__(errors[0]['message'])
+        self.errors = errors
+
+
+class Operation:
+    """Validated operation of the batch. record - values of the fields as they are passed to
+    json_populate_record, the geometry is kept as GeoJSON text in _geom"""
+
+    def __init__(self, index, op, gis_id=None, record=None):
+        self.index = index
+        self.op = op
+        self.gis_id = gis_id
+        self.record = record or {}
+        self.fields = tuple(sorted(self.record))
+        self.result = None
+
+
+def column_value(key, value, column_type):
+    """Checks the value against the type of the column, so a bad value is reported by its operation
+    instead of failing the statement of the group. Returns the value as it is passed to Postgres
+    or the error message"""
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        return value, None
+    if value is None:
+        return value, None
+
+    if python_type is bool:
+        if isinstance(value, bool):
+            return value, None
+        return None, f'{key} must be a boolean'
+    if python_type is int:
+        if isinstance(value, str):
+            value = value.strip()
+            if re.fullmatch(r'[+-]?\d+', value):
+                return int(value), None
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and float(value).is_integer():
+            return int(value), None
+        return None, f'{key} must be an integer'
+    if python_type in (float, Decimal):
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value, None
+        return None, f'{key} must be a number'
+    if python_type in (date, datetime):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            # Dates are accepted as timestamps, like in the endpoint of one record
+            return datetime.fromtimestamp(value, timezone.utc).isoformat(), None
+        if isinstance(value, str) and ISO_DATE.fullmatch(value.strip()):
+            try:
+                date.fromisoformat(value.strip()[:10])
+                return value, None
+            except ValueError:
+                pass
+        return None, f'{key} must be a date in ISO 8601 or a timestamp'
+    if python_type is str:
+        if isinstance(value, (dict, list)):
+            return None, f'{key} must be a string'
+        return value, None
+    return value, None
+
+
+def validate_record(data, columns, geom_types):
+    """Converts the fields of an inserted or updated record. Returns the record or the error message"""
+    if not isinstance(data, dict):
+        return None, 'data must be an object'
+    record = {}
+    for key, value in data.items():
+        if key not in columns:
+            return None, f'not found field {key}'
+        if key == 'gis_id':
+            return None, 'gis_id can not be written'
+        if key == 'geom':
+            if value is not None:
+                if not isinstance(value, dict):
+                    return None, 'geom must be GeoJSON'
+                if geom_types and value.get('type') not in geom_types:
+                    return None, 'geom another type'
+                value = json.dumps(value)
+            record['_geom'] = value
+        else:
+            value, message = column_value(key, value, columns[key].type)
+            if message:
+                return None, message
+            record[key] = value
+    return record, None
+
+
+def validate_operations(operations, columns, geom_type):
+    """Checks all operations against the schema of the table before anything is written.
+    columns - columns of the table, geom_type - type of its geometry, GEOMETRY accepts any type.
+    Raises BatchError with the errors of all invalid operations"""
+    geom_types = None
+    if geom_type and geom_type.upper() != 'GEOMETRY':
+        # A single geometry is written into a multi column as a collection of one
+        geom_types = {geom_type, geom_type[5:]} if geom_type.startswith('Multi') else {geom_type}
+
+    result, errors = [], []
+    for index, item in enumerate(operations):
+        if not isinstance(item, dict) or item.get('op') not in OPERATIONS:
+            errors.append({"index": index, "message": f"op must be one of {', '.join(OPERATIONS)}"})
+            continue
+        op = item['op']
+
+        gis_id = item.get('id')
+        if op != 'insert' and (not isinstance(gis_id, int) or isinstance(gis_id, bool)):
+            errors.append({"index": index, "message": "id must be an integer"})
+            continue
+
+        record = None
+        if op != 'delete':
+            record, message = validate_record(item.get('data', {}), columns, geom_types)
+            if message is None and op == 'update' and not record:
+                message = 'data is empty'
+            if message:
+                errors.append({"index": index, "message": message})
+                continue
+        result.append(Operation(index, op, gis_id if op != 'insert' else None, record))
+
+    if errors:
+        raise BatchError(errors)
+    return result
+
+
+def group_operations(operations, chunk_size=BATCH_CHUNK_SIZE):
+    """Splits the operations into groups written by one statement: consecutive operations of the same kind
+    with the same fields. A repeated id of an update starts a new group, so the order of changes is kept"""
+    groups = []
+    ids = set()
+    for operation in operations:
+        group = groups[-1] if groups else None
+        if group is None or group[0].op != operation.op or group[0].fields != operation.fields \
+                or len(group) >= chunk_size or (operation.op == 'update' and operation.gis_id in ids):
+            group = []
+            groups.append(group)
+            ids = set()
+        group.append(operation)
+        ids.add(operation.gis_id)
+    return groups
+
+
+class BatchWriter:
+    """Applies validated operations to the table in the transaction of the session.
+    Records of a group are passed as one JSON array and converted to the row type of the table by Postgres"""
+
+    def __init__(self, table, geom_column_type=None):
+        self.table = table
+        self.srid = table.srid or 4326
+        self.multi = bool(geom_column_type) and geom_column_type.upper().startswith('MULTI')
+        self.geom_changed = False
+        self.deleted = []
+        self.counts = {"inserted": 0, "updated": 0, "deleted": 0}
+
+    def geom_value(self):
+        value = f"ST_SetSRID(ST_GeomFromGeoJSON(a.e ->> '_geom'), {self.srid})"
+        return f'ST_Multi({value})' if self.multi else value
+
+    def columns(self, group):
+        fields = group[0].fields
+        names = [f'"{name}"' for name in fields if name != '_geom'] + (['geom'] if '_geom' in fields else [])
+        values = [f'r."{name}"' for name in fields if name != '_geom'] + \
+            ([self.geom_value()] if '_geom' in fields else [])
+        return names, values
+
+    def records(self, group, with_id=False):
+        return json.dumps([dict(operation.record, **({"gis_id": operation.gis_id} if with_id else {}))
+                           for operation in group])
+
+    def insert(self, group):
+        names, values = self.columns(group)
+        target = f'{self.table.table_name} ({", ".join(names)})' if names else self.table.table_name
+        rows = Session.execute(text(
+            f"""INSERT INTO {target}
+                SELECT {", ".join(values)}
+                FROM json_array_elements(CAST(:records AS json)) WITH ORDINALITY AS a(e, n),
+                     json_populate_record(NULL::{self.table.table_name}, a.e) AS r
+                ORDER BY a.n
+                RETURNING gis_id"""), {"records": self.records(group)}).all()
+        for operation, row in zip(group, rows):
+            operation.result = {"id": row[0], "status": "inserted"}
+        self.counts['inserted'] += len(rows)
+        if '_geom' in group[0].fields:
+            self.geom_changed = True
+            expand_extent_box(self.table, get_records_box(self.table, [row[0] for row in rows]))
+
+    def update(self, group):
+        names, values = self.columns(group)
+        ids = [operation.gis_id for operation in group]
+        if '_geom' in group[0].fields:
+            self.geom_changed = True
+            release_extent(self.table, get_records_box(self.table, ids))
+        updated = {row[0] for row in Session.execute(text(
+            f"""UPDATE {self.table.table_name} t SET ({", ".join(names)}) = ROW({", ".join(values)})
+                FROM json_array_elements(CAST(:records AS json)) AS a(e),
+                     json_populate_record(NULL::{self.table.table_name}, a.e) AS r
+                WHERE t.gis_id = r.gis_id
+                RETURNING t.gis_id"""), {"records": self.records(group, with_id=True)})}
+        for operation in group:
+            operation.result = {"id": operation.gis_id,
+                                "status": "updated" if operation.gis_id in updated else "not found"}
+        self.counts['updated'] += len(updated)
+        if '_geom' in group[0].fields:
+            expand_extent_box(self.table, get_records_box(self.table, updated))
+
+    def delete(self, group):
+        ids = [operation.gis_id for operation in group]
+        if self.table.geom_type:
+            release_extent(self.table, get_records_box(self.table, ids))
+        deleted = {row[0] for row in Session.execute(
+            text(f'DELETE FROM {self.table.table_name} WHERE gis_id = ANY(:gis_ids) RETURNING gis_id'),
+            {"gis_ids": ids})}
+        self.deleted.extend(deleted)
+        for operation in group:
+            operation.result = {"id": operation.gis_id,
+                                "status": "deleted" if operation.gis_id in deleted else "not found"}
+        self.counts['deleted'] += len(deleted)
+
+    def apply(self, operations):
+        """Writes the groups in their order. A failed statement fails the whole batch,
+        the caller rolls the transaction back"""
+        for group in group_operations(operations):
+            try:
+                getattr(self, group[0].op)(group)
+            except Exception as e:
+                raise BatchError([{"index": group[0].index, "message": str(e).split('\n')[0]}]) from e
+        # Files are removed only when every statement succeeded
+        delete_attachments(self.table.id, self.deleted)
+        if any(self.counts.values()):
+            bump_table_version(self.table.id)
+        return [{"index": operation.index, "op": operation.op, **operation.result} for operation in operations]
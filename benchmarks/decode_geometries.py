@@ -0,0 +1,56 @@
+"""Compares the decoding of WKT/WKB geometries record by record (the former import path)
+with the vectorized decoding of decoding.decode_geometries.
+
+    python benchmarks/decode_geometries.py [rows]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from shapely import wkb, wkt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decoding import decode_geometries  # noqa: E402
+
+
+def load_valid(geo, geometry_format='wkt'):
+    try:
+        return wkb.loads(geo, hex=True) if geometry_format == 'wkb' else wkt.loads(geo)
+    except Exception:
+        return np.nan
+
+
+def make_values(rows, geometry_format):
+    """Points and small polygons with 1% of broken values"""
+    rng = np.random.default_rng(0)
+    xs, ys = rng.uniform(-180, 179, rows), rng.uniform(-85, 84, rows)
+    values = []
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        if i % 2:
+            geom = wkt.loads(f'POINT ({x} {y})')
+        else:
+            geom = wkt.loads(f'POLYGON (({x} {y}, {x + 1} {y}, {x + 1} {y + 1}, {x} {y + 1}, {x} {y}))')
+        values.append(geom.wkb_hex if geometry_format == 'wkb' else geom.wkt)
+    for i in range(0, rows, 100):
+        values[i] = 'broken'
+    return pd.Series(values)
+
+
+def measure(name, func):
+    started = time.perf_counter()
+    result = func()
+    print(f'{name:<24}{time.perf_counter() - started:8.2f} s')
+    return result
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    for geometry_format in ('wkt', 'wkb'):
+        values = make_values(rows, geometry_format)
+        print(f'{geometry_format}, {rows} rows')
+        old = measure('apply(load_valid)', lambda: values.apply(load_valid, geometry_format=geometry_format))
+        new, failed = measure('decode_geometries', lambda: decode_geometries(values, geometry_format))
+        assert int(failed.sum()) == int(old.isna().sum())
@@ -0,0 +1,63 @@
+"""Compares the per-feature TranslateLayer loop of the bundled ogr2ogr.Translator with GDAL's native
+gdal.VectorTranslate, sequentially and in parallel threads.
+
+    python benchmarks/translate_layer.py [features] [threads]
+"""
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal, ogr, osr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ogr2ogr import Translator  # noqa: E402
+
+gdal.UseExceptions()
+
+
+def make_source(path, features):
+    """GeoJSON with points and a few attributes"""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds = ogr.GetDriverByName('GeoJSON').CreateDataSource(path)
+    layer = ds.CreateLayer('points', srs, ogr.wkbPoint)
+    layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTReal))
+    for i in range(features):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('name', f'feature {i}')
+        feature.SetField('value', i * 0.5)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(f'POINT ({i % 360 - 180} {i % 170 - 85})'))
+        layer.CreateFeature(feature)
+    ds = None
+
+
+def translator(source, output):
+    assert Translator().run(['ogr2ogr', '-f', 'GPKG', output, source])
+
+
+def vector_translate(source, output):
+    assert gdal.VectorTranslate(output, source, format='GPKG') is not None
+
+
+def measure(name, func, source, directory, threads):
+    outputs = [os.path.join(directory, f'{name}_{threads}_{i}.gpkg') for i in range(threads)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(lambda output: func(source, output), outputs))
+    print(f'{name:<20}{threads:>3} threads{time.perf_counter() - started:8.2f} s')
+
+
+if __name__ == '__main__':
+    features = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source.geojson')
+        make_source(source, features)
+        print(f'{features} features')
+        for count in (1, threads):
+            measure('Translator', translator, source, directory, count)
+            measure('VectorTranslate', vector_translate, source, directory, count)
@@ -4,4 +4,7 @@ from .endpoints import endpoints
 from .gis import gis
 from .gis_import import gis_import
 from .images import images
+from .index_advisor import index_advisor
 from .localization import localization
+from .reclamation import reclamation
+from .tiles import tiles
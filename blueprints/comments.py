@@ -1,6 +1,7 @@
-from db import get_table_class, CommentTable, TableName, Session
+from db import get_table_class, get_table, CommentTable, Session
 
 from flask import Blueprint, jsonify, request
+from utils import bump_meta_version, request_etag, is_not_modified, not_modified, set_validators
 
 comments = Blueprint('comments', __name__)
 
@@ -8,17 +9,24 @@ comments = Blueprint('comments', __name__)
 @comments.get('/gis/<int:table_id>/comments')
 def get_comments(table_id):
     """The function returns all comments on the table ID and the record ID in the table"""
-    table = TableName.query.filter(TableName.id == table_id).first()
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
         return jsonify({"message": "folder does not have this method"}), 405
 
+    # The list depends on the arguments of the request, it is validated by the ETag only
+    etag = request_etag(table, 'comments')
+    if is_not_modified(etag):
+        return not_modified(etag)
+
     gis_id = request.args.get('gis_id') if request.args else None
+    # Comments of deleted records wait for the reclamation
+    query = CommentTable.query.filter(CommentTable.table_id == table_id, CommentTable.deleted_at.is_(None))
     if gis_id:
-        comments_lst = CommentTable.query.filter(CommentTable.table_id == table_id, CommentTable.row_id == gis_id).all()
+        comments_lst = query.filter(CommentTable.row_id == gis_id).all()
     else:
-        comments_lst = CommentTable.query.filter_by(table_id=table_id).all()
+        comments_lst = query.all()
 
     res = {
         comment.id: {
@@ -30,15 +38,15 @@ def get_comments(table_id):
         } for comment in comments_lst}
 
     if 'as_array' in request.args:
-        return jsonify(list(res.values()))
-    return jsonify(res)
+        return set_validators(jsonify(list(res.values())), etag)
+    return set_validators(jsonify(res), etag)
 
 
 @comments.post('/gis/<int:table_id>/comments')
 def create_comment(table_id):
     """The function creates a comment to an entry in the table by table ID and record ID"""
 
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
@@ -48,7 +56,7 @@ def create_comment(table_id):
     if data is None:
         return jsonify({"message": "Failed request"}), 400
 
-    table_obj = get_table_class(table.table_name)
+    table_obj = get_table_class(table)
 
     # Checking that the data has gis_id
     gis_id = data.get('gis_id')
@@ -68,6 +76,7 @@ def create_comment(table_id):
         return jsonify({"message": "Failed request"}), 400
 
     Session.add(comment)
+    bump_meta_version(table.id)
     Session.commit()
 
     return jsonify({'id': comment.id}), 201
@@ -77,12 +86,14 @@ def create_comment(table_id):
 def delete_comment(table_id, comment_id):
     """The function deletes a comment to an entry in the table by the comment ID"""
 
-    comment = CommentTable.query.filter(CommentTable.table_id == table_id, CommentTable.id == comment_id).first()
+    comment = CommentTable.query.filter(CommentTable.table_id == table_id, CommentTable.id == comment_id,
+                                        CommentTable.deleted_at.is_(None)).first()
 
     if comment is None:
         return jsonify({"message": "comment not found"}), 404
 
     Session.query(CommentTable).filter(CommentTable.table_id == table_id, CommentTable.id == comment_id).delete()
+    bump_meta_version(table_id)
     Session.commit()
 
     return jsonify({"id": comment.id, "message": "Successfully deleted comment"})
@@ -3,26 +3,34 @@ from pathlib import Path
 from datetime import datetime
 
 from flask import Blueprint, jsonify, request, send_from_directory
-from db import get_table_class, TableName, Session, TableFile
+from db import get_table_class, get_table, Session, TableFile
 from werkzeug.utils import secure_filename
+from utils import bump_meta_version, request_etag, is_not_modified, not_modified, set_validators
 
 documents = Blueprint('documents', __name__)
 
 
 @documents.get('/gis/<int:table_id>/documents')
 def get_documents(table_id):
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
         return jsonify({"message": "folder does not have this method"}), 405
 
+    # The list depends on the arguments of the request, it is validated by the ETag only
+    etag = request_etag(table, 'documents')
+    if is_not_modified(etag):
+        return not_modified(etag)
+
     gis_id = request.args.get('gis_id') if request.args else None
 
+    # Documents of deleted records wait for the reclamation
+    query = TableFile.query.filter(TableFile.table_id == table_id, TableFile.deleted_at.is_(None))
     if gis_id:
-        docs = TableFile.query.filter(TableFile.table_id == table_id, TableFile.row_id == gis_id).all()
+        docs = query.filter(TableFile.row_id == gis_id).all()
     else:
-        docs = TableFile.query.filter_by(table_id=table_id).all()
+        docs = query.all()
 
     res = {document.id: {
         "id": document.id,
@@ -34,15 +42,15 @@ def get_documents(table_id):
     } for document in docs}
 
     if 'as_array' in request.args:
-        return jsonify(list(res.values()))
-    return jsonify(res)
+        return set_validators(jsonify(list(res.values())), etag)
+    return set_validators(jsonify(res), etag)
 
 
 @documents.post('/gis/<int:table_id>/documents')
 def upload_file_for_table(table_id):
     """The function accepts a file via form_data for uploading to records in tables."""
 
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
@@ -64,7 +72,7 @@ def upload_file_for_table(table_id):
     except ValueError:
         return jsonify({"message": "failed request"}), 400
 
-    table_obj = get_table_class(table.table_name)
+    table_obj = get_table_class(table)
     if not Session.query(table_obj).filter(table_obj.c.gis_id == gis_id).first():
         return jsonify({"message": "failed request"}), 400
 
@@ -87,6 +95,7 @@ def upload_file_for_table(table_id):
                                 name=secure_filename(file.filename),
                                 filename=file_name, created_by=request.form.get('created_by', None))
         Session.add(record_file)
+        bump_meta_version(table.id)
         Session.commit()
 
     # We save a new file, rename it by linking the number of the table and record, and also use transliteration
@@ -99,13 +108,14 @@ def upload_file_for_table(table_id):
 @documents.get('/gis/<int:table_id>/documents/<int:file_id>/download')
 def get_download_file(table_id, file_id):
     """To upload a file in the argument, you need to submit id of download_file """
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
         return jsonify({"message": "folder does not have this method"}), 405
 
-    doc = TableFile.query.filter(TableFile.id == file_id, TableFile.table_id == table_id).first()
+    doc = TableFile.query.filter(TableFile.id == file_id, TableFile.table_id == table_id,
+                                 TableFile.deleted_at.is_(None)).first()
     if doc is None:
         return jsonify({"message": "file not found"}), 404
     if doc.path and os.path.isfile(doc.path):
@@ -113,6 +123,7 @@ def get_download_file(table_id, file_id):
                                    as_attachment=True, download_name=doc.name)
     else:
         Session.delete(doc)
+        bump_meta_version(table.id)
         Session.commit()
     return jsonify({"message": "file not found"}), 404
 
@@ -120,7 +131,8 @@ def get_download_file(table_id, file_id):
 @documents.delete('/gis/<int:table_id>/documents/<int:file_id>')
 def delete_documents(table_id, file_id):
     """The function deletes a doc to an entry in the table by the doc's ID"""
-    doc = TableFile.query.filter(TableFile.id == file_id, TableFile.table_id == table_id).first()
+    doc = TableFile.query.filter(TableFile.id == file_id, TableFile.table_id == table_id,
+                                 TableFile.deleted_at.is_(None)).first()
     if doc is None:
         return jsonify({"message": "file not found"}), 404
     try:
@@ -128,5 +140,6 @@ def delete_documents(table_id, file_id):
     except FileNotFoundError:
         pass
     Session.query(TableFile).filter(TableFile.id == file_id, TableFile.table_id == table_id).delete()
+    bump_meta_version(table_id)
     Session.commit()
     return jsonify({"id": doc.id, "message": "Successfully deleted file"})
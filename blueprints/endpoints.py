@@ -17,6 +17,22 @@ def get_endpoints():
                 'put': False,
                 'delete': False
             },
+            {
+                'path': '/import/<int>',
+                'description': 'Обновление ГИС таблицы из файла по ключевому полю',
+                'get': False,
+                'post': True,
+                'put': False,
+                'delete': False
+            },
+            {
+                'path': '/import/jobs/<int>',
+                'description': 'Состояние задачи импорта',
+                'get': True,
+                'post': False,
+                'put': False,
+                'delete': False
+            },
             {
                 'path': '/import/empty',
                 'description': 'Создание пустого ИД',
@@ -41,9 +57,25 @@ def get_endpoints():
                 'put': True,
                 'delete': True
             },
+            {
+                'path': '/<int>/batch',
+                'description': 'Пакетное добавление, изменение и удаление записей ГИС таблицы',
+                'get': False,
+                'post': True,
+                'put': False,
+                'delete': False
+            },
             {
                 'path': '/<int>/export',
-                'description': 'Экспорт ГИС таблицы в файл .geojson',
+                'description': 'Экспорт ГИС таблицы в файл GeoJSON, GeoPackage, FlatGeobuf, CSV или Shapefile',
+                'get': True,
+                'post': False,
+                'put': False,
+                'delete': False
+            },
+            {
+                'path': '/<int>/tiles/<int>/<int>/<int>.mvt',
+                'description': 'Векторные тайлы ГИС таблицы',
                 'get': True,
                 'post': False,
                 'put': False,
@@ -145,6 +177,30 @@ def get_endpoints():
                 'put': True,
                 'delete': False
             },
+            {
+                'path': '/reclamation',
+                'description': 'Состояние фоновой очистки удалённых таблиц и записей',
+                'get': True,
+                'post': False,
+                'put': False,
+                'delete': False
+            },
+            {
+                'path': '/indexes',
+                'description': 'Рекомендации индексов по фильтрам и сортировкам ГИС таблиц',
+                'get': True,
+                'post': False,
+                'put': False,
+                'delete': False
+            },
+            {
+                'path': '/indexes/<int>/build',
+                'description': 'Построение рекомендованного индекса',
+                'get': False,
+                'post': True,
+                'put': False,
+                'delete': False
+            },
             {
                 'path': '/img',
                 'description': 'Работа с изображениями',
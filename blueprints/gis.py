@@ -1,18 +1,27 @@
 import json
 import os
 import sqlalchemy
+import time
 from datetime import datetime
-from pathlib import Path
 
-from sqlalchemy import insert, Date
+from sqlalchemy import insert, select, Date
 from sqlalchemy.exc import NoSuchTableError
 from sqlalchemy.sql import text, func
 
-from flask import Blueprint, jsonify, request, send_file, send_from_directory
-from db import json_query, get_table_class, TableName, Session, \
-    CommentTable, Localization, TableFolder, TableFile
+from flask import Blueprint, Response, jsonify, request, send_file, send_from_directory, stream_with_context
+from db import json_query, get_table_class, get_table_schema, get_table, TableName, Session, \
+    Localization, TableFolder
 
-from utils import get_children, get_fields, get_geom_type, get_filter_set, add_filters
+from batch import BatchError, BatchWriter, validate_operations
+from config import BATCH_MAX_OPERATIONS
+from export import EXPORT_FORMATS, get_export
+from index_advisor import record_usage
+from reclamation import reclaim_requested
+from utils import get_children, get_filter_set, add_filters, spatial_filter, get_registry_state, \
+    registry_as_array, invalidate_registry, update_geom_info, next_cursor, count_records, COUNT_MODES, \
+    bump_table_version, get_table_extent, get_filtered_extent, get_record_box, expand_extent, release_extent, \
+    STREAM_FORMATS, stream_records, borders_from_box, table_etag, request_etag, not_modified, \
+    is_not_modified, set_validators, bump_meta_version, new_folder, delete_attachments
 
 
 gis = Blueprint('gis', __name__)
@@ -21,42 +30,25 @@ gis = Blueprint('gis', __name__)
 @gis.get('/gis/tables')
 def get_tables():
     """Returns JSON with a registry of tables"""
-    tables = TableName.query.all()
-    if tables is None:
-        return jsonify({"message": "tables not found"}), 404
+    data, etag, built_at = get_registry_state()
 
-    data = {}
+    # The array and the dictionary are different representations of the same registry
+    as_array = 'as_array' in request.args
+    etag = f'{etag}-array' if as_array else etag
+    if is_not_modified(etag, built_at):
+        return not_modified(etag, built_at)
 
-    as_array = False
-    if 'as_array' in request.args:
-        as_array = True
-
-    for table in tables:
-        locale = Localization.query.filter(Localization.table_id == table.id).all()
-        alias_dict = {rec.language: rec.alias for rec in locale}
-        Session.commit()
-
-        if not table.is_folder and not table.parent_id:
-            data[table.id] = {
-                "id": table.id,
-                "alias": alias_dict,
-                "geom_type": get_geom_type(table.table_name),
-                "parent_id": table.parent_id
-            }
-        if table.is_folder:
-            data[table.id] = {
-                "id": table.id,
-                "alias": alias_dict,
-                "children": get_children(table, as_array)
-            }
-
-    return jsonify({"count": len(data), "tables": list(data.values()) if as_array else data, "message": "success"})
+    if as_array:
+        response = jsonify({"count": len(data), "tables": registry_as_array(data), "message": "success"})
+    else:
+        response = jsonify({"count": len(data), "tables": data, "message": "success"})
+    return set_validators(response, etag, built_at)
 
 
 @gis.post('/gis/<int:table_id>')
 def get_table_id(table_id):
     """Displaying all table entries by ID"""
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
 
@@ -67,51 +59,78 @@ def get_table_id(table_id):
     as_array = True if 'as_array' in request.args else False
 
     if table.is_folder:
-        return jsonify({"id": table.id, "alias": alias_dict,
-                        "children": get_children(table, as_array)})
+        # The content of a folder is taken from the registry and changes with it
+        _, registry_etag, built_at = get_registry_state()
+        etag = f'{registry_etag}-{table.id}-{as_array}'
+        if is_not_modified(etag, built_at):
+            return not_modified(etag, built_at)
+        return set_validators(jsonify({"id": table.id, "alias": alias_dict,
+                                       "children": get_children(table, as_array)}), etag, built_at)
+
+    # The page depends on the versions of the table and on the filters of the request,
+    # so it is validated by the ETag only: the time of the change does not tell the request apart
+    etag = request_etag(table, 'records')
+    if is_not_modified(etag):
+        return not_modified(etag)
 
     try:
-        table_obj = get_table_class(table.table_name)
+        table_obj = get_table_class(table)
     except NoSuchTableError:
         return jsonify({"message": "not found table in db"}), 502
     columns = table_obj.columns
 
-    # Default Requests
-    query = f"""SELECT * FROM {table.table_name}
-                ORDER BY gis_id"""
-
-    count_query = f"""SELECT COUNT(*) FROM {table.table_name}"""
-
     # The number of entries per page by default. Used for pagination.
     limit_value = 50
 
-    if request.args:
-        # Processing arguments for filtering and sorting.
-        filter_set = get_filter_set(request.args.to_dict().items(), limit_value)
-        query_set = filter_set.get('query_set')
-        limit_value = filter_set.get('limit_value')
-        limit = filter_set.get('limit')
-        query_sort = filter_set.get('query_sort')
-
-        if query_set:
-            # Query with filters and sorting.
-            query_args = f"""{' AND '.join(query_set)}
-                    {query_sort} {limit}"""
-
-            # Query is for displaying the number of pages.
-            count_query = f"""SELECT COUNT(*) FROM {table.table_name} WHERE {' AND '.join(query_set)}"""
-        else:
-            # Query with pagination and sorting, but without additional filters.
-            query_args = f"""{query_sort} {limit}"""
+    # Strategy of counting records for the number of pages
+    count_mode = request.args.get('count', 'exact')
+    if count_mode not in COUNT_MODES:
+        return jsonify({"message": f"failed request: count must be one of {', '.join(COUNT_MODES)}"}), 400
 
-        query = f"""SELECT * FROM {table.table_name}
-                        {query_args}"""
-    else:
-        query_args = None
+    # Processing arguments and JSON filters into SQLAlchemy expressions with bound parameters.
+    data = request.get_json(silent=True)
+    try:
+        filter_set = get_filter_set(request.args.to_dict().items(), limit_value, columns)
+        conditions = filter_set.get('conditions')
+        usage = filter_set.get('usage')
+        if data and data.get('attribute'):
+            conditions += add_filters(data.get('attribute'), columns, usage)
+    except ValueError as ex:
+        return jsonify({"message": f"failed request: {ex}"}), 400
+    limit_value = filter_set.get('limit_value')
+
+    if data and data.get('spatial'):
+        if 'geom' not in columns:
+            return jsonify({"message": "failed request: table does not have geometry"}), 400
+        conditions.append(spatial_filter(columns, data.get('spatial')))
+        usage.append(('geom', 'gist'))
+
+    # Query with filters, sorting and pagination. Keyset condition is applied only to the page.
+    query = select(table_obj).where(*conditions, *filter_set.get('keyset')).order_by(*filter_set.get('order_by')). \
+        limit(filter_set.get('limit')).offset(filter_set.get('offset'))
+
+    # Streaming output: records are sent as they are read, without pages count and borders
+    stream_format = request.args.get('stream')
+    if stream_format:
+        if stream_format not in STREAM_FORMATS:
+            return jsonify({"message": f"failed request: stream must be one of {', '.join(STREAM_FORMATS)}"}), 400
+        return Response(stream_with_context(stream_records(query, stream_format, 'geom' in columns)),
+                        mimetype=STREAM_FORMATS[stream_format])
+
+    started = time.perf_counter()
+    try:
+        # Number of pages
+        count_response, count_type = count_records(table, table_obj, conditions, count_mode)
+        response = Session.execute(json_query(query, as_array)).first()['data']
+    except (sqlalchemy.exc.InternalError, sqlalchemy.exc.DataError) as ex:
+        # Returns an error, for example, if the SRID was incorrectly passed.
+        return jsonify({"ERROR": str(ex).split('\n')[0]}), 503
+    if usage:
+        record_usage(table.id, usage, (time.perf_counter() - started) * 1000)
 
-    # Number of pages
-    count_response = Session.execute(text(count_query)).first()[0]
-    if count_response:
+    if count_response is None:
+        pages = None
+    elif count_response:
         if count_response % limit_value == 0:
             pages = count_response // limit_value
         else:
@@ -119,71 +138,45 @@ def get_table_id(table_id):
     else:
         pages = 0
 
-    data = request.json
-    if data:
-        if data.get('attribute'):
-            filters = add_filters(data.get('attribute'), columns)
-            query = f"""SELECT * FROM {table.table_name}
-                        WHERE {' AND '.join(filters) if filters else ''}
-                        {query_args if query_args else ''}
-                        """
-        else:
-            filters = None
-
-        # JSON to Geometry conversions for SQL
-        if data.get('spatial'):
-            sql_geom = f"""ST_AsText(ST_GeomFromGeoJSON('{str(data.get('spatial')).replace("'", '"')}'))"""
-            query = f"""SELECT * FROM {table.table_name}
-                            WHERE ST_Intersects(geom, CONCAT('SRID=4326;', {sql_geom})::geometry)
-                            {' AND '+' AND '.join(filters) if filters else ''}
-                            {query_args if query_args else ''}
-                            """
-
-    try:
-        response = Session.execute(json_query(query, as_array)).first()['data']
-    except sqlalchemy.exc.InternalError as ex:
-        # Returns an error, for example, if the SRID was incorrectly passed.
-        return jsonify({"ERROR": str(ex).split('\n')[0]}), 503
-
     if response and ('geom' in columns):
-
-        query_borders = f"""SELECT json_agg(f) FROM(SELECT
-                            min(ST_XMin(data)) as "0",
-                            min(ST_YMin(data)) as "1",
-                            max(ST_XMax(data)) as "2",
-                            max(ST_YMax(data)) as "3" FROM (SELECT box2d(geom)::geometry as data
-                            FROM {table.table_name} ) gm) f"""
-
-        response_borders = Session.execute(text(query_borders)).first()[0][0]
+        # Borders of the filtered set or the stored extent of the whole table
+        if conditions:
+            response_borders = get_filtered_extent(table_obj, conditions)
+        else:
+            response_borders = get_table_extent(table)
     else:
         response_borders = None
 
-    return jsonify({"alias": alias_dict,
-                    "data": response,
-                    "parent_id": table.parent_id,
-                    "pages": pages,
-                    "borders": response_borders if response_borders else None})
+    return set_validators(jsonify({"alias": alias_dict,
+                                   "data": response,
+                                   "parent_id": table.parent_id,
+                                   "pages": pages,
+                                   "count": count_response,
+                                   "count_type": count_type,
+                                   "next": next_cursor(response, filter_set),
+                                   "borders": response_borders if response_borders else None}),
+                          etag)
 
 
 @gis.put('/gis/<int:table_id>')
 def create_gis_id(table_id):
     """Create new gis object"""
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
         return jsonify({"message": "folder does not have this method"}), 405
 
-    table_obj = get_table_class(table.table_name)
-    fields = Session.execute(f"""SELECT json_agg(column_name) FROM information_schema.columns
-                                 WHERE TABLE_NAME = '{table.table_name.split('.')[1]}'""").first()[0]
+    table_obj = get_table_class(table)
+    fields = table_obj.columns
 
     data = request.get_json()
 
     if data is None:
         return jsonify({"message": "failed request"}), 400
 
-    geom_type = get_geom_type(table.table_name)
+    # Tables imported before the geometry catalog get their geometry information on the first write
+    geom_type = table.geom_type if table.geom_updated_at else update_geom_info(table)
 
     for key in data:
         if key not in fields:
@@ -202,14 +195,21 @@ def create_gis_id(table_id):
 
     query = insert(table_obj).values(**data)
     res = Session.execute(query)
+    if 'geom' in data:
+        expand_extent(table, res.inserted_primary_key[0])
+    bump_table_version(table.id)
     Session.commit()
+
+    # The type of a generic geometry column is defined by the first record
+    if 'geom' in data and geom_type == 'GEOMETRY':
+        update_geom_info(table)
     return jsonify({"id": res.inserted_primary_key[0]}), 201
 
 
 @gis.put('/gis/<int:table_id>/parent')
 def update_parent_id(table_id):
     """Update parent_id of table"""
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
@@ -225,12 +225,16 @@ def update_parent_id(table_id):
     if parent_id is None:
         Session.query(TableName).filter(TableName.id == table.id). \
             update({'parent_id': None}, synchronize_session=False)
+        bump_meta_version(table.id)
         Session.commit()
+        invalidate_registry()
         return jsonify({"message": f"table №{table_id} successfully removed from folder."}), 200
     if folder:
         Session.query(TableName).filter(TableName.id == table.id). \
             update({'parent_id': folder.id}, synchronize_session=False)
+        bump_meta_version(table.id)
         Session.commit()
+        invalidate_registry()
         return jsonify({"message": f"table №{table_id} successfully put in folder."}), 200
 
     return jsonify({"message": "not found parent_id"}), 400
@@ -239,7 +243,7 @@ def update_parent_id(table_id):
 @gis.delete('/gis/<int:table_id>')
 def delete_table_id(table_id):
     """Deleting a table by ID"""
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
@@ -260,85 +264,69 @@ def delete_table_id(table_id):
         # Deleting a folder
         Session.query(TableFolder).filter(TableFolder.id == folder.id).delete()
         Session.commit()
+        invalidate_registry()
 
         return jsonify({"message": f"Successfully deleting folder №{folder.id}"})
 
-    # Deleting files in table
-    files = TableFile.query.filter(TableFile.table_id == table.id).all()
-    for file in files:
-        try:
-            os.remove(file.path)
-        except FileNotFoundError:
-            continue
-
-    # Deleting a table entry from the registry
-    Session.delete(table)
-    Session.commit()
-
-    # Deleting the table itself or a record about it
-    query = f'DROP TABLE {table.table_name};'
-    Session.execute(query)
+    # The table is hidden at once. The table itself, its documents and comments are removed
+    # by the background reclamation
+    table.deleted_at = func.now()
     Session.commit()
+    invalidate_registry()
+    reclaim_requested.set()
     return jsonify({"message": f"Table №{table_id} successfully deleted."})
 
 
 @gis.get('/gis/<int:table_id>/<int:gis_id>')
 def get_gis_id(table_id, gis_id):
     """Displaying table entries by ID"""
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
         return jsonify({"message": "folder does not have this method"}), 405
 
-    count_query = f"""SELECT array_agg(gis_id) FROM {table.table_name}"""
+    # The record can change only with the version of the table, then the client's copy is still valid
+    etag = table_etag(table, 'record', gis_id)
+    if is_not_modified(etag, table.modified_at):
+        return not_modified(etag, table.modified_at)
 
-    count_response = Session.execute(text(count_query)).first()[0]
+    try:
+        field_base = get_table_schema(table).columns
+    except NoSuchTableError:
+        return jsonify({"message": "not found table in db"}), 502
 
-    if count_response is None:
-        return jsonify({"message": "not found any records"}), 404
-
-    field_base = Session.execute(f"""SELECT json_agg(column_name) FROM information_schema.columns
-                                     WHERE TABLE_NAME = '{table.table_name.split('.')[1]}'""").first()[0]
-
-    response_borders = None
-    if gis_id in count_response:
-        query = f"""SELECT json_agg(gis_obj)
-                            FROM (SELECT * FROM {table.table_name} 
-                            WHERE gis_id = {gis_id}) as gis_obj"""
-        response = Session.execute(text(query)).first()[0][0]
-        if 'geom' in field_base:
-            query_borders = f"""SELECT json_agg(f) FROM(SELECT
-                                                    min(ST_XMin(data)) as "0",
-                                                    min(ST_YMin(data)) as "1",
-                                                    max(ST_XMax(data)) as "2",
-                                                    max(ST_YMax(data)) as "3" FROM (SELECT box2d(geom)::geometry as data
-                                                    FROM {table.table_name}
-                                                    WHERE gis_id = {gis_id}) as gm) f"""
-
-            response_borders = Session.execute(text(query_borders)).first()[0][0]
-    else:
+    # One lookup by the primary key returns the record together with its bbox
+    box = "ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)" if 'geom' in field_base \
+        else "NULL, NULL, NULL, NULL"
+    query = f"""SELECT row_to_json(gis_obj), {box}
+                FROM {table.table_name} gis_obj
+                WHERE gis_id = :gis_id"""
+    record = Session.execute(text(query), {"gis_id": gis_id}).first()
+    if record is None:
         return jsonify({"message": "record not found"}), 404
 
-    return jsonify({"data": response, "borders": response_borders if response_borders else None})
+    return set_validators(jsonify({"data": record[0], "borders": borders_from_box(record[1:])}),
+                          etag, table.modified_at)
 
 
 @gis.post('/gis/<int:table_id>/<int:gis_id>/copy')
 def copy_gis_id(table_id, gis_id):
     """Copy record table by ID"""
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
         return jsonify({"message": "folder does not have this method"}), 405
 
-    table_obj = get_table_class(table.table_name)
+    table_obj = get_table_class(table)
     gis_obj = Session.query(*[col for col in table_obj.c if col.name != 'gis_id']). \
         filter(table_obj.c.gis_id == gis_id).first()
     if gis_obj:
         # Copy record in table
         query = insert(table_obj).values(**gis_obj)
         res = Session.execute(query)
+        bump_table_version(table.id)
         Session.commit()
     else:
         return jsonify({"message": "not found gis_id"}), 404
@@ -349,7 +337,7 @@ def copy_gis_id(table_id, gis_id):
 @gis.put('/gis/<int:table_id>/<int:gis_id>')
 def put_gis_id(table_id, gis_id):
     """A request to change data in a table by ID receives a JSON"""
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
@@ -361,7 +349,7 @@ def put_gis_id(table_id, gis_id):
     if not isinstance(data, dict):
         return jsonify({"message": "failed request"}), 400
 
-    table_obj = get_table_class(table.table_name)
+    table_obj = get_table_class(table)
 
     for key, value in data.items():
         if not (key in table_obj.columns):
@@ -373,52 +361,97 @@ def put_gis_id(table_id, gis_id):
 
     query = table_obj.update().values(data).where(table_obj.c.gis_id == gis_id)
 
+    if 'geom' in data:
+        release_extent(table, get_record_box(table, gis_id))
     Session.execute(query)
+    if 'geom' in data:
+        expand_extent(table, gis_id)
+    bump_table_version(table.id)
     Session.commit()
 
+    if 'geom' in data and table.geom_type in (None, 'GEOMETRY'):
+        update_geom_info(table)
+
     return jsonify({"id": gis_id}), 200
 
 
 @gis.delete('/gis/<int:table_id>/<int:gis_id>')
 def delete_gis_id(table_id, gis_id):
     """Deleting a record in table by ID"""
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
         return jsonify({"message": "folder does not have this method"}), 405
 
-    table_obj = get_table_class(table.table_name)
+    table_obj = get_table_class(table)
     gis_obj = Session.query(table_obj).filter(table_obj.c.gis_id == gis_id).first()
 
-    files = TableFile.query.filter(TableFile.table_id == table_id, TableFile.row_id == gis_id).all()
     # Checking that a record with this id exists
     if gis_obj:
-        if files:
-            # Deleting file in record
-            for file in files:
-                try:
-                    os.remove(file.path)
-                except FileNotFoundError:
-                    continue
-            # Deleting record about file from table files
-            TableFile.query.filter(TableFile.table_id == table_id, TableFile.row_id == gis_id).delete()
-
-        # Deleting comments in record
-        CommentTable.query.filter(CommentTable.table_id == table_id,
-                                  CommentTable.row_id == gis_id).delete()
+        # Deleting documents and comments of the record
+        delete_attachments(table_id, [gis_id])
 
         query = f'DELETE FROM {table.table_name} WHERE gis_id = {gis_id};'
+        if table.geom_type:
+            release_extent(table, get_record_box(table, gis_id))
     else:
         return jsonify({"message": "Row not found"}), 404
 
     # Deleting the table itself or a record about it
     Session.execute(query)
+    bump_table_version(table.id)
     Session.commit()
+    reclaim_requested.set()
 
     return jsonify({"message": f"Row № {gis_id} successfully deleted."})
 
 
+@gis.post('/gis/<int:table_id>/batch')
+def batch_gis_id(table_id):
+    """Inserts, updates and deletes records of the table by a list of operations in one transaction.
+    Body: {"operations": [{"op": "insert", "data": {...}}, {"op": "update", "id": 1, "data": {...}},
+    {"op": "delete", "id": 2}]}. All operations are checked before writing, any error cancels the whole batch.
+    Returns the result of every operation: id of the record and its status"""
+    table = get_table(table_id)
+    if table is None:
+        return jsonify({"message": "table not found"}), 404
+    if table.is_folder:
+        return jsonify({"message": "folder does not have this method"}), 405
+
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list):
+        return jsonify({"message": "failed request: operations must be a list"}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({"message": f"too many operations, maximum is {BATCH_MAX_OPERATIONS}"}), 413
+
+    try:
+        schema = get_table_schema(table)
+    except NoSuchTableError:
+        return jsonify({"message": "not found table in db"}), 502
+    geom_column_type = schema.geometry[0] if schema.geometry else None
+    # Tables imported before the geometry catalog get their geometry information on the first write
+    geom_type = table.geom_type if table.geom_updated_at else update_geom_info(table)
+
+    writer = BatchWriter(table, geom_column_type)
+    try:
+        operations = validate_operations(operations, schema.table.columns,
+                                         None if geom_column_type == 'GEOMETRY' else geom_type)
+        results = writer.apply(operations)
+        Session.commit()
+    except BatchError as e:
+        Session.rollback()
+        return jsonify({"message": str(e), "errors": e.errors}), 400
+
+    if writer.counts['deleted']:
+        reclaim_requested.set()
+    # The type of a generic geometry column is defined by the first record
+    if writer.geom_changed and table.geom_type in (None, 'GEOMETRY'):
+        update_geom_info(table)
+    return jsonify({"results": results, **writer.counts})
+
+
 @gis.post('/gis/folders')
 def create_folder():
     """Create a new folder"""
@@ -428,55 +461,43 @@ def create_folder():
     if alias is None:
         return jsonify({"message": "not found data"}), 400
 
-    name = f'folder{datetime.utcnow().strftime("%d_%m_%y_%H_%M_%S")}'
-
-    # Saving folder to the table of folders
-    folder = TableFolder(name=name)
-
-    # Saving folder to the registry of tables
-    table = TableName(table_name=f'{folder.name}', is_folder=True)
-    Session.add_all([folder, table])
-    Session.commit()
-
-    # Saving alias to the registry of tables
-    localization = Localization(language='ru', alias=alias, table_id=table.id)
-    Session.add(localization)
-    Session.commit()
-
+    _, table = new_folder(alias)
     return jsonify({"id": table.id}), 201
 
 
 @gis.get('/gis/<int:table_id>/export')
 def export_data(table_id):
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
         return jsonify({"message": "folder does not have this method"}), 405
 
-    location = os.path.join('gis_export_files')
-    Path(location).mkdir(parents=True, exist_ok=True)
-
-    filename = f'file_geotable_{datetime.utcnow().strftime("%d_%m_%y_%H_%M_%S")}'
-    path_file = f'{filename}.geojson'
-    path = os.path.join(location, path_file)
-
-    query = f""" SELECT json_agg(f) FROM (SELECT * FROM {table.table_name}) f """
-    data = Session.execute(text(query)).first()[0]
-    Session.commit()
-
-    geojson = {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": d.pop('geom', None),
-                "properties": d,
-            } for d in data]
-    }
-
-    with open(path, 'w') as f:
-        json.dump(geojson, f)
-
-    return send_from_directory(directory=location, path=path_file,
-                               as_attachment=True, download_name=filename)
+    # Streaming export straight from the database cursor
+    stream_format = request.args.get('stream')
+    if stream_format:
+        if stream_format not in STREAM_FORMATS:
+            return jsonify({"message": f"failed request: stream must be one of {', '.join(STREAM_FORMATS)}"}), 400
+        try:
+            table_obj = get_table_class(table)
+        except NoSuchTableError:
+            return jsonify({"message": "not found table in db"}), 502
+        query = select(table_obj).order_by(table_obj.c.gis_id)
+        filename = f'file_geotable_{datetime.utcnow().strftime("%d_%m_%y_%H_%M_%S")}.{stream_format}'
+        return Response(stream_with_context(stream_records(query, stream_format, 'geom' in table_obj.columns)),
+                        mimetype=STREAM_FORMATS[stream_format],
+                        headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+    # Export by ogr2ogr to a file kept until the table changes
+    export_format = request.args.get('format', 'geojson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"message": f"failed request: format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+
+    path = get_export(table, export_format)
+    if path is None:
+        return jsonify({"message": "failed to export table"}), 503
+
+    _, extension, mimetype, _ = EXPORT_FORMATS[export_format]
+    return send_from_directory(directory=os.path.dirname(path), path=os.path.basename(path),
+                               as_attachment=True, mimetype=mimetype,
+                               download_name=f'{table.table_name.split(".")[-1].strip(chr(34))}.{extension}')
@@ -1,62 +1,158 @@
+import codecs
+import io
 import os
+import time
+import zipfile
+import fiona
 import geopandas as gpd
-import numpy as np
 import re
-import json
 from chardet import detect
 from flask import Blueprint, jsonify, request
 from sqlalchemy import Table, Column, Boolean, Integer, Float, String, Numeric, \
-    DateTime
+    DateTime, MetaData, or_
+from sqlalchemy.sql import func
 from geoalchemy2 import Geometry
-from shapely import wkt, wkb
 from datetime import datetime
-from ogr2ogr import main
-
-from config import logger, DB_SCHEMA
-from db import engine, TableName, Session, Localization, metadata, TableAlias
+from itertools import islice
+from concurrent.futures import wait
+from ogr2ogr import main, Translator
+from osgeo import ogr
+
+from config import logger, DB_SCHEMA, IMPORT_CHUNK_SIZE
+from db import engine, pg_source, TableName, TableFolder, Session, Localization, TableAlias, ImportJob, \
+    install_version_trigger, get_table_schema, get_table
+from decoding import decode_geometries
+from json_stream import JsonStream
+from loader import CopyLoader
+from jobs import import_pool, QueueFull, update_job, job_info
+from reimport import merge_staging, MergeError
+from utils import invalidate_registry, update_geom_info, refresh_extent, new_folder
 
 gis_import = Blueprint('gis_import', __name__)
 
+# Progress of the import in percent at the end of the conversion and writing of the file
+CONVERTED, WRITTEN = 30, 95
+
+# Number of features in a transaction of the direct import
+DIRECT_TRANSACTION_SIZE = 65536
+
+# Size of the beginning of the file checked for BOM and UTF-8, and the part of it given to chardet
+ENCODING_SAMPLE_SIZE = 1 << 20
+DETECT_SAMPLE_SIZE = 64 << 10
+NON_ASCII = re.compile(rb'[\x80-\xff]')
+
+BINARY_EXTENSIONS = ('.gpkg', '.sqlite', '.fgb')
+
+# Code pages of the language driver byte of .dbf files
+DBF_LANGUAGE_DRIVERS = {0x01: 'cp437', 0x02: 'cp850', 0x03: 'cp1252', 0x26: 'cp866', 0x65: 'cp866', 0xC9: 'cp1251'}
+
 GEOMETRY_TYPE = ['geometry', 'point', 'polygon', 'linestring', 'multilinestring', 'multipolygon',
                  'multipoint', 'polyhedralsurface', 'triangle', 'tin', 'geometrycollection']
 
 
-def load_valid(geo, geometry_format='wkt'):
+def cpg_encoding(value):
+    """Python name of the encoding written in a .cpg file: UTF-8, 1251, CP1251, ANSI 1251, 65001..."""
+    value = value.strip().upper().replace('ANSI', '').strip()
+    if value.isdigit():
+        value = 'utf-8' if value == '65001' else f'cp{value}'
     try:
-        return wkb.loads(geo, hex=True) if geometry_format == 'wkb' else wkt.loads(geo)
-    except Exception:
-        return np.nan
-
+        return codecs.lookup(value).name
+    except LookupError:
+        return None
+
+
+def sample_encoding(sample):
+    """Encoding of a sample of the file: by BOM, by validity of UTF-8, and only then by chardet
+    over a bounded part of the sample with non-ASCII lines"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        # The sample can end in the middle of a character
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    non_ascii = b'\n'.join(line for line in sample.split(b'\n') if NON_ASCII.search(line))
+    detected = detect(non_ascii[:DETECT_SAMPLE_SIZE]).get("encoding")
+    return codecs.lookup(detected).name if detected else 'cp1251'
+
+
+def layer_files(names, layer):
+    """Files of the shapefile of the layer in the archive, all files if the layer is not given or not found"""
+    if layer is None:
+        return names
+    files = [name for name in names if os.path.splitext(os.path.basename(name))[0].lower() == layer.lower()]
+    return files or names
+
+
+def detect_encoding(file_path, file_type, layer=None):
+    """Determines the encoding of the uploaded file once, before it is parsed.
+    For a zip of shapefiles the .cpg file is used, then the language driver and the records of the .dbf file.
+    The shapefiles of an archive may have different code pages, so the files of the layer are read"""
+    if file_type == 'application/zip':
+        with zipfile.ZipFile(file_path) as archive:
+            names = layer_files(archive.namelist(), layer)
+            cpg = next((name for name in names if name.lower().endswith('.cpg')), None)
+            if cpg:
+                encoding = cpg_encoding(archive.read(cpg).decode('ascii', 'ignore'))
+                if encoding:
+                    return encoding
+            dbf = next((name for name in names if name.lower().endswith('.dbf')), None)
+            if dbf is None:
+                return None
+            with archive.open(dbf) as f:
+                sample = f.read(ENCODING_SAMPLE_SIZE)
+        if len(sample) > 29 and sample[29] in DBF_LANGUAGE_DRIVERS:
+            return DBF_LANGUAGE_DRIVERS[sample[29]]
+        # Records of the .dbf file follow its header
+        return sample_encoding(sample[int.from_bytes(sample[8:10], 'little'):])
+
+    # Strings of binary formats are in UTF-8 by their specifications
+    if file_path.lower().endswith(BINARY_EXTENSIONS):
+        return None
 
-def check_encoding(file_path):
     with open(file_path, 'rb') as f:
-        data = f.read(1000000)
-    encoding = detect(data).get("encoding")
-    return encoding
-
-
-def parse_json(file_path, file_output, geometry_field, geometry_format):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    if isinstance(data, list):
-        if geometry_field not in data[0]:
-            return logger.error("not found geometry_field")
-        geojson_data = {
-            "type": "FeatureCollection",
-            "features": [{
-                "type": "Feature",
-                "geometry": d.pop(geometry_field) if not geometry_format or (geometry_format.lower() == 'geojson')
-                else None,
-                "properties": d if not d.get('properties') else d['properties'],
-            } for d in data]
-        }
-    elif isinstance(data, dict) and data.get('features', None):
-        geojson_data = data
-    else:
-        return logger.error("don't read json: not valid data")
-
-    with open(file_output, 'w') as f:
-        json.dump(geojson_data, f)
+        sample = f.read(ENCODING_SAMPLE_SIZE)
+    return sample_encoding(sample)
+
+
+def json_feature(item, geometry_field, geometry_format):
+    """Feature of GeoJSON for a record of a JSON array"""
+    return {
+        "type": "Feature",
+        "geometry": item.pop(geometry_field, None) if not geometry_format or (geometry_format.lower() == 'geojson')
+        else None,
+        "properties": item if not item.get('properties') else item['properties'],
+    }
+
+
+def read_json_chunks(path, geometry_field, geometry_format, encoding=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """Reads a JSON array of records or a FeatureCollection by chunks straight from the uploaded file,
+    decoding one element at a time. Yields pairs (GeoDataFrame, read part of the file)"""
+    size = os.path.getsize(path) or 1
+    with open(path, 'rb') as raw, io.TextIOWrapper(raw, encoding=encoding or 'utf-8') as f:
+        stream = JsonStream(f)
+        items = iter(stream)
+        empty = True
+        try:
+            for batch in iter(lambda: list(islice(items, chunk_size)), []):
+                if stream.kind == 'array':
+                    if empty and (not isinstance(batch[0], dict) or geometry_field not in batch[0]):
+                        raise ParseError("not found geometry_field")
+                    batch = [json_feature(item, geometry_field, geometry_format) for item in batch]
+                # Named CRS of the old GeoJSON specification, if it goes before the features
+                crs = ((stream.members.get('crs') or {}).get('properties') or {}).get('name') or 'EPSG:4326'
+                empty = False
+                yield gpd.GeoDataFrame.from_features(batch, crs=crs), raw.tell() / size
+        except UnicodeError:
+            raise
+        except (ValueError, AttributeError, TypeError) as e:
+            logger.error(f"don't read json: {e}")
+            raise ParseError("failed to read file, not valid data")
+    if empty:
+        yield gpd.GeoDataFrame(columns=['geometry'], geometry='geometry', crs='EPSG:4326'), 1
 
 
 def check_columns(gdf, geometry_field):
@@ -80,53 +176,89 @@ def check_columns(gdf, geometry_field):
     return gdf
 
 
-def parser(file_path, table_name, file_type, geometry_field, geometry_format):
-    """ Handling file. Convert file to dataframe, then upload to database.
-        Entry data mush have file_path, table_name and file_type for upload table.
-        Geometry_field and geometry_format need for correct processing of geometry"""
+def same_geometry(types):
+    """Only a type and its multi type are allowed in a table"""
+    return len({name.upper().replace('MULTI', '', 1) for name in types}) <= 1
+
+
+def inspect_source(file_path, layer=None):
+    """Names of the fields and the geometry types of the layer as GDAL reads it, None if GDAL can't open it.
+    A layer declaring a generic geometry type is scanned for the types of its geometries"""
+    source = ogr.Open(file_path)
+    if source is None:
+        return None
+    source_layer = source.GetLayerByName(layer) if layer else source.GetLayer(0)
+    if source_layer is None:
+        return None
+    definition = source_layer.GetLayerDefn()
+    fields = [definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())]
+
+    geom_type = ogr.GT_Flatten(source_layer.GetGeomType())
+    if geom_type == ogr.wkbNone:
+        types = set()
+    elif geom_type in (ogr.wkbUnknown, ogr.wkbGeometryCollection):
+        result = source.ExecuteSQL(f'SELECT DISTINCT OGR_GEOMETRY FROM "{source_layer.GetName()}"',
+                                   dialect='OGRSQL')
+        types = {feature.GetField(0) for feature in result if feature.GetField(0)}
+        source.ReleaseResultSet(result)
+    else:
+        types = {ogr.GeometryTypeToName(geom_type).replace(' ', '').upper()}
+    return fields, types
 
-    file_output = os.path.join('files', f'out_{datetime.utcnow().strftime("%d_%m_%y_%H_%M_%S")}.geojson')
 
-    if file_type == 'application/json':
-        parse_json(file_path, file_output, geometry_field, geometry_format)
-    elif file_type == 'application/zip':
-        file_output = file_path
-    else:
-        main(["ogr2ogr", "-f", "GeoJSON", file_output, file_path])
+def keeps_columns(fields, geometry_field):
+    """The direct import writes the fields as they are, so it is used only when check_columns
+    would not drop or rename any of them and they do not clash with gis_id and geom"""
+    names = [re.sub(r'\W', '_', field).lower() for field in fields]
+    return names == fields and len(set(names)) == len(names) and geometry_field not in fields \
+        and 'gis_id' not in names and 'geom' not in names
 
-    if not os.path.exists(file_output):
-        return {"message": "failed to read file, not valid data"}, 400
 
-    try:
-        gdf = gpd.read_file(file_output).to_crs(epsg=4326)
-    except UnicodeError:
+def no_progress(phase, percent, **counts):
+    pass
+
+
+class ParseError(Exception):
+    """Not valid data of the imported file, the message is returned to the user"""
+
+
+def read_chunks(path, encoding=None, layer=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """Reads the file by chunks of features, so that the memory does not depend on the size of the file.
+    Yields pairs (GeoDataFrame, read part of the file or None if the driver can't count features fast)"""
+    with fiona.open(path, encoding=encoding, layer=layer) as source:
+        crs = source.crs_wkt or None
         try:
-            gdf = gpd.read_file(file_output, encoding='Windows-1251').to_crs(epsg=4326)
-        except UnicodeError:
-            encoding = check_encoding(file_path)
-            if encoding:
-                gdf = gpd.read_file(file_output, encoding=encoding).to_crs(epsg=4326)
-            else:
-                return {"message": "don't read encoding of file"}, 400
-    except Exception as e:
-        logger.error(e)
-        return {"message": "failed convert to dataframe"}, 500
+            total = len(source)
+        except (TypeError, ValueError, fiona.errors.FionaError):
+            total = None
+        columns = list(source.schema['properties']) + ['geometry']
+        rows = 0
+        for batch in iter(lambda: list(islice(source, chunk_size)), []):
+            rows += len(batch)
+            yield gpd.GeoDataFrame.from_features(batch, crs=crs, columns=columns), rows / total if total else None
+        if not rows:
+            yield gpd.GeoDataFrame(columns=columns, geometry='geometry', crs=crs), 1
+
+
+def prepare_chunk(gdf, geometry_field, geometry_format):
+    """Reprojects the chunk to 4326, decodes its geometry and normalizes the names of columns.
+    Returns the chunk and the number of records whose geometry failed to decode"""
+    gdf = gdf.to_crs(epsg=4326) if gdf.crs else gdf
 
     # Adapt format of geometry in file
-    if geometry_format == 'wkt':
-        gdf.geometry = gdf[geometry_field].apply(load_valid) if geometry_field in gdf.columns.tolist() \
-            else gdf.geometry.apply(load_valid)
-    elif geometry_format == 'wkb':
-        gdf.geometry = gdf[geometry_field].apply(load_valid,
-                                                 geometry_format='wkb') if geometry_field in gdf.columns.tolist() \
-            else gdf.geometry.apply(load_valid, geometry_format='wkb')
+    failed = 0
+    if geometry_format in ('wkt', 'wkb'):
+        if geometry_field in gdf.columns.tolist():
+            geometries, failed_mask = decode_geometries(gdf[geometry_field], geometry_format)
+            gdf.geometry = geometries
+            failed = int(failed_mask.sum())
     elif geometry_format == 'xy':
         geometry_field = geometry_field.replace(' ', '').split(',')
 
         if len(geometry_field) != 2:
-            return {"message": "not valid geometry_field for XY"}, 400
+            raise ParseError("not valid geometry_field for XY")
         if not set(geometry_field).issubset(set(gdf.columns.tolist())):
-            return {"message": "not found columns XY"}, 400
+            raise ParseError("not found columns XY")
 
         gdf.geometry = gpd.points_from_xy(gdf[geometry_field[0]], gdf[geometry_field[1]])
 
@@ -134,75 +266,405 @@ def parser(file_path, table_name, file_type, geometry_field, geometry_format):
 
     gdf.rename_geometry('geom', inplace=True)
 
-    gdf = check_columns(gdf, geometry_field)
+    return check_columns(gdf, geometry_field), failed
+
+
+def load_file(chunks, table_name, geometry_field, geometry_format, progress):
+    """Writes every chunk of the file to the database in one transaction.
+    chunks - pairs (GeoDataFrame, read part of the file or None)"""
+    geometry_types = set()
+    rows_read = 0
+    rows_failed = 0
+    with CopyLoader(table_name) as loader:
+        for chunk, part in chunks:
+            gdf, failed = prepare_chunk(chunk, geometry_field, geometry_format)
+            rows_read += len(gdf)
+            rows_failed += failed
+
+            # Check valid geometry in table: only a type and its multi type are allowed
+            geometry_types.update(str(geom) for geom in gdf.geom_type.values if geom)
+            if not same_geometry(geometry_types):
+                raise ParseError("different geometry")
+
+            loader.write(gdf)
+            percent = CONVERTED + (WRITTEN - CONVERTED) * part if part else CONVERTED
+            progress('writing', percent, rows_read=rows_read, rows_written=loader.rows, rows_failed=rows_failed)
+        stats = loader.finish()
+    progress('writing', WRITTEN, rows_per_second=stats['rows_per_second'])
+    return 'import done', 200
 
-    try:
-        geometry_empty = gdf.geometry.isnull().all()
-        if not geometry_empty:
-            # Check valid geometry in table
-            geometry_types = list(dict.fromkeys(gdf.geom_type.values))
-            different_geometry = [geom for geom in geometry_types if str(geometry_types[0]) not in f'Multi{geom}']
-            if different_geometry:
+
+def load_direct(file_path, table_name, progress, layer=None):
+    """Translates the file straight into Postgis by the PostgreSQL driver of ogr2ogr: COPY, reprojection
+    to 4326, gis_id key and the spatial index in one pass, without an intermediate file and a dataframe"""
+    def ogr_progress(complete, message, data):
+        progress('writing', complete * WRITTEN)
+        return True
+
+    args = ["ogr2ogr", "-progress", "--config", "PG_USE_COPY", "YES",
+            "-f", "PostgreSQL", pg_source(), file_path, *([layer] if layer else []), "-nln", table_name,
+            "-t_srs", "EPSG:4326", "-gt", str(DIRECT_TRANSACTION_SIZE),
+            "-lco", f"SCHEMA={DB_SCHEMA}", "-lco", "GEOMETRY_NAME=geom", "-lco", "FID=gis_id",
+            "-lco", "SPATIAL_INDEX=GIST", "-lco", "LAUNDER=YES"]
+    # Shapefiles declare polygons and lines, but can have multi geometries
+    if file_path.lower().endswith('.shp'):
+        args += ["-nlt", "PROMOTE_TO_MULTI"]
+
+    started = time.perf_counter()
+    if not Translator().run(args, progress_func=ogr_progress):
+        Session.execute(f'DROP TABLE IF EXISTS {DB_SCHEMA}."{table_name}"')
+        Session.commit()
+        return {"message": "failed to read file, not valid data"}, 400
+
+    seconds = time.perf_counter() - started
+    rows = Session.execute(f'SELECT count(*) FROM {DB_SCHEMA}."{table_name}"').scalar()
+    logger.info(f'{table_name}: {rows} rows translated in {seconds:.1f} s')
+    progress('writing', WRITTEN, rows_read=rows, rows_written=rows,
+             rows_per_second=round(rows / seconds) if seconds else None)
+    return 'import done', 200
+
+
+def parser(file_path, table_name, file_type, geometry_field, geometry_format, progress=no_progress,
+           encoding=None, layer=None):
+    """ Handling file. Convert file to a readable format, then upload it to database by chunks.
+        Entry data mush have file_path, table_name and file_type for upload table.
+        Geometry_field and geometry_format need for correct processing of geometry.
+        Encoding is detected by detect_encoding if it is not given.
+        Layer is the name of the imported layer of a file with several layers.
+        progress(phase, percent, rows_read=, rows_written=) reports the state of the import"""
+
+    file_output = os.path.join('files', f'out_{table_name}.geojson')
+    if encoding is None:
+        encoding = detect_encoding(file_path, file_type, layer)
+
+    # Files which GDAL reads as they are go straight to the database. Geometry in attributes
+    # and strings not in UTF-8 are handled in Python
+    if file_type not in ('application/json', 'application/zip') and not geometry_format \
+            and encoding in (None, 'ascii', 'utf-8', 'utf-8-sig'):
+        source = inspect_source(file_path, layer)
+        if source is not None:
+            fields, geometry_types = source
+            if not same_geometry(geometry_types):
                 return {"message": "different geometry"}, 400
-            # Saving tables with geometry
-            gdf.to_postgis(name=table_name, con=engine, schema=DB_SCHEMA, index=False,
-                           if_exists='replace')
+            # Fields renamed or dropped by check_columns, gis_id among them, are loaded by the COPY loader
+            if keeps_columns(fields, geometry_field):
+                return load_direct(file_path, table_name, progress, layer)
+
+    progress('converting', 0)
+    if file_type == 'application/json':
+        # JSON is read straight from the upload without conversion
+        chunks = read_json_chunks(file_path, geometry_field, geometry_format, encoding)
+    else:
+        if file_type == 'application/zip':
+            file_output = file_path
         else:
-            # Saving tables without geometry
-            gdf.to_sql(name=table_name, con=engine, schema=DB_SCHEMA, index=False,
-                       if_exists='replace')
+            def ogr_progress(complete, message, data):
+                progress('converting', complete * CONVERTED)
+                return True
+            # ogr2ogr keeps the bytes of strings as they are in the source, so the encoding of the source is used
+            main(["ogr2ogr", "-progress", "-f", "GeoJSON", file_output, file_path, *([layer] if layer else [])],
+                 progress_func=ogr_progress)
+            layer = None
+
+        if not os.path.exists(file_output):
+            return {"message": "failed to read file, not valid data"}, 400
+        source = f'zip://{file_output}' if file_type == 'application/zip' else file_output
+        chunks = read_chunks(source, encoding, layer)
+    progress('writing', CONVERTED)
+
+    try:
+        return load_file(chunks, table_name, geometry_field, geometry_format, progress)
+    except UnicodeError:
+        return {"message": "don't read encoding of file"}, 400
+    except ParseError as e:
+        return {"message": str(e)}, 400
     except Exception as e:
         logger.error(e)
         return {"message": "don't put in postgis"}, 500
 
-    return 'import done', 200
+
+def register_table(table_name, alias, language, parent_id=None):
+    """Saves the imported table in the registry of tables, in the folder parent_id if it is given"""
+    # Saving information to the registry of tables
+    table = TableName(table_name=f'{DB_SCHEMA}.{table_name}', parent_id=parent_id)
+    Session.add(table)
+    Session.commit()
+
+    # Saving alias to the registry of tables
+    localization = Localization(language=language, alias=alias, table_id=table.id)
+    Session.add(localization)
+    Session.commit()
+
+    # Column gis_id is created by the loader
+    install_version_trigger(Session, table.table_name)
+    Session.commit()
+    update_geom_info(table)
+    refresh_extent(table)
+    return table
+
+
+def run_import_job(job_id):
+    """Imports the uploaded file of the job. Runs in a worker process of the import pool
+    or in the request thread for a synchronous import. Returns the HTTP status of the result:
+    400 for the errors of the file, 500 for the failures of the service"""
+    job = ImportJob.query.get(job_id)
+    update_job(job_id, status='running', started_at=func.now())
+
+    reported = {}
+
+    def progress(phase, percent, **counts):
+        # ogr2ogr reports often, the state is saved only when the percentage grows by one
+        if counts or phase != reported.get('phase') or percent - reported.get('percent', 0) >= 1:
+            update_job(job_id, phase=phase, progress=percent, **counts)
+            reported.update(phase=phase, percent=percent)
+
+    # Job id keeps the names of the tables imported in parallel different
+    table_name = f'geotable{datetime.utcnow().strftime("%d_%m_%y_%H_%M_%S")}_{job_id}'
+    if job.target_table_id:
+        # A re-import is loaded into a staging table and merged into the existing table
+        table_name = f'staging_{job.target_table_id}_{job_id}'
+    try:
+        # The encoding is decided once and kept with the upload
+        encoding = job.encoding
+        if encoding is None:
+            encoding = detect_encoding(job.file_path, job.content_type, job.layer)
+            update_job(job_id, encoding=encoding)
+
+        message, status = parser(job.file_path, table_name, job.content_type, job.geometry_field,
+                                 job.geometry_format, progress, encoding, job.layer)
+        if status != 200:
+            update_job(job_id, status='failed', message=message.get('message'), finished_at=func.now())
+            return status
+
+        if job.target_table_id:
+            progress('merging', WRITTEN)
+            counts = merge_staging(get_table(job.target_table_id), table_name, job.key_field)
+            update_job(job_id, status='done', progress=100, table_id=job.target_table_id, finished_at=func.now(),
+                       rows_inserted=counts['inserted'], rows_updated=counts['updated'],
+                       rows_deleted=counts['deleted'])
+            return 200
+
+        progress('registering', WRITTEN)
+        table = register_table(table_name, job.alias, job.language, job.folder_id)
+        update_job(job_id, status='done', progress=100, table_id=table.id, finished_at=func.now())
+        logger.info(message)
+        return 200
+    except Exception as e:
+        logger.error(f'import job {job_id}: {e}')
+        Session.rollback()
+        update_job(job_id, status='failed', message=str(e).split('\n')[0], finished_at=func.now())
+        # The key which does not match the file or the table is an error of the request
+        return 400 if isinstance(e, MergeError) else 500
+    finally:
+        Session.remove()
+
+
+def import_finished(job_id):
+    # The worker process has its own registry, the registry of the web process is invalidated here
+    invalidate_registry()
+    try:
+        # The job of the last finished layer finishes the job of the file
+        parent_id = ImportJob.query.get(job_id).parent_id
+        if parent_id:
+            finish_layers(parent_id)
+    finally:
+        Session.remove()
+
+
+def fail_layers(parent_id, message):
+    """Fails the job of a file with several layers together with the jobs of all its layers"""
+    Session.query(ImportJob).filter(or_(ImportJob.id == parent_id, ImportJob.parent_id == parent_id)). \
+        update({'status': 'failed', 'message': message, 'finished_at': func.now()}, synchronize_session=False)
+    Session.commit()
+
+
+def finish_layers(parent_id):
+    """Finishes the job of a file with several layers when the jobs of all its layers are finished"""
+    layers = ImportJob.query.filter(ImportJob.parent_id == parent_id).all()
+    if any(job.status in ('queued', 'running') for job in layers):
+        return
+    failed = [job for job in layers if job.status != 'done']
+    update_job(parent_id, status='failed' if failed else 'done', progress=100, finished_at=func.now(),
+               rows_read=sum(job.rows_read or 0 for job in layers),
+               rows_written=sum(job.rows_written or 0 for job in layers),
+               message=f'{len(failed)} of {len(layers)} layers failed' if failed else None)
+
+
+def list_layers(file_path, file_type):
+    """Names of the layers of a GeoPackage, an archive with several shapefiles and other multi-layer files"""
+    if file_type == 'application/json':
+        return []
+    try:
+        return fiona.listlayers(f'zip://{file_path}' if file_type == 'application/zip' else file_path)
+    except Exception as e:
+        logger.info(f'layers of {file_path}: {e}')
+        return []
+
+
+def layers_info(parent):
+    """Information of the job of a file with several layers: the folder of the tables and the jobs of layers
+    with their timings"""
+    layers = ImportJob.query.filter(ImportJob.parent_id == parent.id).order_by(ImportJob.id).all()
+    return job_info(parent) | {"folder_id": parent.table_id, "layers": [job_info(job) for job in layers]}
+
+
+def import_layers(parent, layers, sync):
+    """Imports every layer of the file into its own table by the process pool in parallel.
+    The tables are put into a new folder named as the file. The jobs of all layers are queued at once
+    or, when the queue has no place for all of them, the file is rejected, so it is never imported partly"""
+    folder, folder_table = new_folder(parent.alias or os.path.basename(parent.file_path), parent.language)
+    update_job(parent.id, status='running', phase='layers', table_id=folder_table.id, started_at=func.now())
+
+    jobs = [ImportJob(parent_id=parent.id, layer=layer, folder_id=folder.id, file_path=parent.file_path,
+                      content_type=parent.content_type, geometry_field=parent.geometry_field,
+                      geometry_format=parent.geometry_format, alias=layer, language=parent.language)
+            for layer in layers]
+    Session.add_all(jobs)
+    Session.commit()
+
+    try:
+        futures = import_pool.submit_many(run_import_job, [job.id for job in jobs], import_finished)
+    except QueueFull:
+        fail_layers(parent.id, 'import queue is full')
+        # The folder stays empty, it is removed as the endpoint of deletion removes folders
+        Session.query(TableName).filter(TableName.id == folder_table.id).delete(synchronize_session=False)
+        Session.query(TableFolder).filter(TableFolder.id == folder.id).delete(synchronize_session=False)
+        Session.commit()
+        invalidate_registry()
+        return jsonify({"message": "import queue is full, try later", "job_id": parent.id}), 503
+
+    if sync:
+        # Callbacks of the futures may still run when wait returns, the job of the file is finished here too
+        wait(futures)
+        invalidate_registry()
+        Session.expire_all()
+        finish_layers(parent.id)
+        return jsonify(layers_info(ImportJob.query.get(parent.id))), 201
+    return jsonify(layers_info(parent)), 202, {"Location": f'/gis/import/jobs/{parent.id}'}
+
+
+def save_upload(job, file_requested):
+    """Saves the uploaded file of the job. Job id keeps the files with the same name uploaded in parallel different"""
+    location = os.path.join('files', str(job.id))
+    os.makedirs(location, exist_ok=True)
+    job.file_path = os.path.join(location, os.path.basename(file_requested.filename))
+    logger.info(f'{job.file_path=}')
+    file_requested.save(job.file_path)
+    Session.commit()
+
+
+def submit_job(job):
+    """Puts the job into the queue of the import pool"""
+    try:
+        import_pool.submit(run_import_job, job.id, import_finished)
+    except QueueFull:
+        update_job(job.id, status='failed', message='import queue is full', finished_at=func.now())
+        return jsonify({"message": "import queue is full, try later", "job_id": job.id}), 503
+
+    return jsonify({"job_id": job.id, "status": "queued"}), 202, {"Location": f'/gis/import/jobs/{job.id}'}
 
 
 @gis_import.post('/gis/import')
 def import_gis_file():
-    """The function accepts GIS objects via POST request.
-    Saves them in the database and leaves an entry in the registry.
-    In response, the function returns the ID and alias of the table by which it can be accessed."""
+    """The function accepts GIS objects via POST request and creates the import job.
+    The file is imported in a worker process, its state is returned by /gis/import/jobs/<id>.
+    With the argument sync the file is imported in the request, and in response the function returns
+    the ID and alias of the table by which it can be accessed."""
 
+    if 'file' not in request.files:
+        return jsonify({"message": "failed request"}), 400
     file_requested = request.files['file']
-    geometry_field = request.form.get('geometry_field', 'geometry')
-    geometry_format = request.form.get('geometry_format')
-    alias = request.form.get('alias')
-    language = request.form.get('locale', 'ru')
+    if file_requested.filename == '':
+        return jsonify({"message": "not found file"}), 400
+
+    job = ImportJob(content_type=file_requested.content_type,
+                    geometry_field=request.form.get('geometry_field', 'geometry'),
+                    geometry_format=request.form.get('geometry_format'),
+                    alias=request.form.get('alias'),
+                    language=request.form.get('locale', 'ru'))
+    Session.add(job)
+    Session.commit()
+
+    save_upload(job, file_requested)
+
+    # Every layer of a multi-layer file becomes a table of its own
+    layers = list_layers(job.file_path, job.content_type)
+    if len(layers) > 1:
+        return import_layers(job, layers, 'sync' in request.args)
+
+    if 'sync' in request.args:
+        status = run_import_job(job.id)
+        job = ImportJob.query.get(job.id)
+        invalidate_registry()
+        if job.status != 'done':
+            return jsonify({"message": job.message, "job_id": job.id}), status
+        return jsonify({"id": job.table_id, "alias": {job.language: job.alias},
+                        "rows_failed": job.rows_failed}), 201
+
+    return submit_job(job)
+
+
+@gis_import.post('/gis/import/<int:table_id>')
+def reimport_gis_file(table_id):
+    """Updates the existing table from a new version of its source. Records of the file are matched
+    with the records of the table by the key column: only new, changed and deleted records are written,
+    so gis_id of unchanged records and their comments and documents are kept.
+    A file with several layers needs the layer to be given. The arguments sync and the state of the job
+    are the same as for /gis/import"""
+    table = get_table(table_id)
+    if table is None:
+        return jsonify({"message": "table not found"}), 404
+    if table.is_folder:
+        return jsonify({"message": "folder does not have this method"}), 405
+
+    key = request.form.get('key')
+    if not key:
+        return jsonify({"message": "key is required"}), 400
+    if key not in get_table_schema(table).columns or key in ('gis_id', 'geom'):
+        return jsonify({"message": f"{key} can not be the key of the table"}), 400
 
     if 'file' not in request.files:
         return jsonify({"message": "failed request"}), 400
+    file_requested = request.files['file']
     if file_requested.filename == '':
         return jsonify({"message": "not found file"}), 400
 
-    table_name = f'geotable{datetime.utcnow().strftime("%d_%m_%y_%H_%M_%S")}'
-
-    file_path = os.path.join('files', file_requested.filename)
-    logger.info(f'{file_path=}')
-    file_requested.save(file_path)
+    job = ImportJob(content_type=file_requested.content_type,
+                    geometry_field=request.form.get('geometry_field', 'geometry'),
+                    geometry_format=request.form.get('geometry_format'),
+                    layer=request.form.get('layer'),
+                    target_table_id=table.id,
+                    key_field=key)
+    Session.add(job)
+    Session.commit()
+    save_upload(job, file_requested)
 
-    message, status = parser(file_path, table_name, file_requested.content_type, geometry_field, geometry_format)
+    if job.layer is None and len(list_layers(job.file_path, job.content_type)) > 1:
+        update_job(job.id, status='failed', message='layer is required', finished_at=func.now())
+        return jsonify({"message": "the file has several layers, layer is required", "job_id": job.id}), 400
 
-    if status != 200:
-        return jsonify(message), status
-    else:
-        # Saving information to the registry of tables
-        table = TableName(table_name=f'{DB_SCHEMA}.{table_name}')
-        Session.add(table)
-        Session.commit()
+    if 'sync' in request.args:
+        status = run_import_job(job.id)
+        job = ImportJob.query.get(job.id)
+        invalidate_registry()
+        if job.status != 'done':
+            return jsonify({"message": job.message, "job_id": job.id}), status
+        return jsonify({"id": table_id, "rows_inserted": job.rows_inserted, "rows_updated": job.rows_updated,
+                        "rows_deleted": job.rows_deleted, "rows_failed": job.rows_failed})
 
-        # Saving alias to the registry of tables
-        localization = Localization(language=language, alias=alias, table_id=table.id)
-        Session.add(localization)
-        Session.commit()
+    return submit_job(job)
 
-        # Add column gis_id as primary key
-        query_gis_id = f"""ALTER TABLE {table.table_name} ADD COLUMN gis_id SERIAL PRIMARY KEY;"""
-        Session.execute(query_gis_id)
-        Session.commit()
 
-        logger.info(message)
-        return jsonify({"id": table.id, "alias": {language: alias}}), 201
+@gis_import.get('/gis/import/jobs/<int:job_id>')
+def get_import_job(job_id):
+    """Returns the phase, the percentage and the row counts of the import job and the ID of the created table.
+    For a file with several layers the jobs of the layers are returned too"""
+    job = ImportJob.query.get(job_id)
+    if job is None:
+        return jsonify({"message": "job not found"}), 404
+    if job.phase == 'layers':
+        return jsonify(layers_info(job))
+    return jsonify(job_info(job))
 
 
 @gis_import.post('/gis/import/empty')
@@ -252,9 +714,10 @@ def create_empty_gis():
     if 'geom' not in data.keys() and geometry_type:
         columns.append(Column('geom', Geometry(geometry_type.upper())))
 
+    # The table is created in its own metadata, the schema catalog reflects it on demand
     table_obj = Table(
         table_name,
-        metadata,
+        MetaData(schema=DB_SCHEMA),
         Column('gis_id', Integer, primary_key=True),
         *columns
     )
@@ -264,7 +727,10 @@ def create_empty_gis():
     # Saving information to the registry of tables
     table = TableName(table_name=f'{DB_SCHEMA}.{table_name}')
     Session.add(table)
+    install_version_trigger(Session, table.table_name)
     Session.commit()
+    update_geom_info(table)
+    refresh_extent(table)
 
     # Saving alias to the registry of tables
     if alias:
@@ -282,4 +748,5 @@ def create_empty_gis():
             Session.add(new_alias)
             Session.commit()
 
+    invalidate_registry()
     return jsonify({'id': table.id, "alias": {language: alias}}), 201
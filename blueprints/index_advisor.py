@@ -0,0 +1,40 @@
+import threading
+
+from flask import Blueprint, jsonify, request
+
+from db import TableIndex, Session
+from index_advisor import build_index, index_info
+
+index_advisor = Blueprint('index_advisor', __name__)
+
+
+@index_advisor.get('/gis/indexes')
+def get_indexes():
+    """Returns the recommended indexes with the latency of requests before and after building them"""
+    query = TableIndex.query
+    if request.args.get('table_id'):
+        query = query.filter(TableIndex.table_id == request.args.get('table_id', type=int))
+    res = {rec.id: index_info(rec) for rec in query.order_by(TableIndex.hits.desc()).all()}
+
+    if 'as_array' in request.args:
+        return jsonify(list(res.values()))
+    return jsonify(res)
+
+
+@index_advisor.post('/gis/indexes/<int:index_id>/build')
+def post_build_index(index_id):
+    """Starts building the recommended index in the background"""
+    rec = TableIndex.query.get(index_id)
+    if rec is None:
+        return jsonify({"message": "index not found"}), 404
+    if rec.status in ('building', 'built', 'exists'):
+        return jsonify({"message": f"index is already {rec.status}"}), 409
+
+    def run():
+        try:
+            build_index(index_id)
+        finally:
+            Session.remove()
+
+    threading.Thread(target=run, name=f'build_index_{index_id}', daemon=True).start()
+    return jsonify({"id": index_id, "status": "building"}), 202
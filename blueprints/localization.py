@@ -1,8 +1,10 @@
 import re
 from flask import Blueprint, jsonify, request
+from sqlalchemy.exc import NoSuchTableError
 
-from db import TableName, Localization, Session, TableAlias, get_table_class
-from blueprints.gis import get_geom_type
+from db import get_table, Localization, Session, TableAlias, get_table_schema
+from utils import invalidate_registry, bump_table_version, bump_schema_version, bump_meta_version, table_etag, \
+    is_not_modified, not_modified, set_validators
 
 localization = Blueprint('localization', __name__)
 
@@ -11,7 +13,7 @@ localization = Blueprint('localization', __name__)
 def update_alias(table_id):
     """The function updated localization in table"""
 
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
 
@@ -28,6 +30,9 @@ def update_alias(table_id):
             alias_new = Localization(table_id=table_id, language=keys, alias=values)
             Session.add(alias_new)
             Session.commit()
+    bump_meta_version(table_id)
+    Session.commit()
+    invalidate_registry()
     return jsonify({'message': f'Alias table №{table_id} update!'})
 
 
@@ -35,7 +40,7 @@ def update_alias(table_id):
 def delete_alias(table_id):
     """The function removes localization"""
 
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
 
@@ -44,7 +49,9 @@ def delete_alias(table_id):
                                              Localization.language == language).first()
     if alias_delete:
         Session.delete(alias_delete)
+        bump_meta_version(table_id)
         Session.commit()
+        invalidate_registry()
         return jsonify({'message': f'Localization "{language}" in table №{table_id} delete!'})
     else:
         return jsonify({"message": "Localization not found"}), 404
@@ -55,16 +62,22 @@ def get_fileds(table_id):
     """getting table field types in a separate method
     and converting to a single view for frontend and
     getting alias for field"""
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
         return jsonify({"message": "folder does not have this method"}), 405
 
+    # Types, aliases and extremes of the fields change only with the versions of the table
+    etag = table_etag(table, 'fields')
+    if is_not_modified(etag, table.modified_at):
+        return not_modified(etag, table.modified_at)
+
     # getting table types from the database
-    fields_base = Session.execute(f"""SELECT column_name, udt_name 
-                                      FROM information_schema.columns
-                                      WHERE TABLE_NAME = '{table.table_name.split('.')[1]}'""").all()
+    try:
+        fields_base = get_table_schema(table).columns.items()
+    except NoSuchTableError:
+        return jsonify({"message": "not found table in db"}), 502
 
     # beauty guidance for frontend
     fields_dict = {}
@@ -86,7 +99,7 @@ def get_fileds(table_id):
             fields_dict[field[0]] = {'type': 'datetime'}
         elif 'geom' in field[1]:
             fields_dict[field[0]] = {'type': 'geometry',
-                                     'geometry_type': get_geom_type(table.table_name)}
+                                     'geometry_type': table.geom_type}
         elif 'bool' in field[1]:
             fields_dict[field[0]] = {'type': 'boolean'}
         else:
@@ -105,7 +118,7 @@ def get_fileds(table_id):
 
             fields_dict[field[0]].update({'min': field_extremes[0], 'max': field_extremes[1]})
 
-    return jsonify(fields_dict)
+    return set_validators(jsonify(fields_dict), etag, table.modified_at)
 
 
 @localization.get('/gis/fields')
@@ -124,7 +137,7 @@ def get_attrs():
 def new_attr(table_id):
     """Accepts json with the name and type of the new field in the table"""
 
-    table = TableName.query.get(table_id)
+    table = get_table(table_id)
     if table is None:
         return jsonify({"message": "table not found"}), 404
     if table.is_folder:
@@ -136,9 +149,7 @@ def new_attr(table_id):
     if not isinstance(data, list):
         return jsonify({"message": "failed request"}), 400
 
-    field_base = Session.execute(f"""SELECT json_agg(column_name)
-                                     FROM information_schema.columns
-                                     WHERE TABLE_NAME = '{table.table_name.split('.')[1]}'""").first()[0]
+    field_base = get_table_schema(table).columns
 
     possible_attributes = {"string", "time", "integer", "boolean", "numeric"}
 
@@ -160,11 +171,14 @@ def new_attr(table_id):
 
                 query = f"""ALTER TABLE {table.table_name} DROP COLUMN {field_name}"""
                 Session.execute(query)
+                bump_table_version(table.id)
+                bump_schema_version(table)
                 Session.commit()
 
                 Session.query(TableAlias).filter(TableAlias.table_id == table_id,
                                                  TableAlias.table_field == field_name,
                                                  TableAlias.language == field.get('locale', 'ru')).delete()
+                bump_meta_version(table.id)
                 Session.commit()
             else:
                 if 'alias' in field.keys():
@@ -177,6 +191,7 @@ def new_attr(table_id):
                         alias = TableAlias(language=field.get('locale', 'ru'), alias=str(field.get('alias')),
                                            table_id=table.id, table_field=field_name)
                         Session.add(alias)
+                    bump_meta_version(table.id)
                     Session.commit()
         else:
 
@@ -185,11 +200,14 @@ def new_attr(table_id):
             query = f"""ALTER TABLE {table.table_name} ADD COLUMN {field_name} {field_type
             if field_type != 'time' else 'timestamp'};"""
             Session.execute(query)
+            bump_table_version(table.id)
+            bump_schema_version(table)
             Session.commit()
             if field.get('alias'):
                 locale = TableAlias(language=field.get('locale', 'ru'), alias=field.get('alias'),
                                     table_id=table.id, table_field=field_name)
                 Session.add(locale)
+                bump_meta_version(table.id)
                 Session.commit()
 
     return jsonify({'id': table.id}), 201
@@ -0,0 +1,12 @@
+from flask import Blueprint, jsonify
+
+from reclamation import reclamation_status
+
+reclamation = Blueprint('reclamation', __name__)
+
+
+@reclamation.get('/gis/reclamation')
+def get_reclamation():
+    """Returns the deleted tables and the numbers of comments and documents waiting for the background
+    reclamation, and the statistics of its last run"""
+    return jsonify(reclamation_status())
@@ -0,0 +1,60 @@
+import hashlib
+
+import sqlalchemy
+from flask import Blueprint, Response, jsonify, request
+from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy.sql import text
+
+from db import get_table, Session, get_table_class
+from utils import tile_cache
+
+tiles = Blueprint('tiles', __name__)
+
+# Parameters of ST_AsMVT: size of the tile in its own coordinates and the buffer around it
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+
+@tiles.get('/gis/<int:table_id>/tiles/<int:z>/<int:x>/<int:y>.mvt')
+def get_tile(table_id, z, x, y):
+    """Returns the Mapbox Vector Tile of the table. Attribute columns of features are set by
+    the argument columns=field1,field2, by default features have only gis_id"""
+    table = get_table(table_id)
+    if table is None:
+        return jsonify({"message": "table not found"}), 404
+    if table.is_folder:
+        return jsonify({"message": "folder does not have this method"}), 405
+    if not table.geom_type:
+        return jsonify({"message": "table does not have geometry"}), 400
+    if z > 30 or x >= 2 ** z or y >= 2 ** z:
+        return jsonify({"message": "not valid tile coordinates"}), 400
+
+    try:
+        table_obj = get_table_class(table)
+    except NoSuchTableError:
+        return jsonify({"message": "not found table in db"}), 502
+
+    columns = [column.strip() for column in request.args.get('columns', '').split(',') if column.strip()]
+    for column in columns:
+        if column not in table_obj.columns or column in ('geom', 'gis_id'):
+            return jsonify({"message": f"failed request: not found field {column}"}), 400
+
+    layer_key = hashlib.sha1(','.join(columns).encode()).hexdigest()[:16]
+    tile = tile_cache.get(table.id, table.version, layer_key, z, x, y)
+    if tile is None:
+        attributes = ''.join(f', t."{column}"' for column in columns)
+        query = f"""WITH bounds AS (SELECT ST_TileEnvelope(:z, :x, :y) AS env),
+                    mvt AS (SELECT ST_AsMVTGeom(ST_Transform(t.geom, 3857), bounds.env,
+                                                {TILE_EXTENT}, {TILE_BUFFER}, true) AS geom,
+                                   t.gis_id{attributes}
+                            FROM {table.table_name} t, bounds
+                            WHERE t.geom && ST_Transform(bounds.env, {table.srid or 4326}))
+                    SELECT ST_AsMVT(mvt.*, :layer, {TILE_EXTENT}, 'geom', 'gis_id') FROM mvt"""
+        try:
+            tile = Session.execute(text(query), {"z": z, "x": x, "y": y, "layer": str(table.id)}).scalar()
+        except sqlalchemy.exc.DBAPIError as ex:
+            return jsonify({"ERROR": str(ex).split('\n')[0]}), 503
+        tile = bytes(tile) if tile is not None else b''
+        tile_cache.set(table.id, table.version, layer_key, z, x, y, tile)
+
+    return Response(tile, mimetype='application/vnd.mapbox-vector-tile')
@@ -0,0 +1,112 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe dictionary which evicts the least recently used entries when it is full"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def discard(self, predicate):
+        """Removes all entries whose key satisfies the predicate"""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TileCache:
+    """Cache of vector tiles in memory and on disk.
+    Tiles are keyed by the table version, so a changed table never serves old tiles,
+    and invalidate() removes the tiles of the previous versions"""
+
+    def __init__(self, directory, maxsize=2048):
+        self.directory = directory
+        self._memory = LRUCache(maxsize)
+        # The oldest valid version of the tables, tiles of older versions built by parallel requests are not kept
+        self._versions = {}
+
+    def _path(self, table_id, version, layer_key, z, x, y):
+        return os.path.join(self.directory, str(table_id), str(version), layer_key, str(z), str(x), f'{y}.mvt')
+
+    def get(self, table_id, version, layer_key, z, x, y):
+        key = (table_id, version, layer_key, z, x, y)
+        tile = self._memory.get(key)
+        if tile is not None:
+            return tile
+        try:
+            with open(self._path(*key), 'rb') as f:
+                tile = f.read()
+        except FileNotFoundError:
+            return None
+        self._memory.set(key, tile)
+        return tile
+
+    def set(self, table_id, version, layer_key, z, x, y, tile):
+        if version < self._versions.get(table_id, version):
+            return
+        key = (table_id, version, layer_key, z, x, y)
+        self._memory.set(key, tile)
+        path = self._path(*key)
+        # Writing through a temporary file, so that a parallel reader never gets a part of the tile
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(tile)
+            os.replace(tmp_path, path)
+        except OSError:
+            # The directory was removed by a parallel invalidate(), the tile is served from memory only
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def invalidate(self, table_id, version=None):
+        """Removes the tiles of the versions of the table older than the version, all tiles without it.
+        Called after the change is committed, so parallel requests do not build the old version again"""
+        if version is None:
+            self._versions.pop(table_id, None)
+            self._memory.discard(lambda key: key[0] == table_id)
+            shutil.rmtree(os.path.join(self.directory, str(table_id)), ignore_errors=True)
+            return
+        self._versions[table_id] = max(version, self._versions.get(table_id, version))
+        self._memory.discard(lambda key: key[0] == table_id and key[1] < version)
+        table_directory = os.path.join(self.directory, str(table_id))
+        try:
+            names = os.listdir(table_directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.isdigit() or int(name) < version:
+                shutil.rmtree(os.path.join(table_directory, name), ignore_errors=True)
@@ -15,6 +15,49 @@ DB_SCHEMA = 'public'
 HOST = os.getenv('HOST') or '0.0.0.0'
 PORT = int(os.getenv('PORT') or 84)
 
+# Interval in seconds of the background refresh of geometry information for tables
+GEOM_REFRESH_INTERVAL = int(os.getenv('GEOM_REFRESH_INTERVAL') or 600)
+
+# Number of exact record counts kept in memory for count=cached
+COUNT_CACHE_SIZE = int(os.getenv('COUNT_CACHE_SIZE') or 4096)
+
+# Number of records read from the database at once by streaming responses
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE') or 1000)
+
+# Number of table schemas kept in memory
+SCHEMA_CATALOG_SIZE = int(os.getenv('SCHEMA_CATALOG_SIZE') or 512)
+
+# Vector tiles cache: directory on disk and number of tiles in memory
+TILE_CACHE_DIR = os.getenv('TILE_CACHE_DIR') or 'gis_tile_cache'
+TILE_CACHE_SIZE = int(os.getenv('TILE_CACHE_SIZE') or 2048)
+
+# Directory of the exported tables, files are kept until the table changes
+EXPORT_DIR = os.getenv('EXPORT_DIR') or 'gis_export_files'
+
+# Import jobs: number of worker processes and number of jobs waiting for a worker
+IMPORT_WORKERS = int(os.getenv('IMPORT_WORKERS') or 2)
+IMPORT_QUEUE_SIZE = int(os.getenv('IMPORT_QUEUE_SIZE') or 8)
+
+# Number of features read from an imported file and written to the database at once
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE') or 10000)
+
+# Batch writes of records: maximum number of operations in a request and number of records
+# written by one statement
+BATCH_MAX_OPERATIONS = int(os.getenv('BATCH_MAX_OPERATIONS') or 100000)
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE') or 1000)
+
+# Reclamation of deleted tables and records: interval in seconds of the background worker, number of
+# comments and documents removed at once and number of threads removing files
+RECLAIM_INTERVAL = int(os.getenv('RECLAIM_INTERVAL') or 60)
+RECLAIM_BATCH_SIZE = int(os.getenv('RECLAIM_BATCH_SIZE') or 1000)
+RECLAIM_WORKERS = int(os.getenv('RECLAIM_WORKERS') or 8)
+
+# Index advisor: interval in seconds of its background job, number of requests filtering or sorting
+# by a field before an index is recommended, and whether recommended indexes are built automatically
+INDEX_ADVISOR_INTERVAL = int(os.getenv('INDEX_ADVISOR_INTERVAL') or 300)
+INDEX_MIN_HITS = int(os.getenv('INDEX_MIN_HITS') or 100)
+INDEX_AUTO_BUILD = (os.getenv('INDEX_AUTO_BUILD') or 'false').lower() in ('1', 'true', 'yes')
+
 LOG_FORMAT = '[%(levelname) -3s %(asctime)s] %(message)s'
 logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
\ No newline at end of file
@@ -1,7 +1,12 @@
 import logging
-from config import DB_URL, DB_SCHEMA
-from sqlalchemy import Table, Column, Integer, String, create_engine, MetaData, Boolean, ForeignKey, DateTime, Text
-from sqlalchemy.sql import func
+import geoalchemy2  # noqa: F401 registers PostGIS types for the reflection of GIS tables
+from cache import LRUCache
+from config import DB_URL, DB_SCHEMA, STREAM_BATCH_SIZE, SCHEMA_CATALOG_SIZE, DB_HOST, DB_PORT, DB_NAME, DB_USER, \
+    DB_PWD
+from sqlalchemy import Table, Column, Integer, String, create_engine, MetaData, Boolean, ForeignKey, DateTime, Text, \
+    Float, inspect
+from sqlalchemy import select, exc
+from sqlalchemy.sql import func, literal_column, text
 from sqlalchemy.ext.declarative import as_declarative
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship
 
@@ -50,6 +55,22 @@ class TableName(Base):
     table_name = Column(String, comment='Название таблицы')
     is_folder = Column(Boolean, comment='Является ли таблица папкой', default=False)
     parent_id = Column(Integer, ForeignKey('table_folders.id'), comment='ID таблицы вложенности')
+    geom_type = Column(String, comment='Тип геометрии')
+    srid = Column(Integer, comment='SRID геометрии')
+    coord_dimension = Column(Integer, comment='Размерность геометрии')
+    geom_updated_at = Column(DateTime(timezone=True), comment='Дата обновления сведений о геометрии')
+    version = Column(Integer, comment='Версия данных таблицы', default=0, server_default='0', nullable=False)
+    schema_version = Column(Integer, comment='Версия структуры таблицы', default=0, server_default='0',
+                            nullable=False)
+    meta_version = Column(Integer, comment='Версия описаний таблицы: псевдонимов, комментариев, файлов',
+                          default=0, server_default='0', nullable=False)
+    modified_at = Column(DateTime(timezone=True), server_default=func.now(), comment='Дата изменения таблицы')
+    xmin = Column(Float, comment='Граница таблицы: минимальная долгота')
+    ymin = Column(Float, comment='Граница таблицы: минимальная широта')
+    xmax = Column(Float, comment='Граница таблицы: максимальная долгота')
+    ymax = Column(Float, comment='Граница таблицы: максимальная широта')
+    extent_updated_at = Column(DateTime(timezone=True), comment='Дата расчёта границ таблицы, пусто - требует расчёта')
+    deleted_at = Column(DateTime(timezone=True), comment='Дата удаления таблицы, таблица ожидает очистки')
 
 
 class CommentTable(Base):
@@ -61,6 +82,7 @@ class CommentTable(Base):
     created_by = Column(String, comment='Имя пользователя, оставившего комментарий')
     created_at = Column(DateTime(timezone=True), server_default=func.now(), comment='Дата создания')
     text = Column(Text, comment='Текст комментария')
+    deleted_at = Column(DateTime(timezone=True), comment='Дата удаления записи, комментарий ожидает очистки')
 
 
 class Localization(Base):
@@ -99,32 +121,224 @@ class TableFile(Base):
     filename = Column(String, comment='Имя файла в директории')
     name = Column(String, comment='Имя файла для юзера в системе')
     path = Column(String, comment='Путь к файлу')
+    deleted_at = Column(DateTime(timezone=True), comment='Дата удаления записи, файл ожидает очистки')
+
+
+class TableIndex(Base):
+    __tablename__ = 'table_indexes'
+    id = Column(Integer, primary_key=True, comment='ID рекомендации')
+    table_id = Column(Integer, ForeignKey(TableName.id, ondelete='CASCADE'), comment='ID ГИС таблицы', nullable=False)
+    field = Column(String, comment='Поле таблицы')
+    method = Column(String, comment='Вид индекса: btree, trgm или gist')
+    status = Column(String, comment='Состояние: proposed, building, built, exists или failed', default='proposed')
+    index_name = Column(String, comment='Имя индекса в БД')
+    hits = Column(Integer, comment='Количество запросов до построения индекса', default=0)
+    total_ms = Column(Float, comment='Суммарное время запросов до построения индекса, мс', default=0)
+    hits_after = Column(Integer, comment='Количество запросов после построения индекса', default=0)
+    total_ms_after = Column(Float, comment='Суммарное время запросов после построения индекса, мс', default=0)
+    message = Column(Text, comment='Ошибка построения индекса')
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment='Дата создания')
+    built_at = Column(DateTime(timezone=True), comment='Дата построения индекса')
+
+
+class ImportJob(Base):
+    __tablename__ = 'import_jobs'
+    id = Column(Integer, primary_key=True, comment='ID задачи импорта')
+    status = Column(String, comment='Состояние: queued, running, done или failed', default='queued')
+    phase = Column(String, comment='Этап импорта: converting, reading, writing, merging или registering')
+    progress = Column(Float, comment='Процент выполнения', default=0)
+    rows_read = Column(Integer, comment='Количество прочитанных записей')
+    rows_written = Column(Integer, comment='Количество записанных в БД записей')
+    rows_per_second = Column(Float, comment='Скорость записи в БД, записей в секунду')
+    rows_failed = Column(Integer, comment='Количество записей, геометрию которых не удалось прочитать')
+    file_path = Column(String, comment='Путь к загруженному файлу')
+    content_type = Column(String, comment='Тип загруженного файла')
+    geometry_field = Column(String, comment='Поле геометрии в файле')
+    geometry_format = Column(String, comment='Формат геометрии в файле')
+    encoding = Column(String, comment='Кодировка файла')
+    alias = Column(String, comment='Название таблицы')
+    language = Column(String, comment='Язык названия таблицы')
+    table_id = Column(Integer, ForeignKey(TableName.id, ondelete='SET NULL'),
+                      comment='ID созданной ГИС таблицы или папки слоёв')
+    layer = Column(String, comment='Слой файла')
+    parent_id = Column(Integer, ForeignKey('import_jobs.id', ondelete='CASCADE'),
+                       comment='ID задачи импорта файла со слоями')
+    folder_id = Column(Integer, ForeignKey(TableFolder.id, ondelete='SET NULL'), comment='ID папки слоёв')
+    target_table_id = Column(Integer, ForeignKey(TableName.id, ondelete='CASCADE'),
+                             comment='ID обновляемой ГИС таблицы при повторном импорте')
+    key_field = Column(String, comment='Ключевое поле сопоставления записей при повторном импорте')
+    rows_inserted = Column(Integer, comment='Количество добавленных записей при повторном импорте')
+    rows_updated = Column(Integer, comment='Количество изменённых записей при повторном импорте')
+    rows_deleted = Column(Integer, comment='Количество удалённых записей при повторном импорте')
+    message = Column(Text, comment='Ошибка импорта')
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment='Дата создания задачи')
+    started_at = Column(DateTime(timezone=True), comment='Дата начала импорта')
+    finished_at = Column(DateTime(timezone=True), comment='Дата окончания импорта')
+
+
+def get_table(table_id):
+    """Table or folder of the registry by ID. Deleted tables wait for the reclamation and are not shown"""
+    return TableName.query.filter(TableName.id == table_id, TableName.deleted_at.is_(None)).first()
+
+
+def pg_source():
+    """Connection string of the database for OGR"""
+    return f"PG:host='{DB_HOST}' port='{DB_PORT}' dbname='{DB_NAME}' user='{DB_USER}' password='{DB_PWD}'"
 
 
 def init_db():
     metadata.create_all()
+    upgrade_db()
+    with engine.begin() as conn:
+        conn.execute(VERSION_TRIGGER_FUNCTION)
+        for (table_name,) in conn.execute(text("SELECT table_name FROM table_names WHERE is_folder IS NOT TRUE")):
+            try:
+                with conn.begin_nested():
+                    install_version_trigger(conn, table_name)
+            except exc.DBAPIError as e:
+                logger.error(f'version trigger of {table_name}: {e}')
     logger.info('Tables created')
 
 
-def get_table_class(table_name):
-    if '.' in table_name:
-        table_name = table_name.split(".")[1]
-    res = metadata.tables.get(table_name)
-    if res is None:
-        res = Table(table_name, metadata, autoload_with=engine)
-    return res
+# Counts changes of GIS tables made bypassing the endpoints, for example by direct SQL
+VERSION_TRIGGER_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION gis_bump_table_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE {DB_SCHEMA}.table_names SET version = version + 1, modified_at = now()
+    WHERE table_name IN (TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME,
+                         TG_TABLE_SCHEMA || '."' || TG_TABLE_NAME || '"');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def install_version_trigger(conn, table_name):
+    """Creates the statement-level trigger incrementing the version of the table on any change of its data.
+    conn - connection or session"""
+    conn.execute(f'DROP TRIGGER IF EXISTS gis_version ON {table_name}')
+    conn.execute(f'CREATE TRIGGER gis_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table_name} '
+                 f'FOR EACH STATEMENT EXECUTE FUNCTION gis_bump_table_version()')
+
+
+def upgrade_db():
+    """Adds to the existing tables the columns that appeared in the models after the tables were created"""
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name, schema=DB_SCHEMA)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                default = ''
+                if column.server_default is not None:
+                    default = f' DEFAULT {column.server_default.arg}{"" if column.nullable else " NOT NULL"}'
+                conn.execute(f'ALTER TABLE {DB_SCHEMA}.{table.name} ADD COLUMN IF NOT EXISTS "{column.name}" '
+                             f'{column.type.compile(engine.dialect)}{default}')
+                logger.info(f'Column {table.name}.{column.name} added')
+
+
+class TableSchema:
+    """Schema of a GIS table: reflected SQLAlchemy table, types of columns (udt_name) in their order
+    and the geometry column description from geometry_columns"""
+
+    def __init__(self, table, columns, geometry):
+        self.table = table
+        self.columns = columns
+        self.geometry = geometry
+
+
+class SchemaCatalog:
+    """Cache of schemas of GIS tables with eviction of the least recently used ones.
+    An entry is reloaded when the schema version of the table changes,
+    the version is incremented by the endpoints which run DDL"""
+
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, table_name, schema_version=0):
+        entry = self._cache.get(table_name)
+        if entry is not None and entry[0] == schema_version:
+            return entry[1]
+        schema = self._load(table_name)
+        self._cache.set(table_name, (schema_version, schema))
+        return schema
+
+    def invalidate(self, table_name):
+        self._cache.pop(table_name)
+
+    @staticmethod
+    def _load(table_name):
+        schema, _, name = table_name.rpartition('.')
+        schema, name = (schema or DB_SCHEMA).strip('"'), name.strip('"')
+        # Each table is reflected into its own metadata, so an evicted table is freed
+        table = Table(name, MetaData(schema=schema), autoload_with=engine)
+        with engine.connect() as conn:
+            columns = {rec[0]: rec[1] for rec in conn.execute(
+                text("""SELECT column_name, udt_name FROM information_schema.columns
+                        WHERE table_schema = :schema AND table_name = :name ORDER BY ordinal_position"""),
+                {"schema": schema, "name": name})}
+            geometry = None
+            if 'geom' in columns:
+                geometry = conn.execute(text("""SELECT type::text, srid, coord_dimension FROM geometry_columns
+                                                WHERE f_table_schema = :schema AND f_table_name = :name
+                                                AND f_geometry_column = 'geom'"""),
+                                        {"schema": schema, "name": name}).first()
+        return TableSchema(table, columns, tuple(geometry) if geometry else None)
+
+
+schema_catalog = SchemaCatalog(SCHEMA_CATALOG_SIZE)
+
+
+def get_table_schema(table):
+    """Schema of the table from the catalog. table - record of TableName"""
+    return schema_catalog.get(table.table_name, table.schema_version or 0)
+
+
+def get_table_class(table):
+    return get_table_schema(table).table
 
 
 def json_query(query, as_array=False):
     """
     Описание: функция для преобразования запроса в запрос, возвращающий json
-    query - строковый запрос (без каких либо форматирований в json)
+    query - запрос SQLAlchemy (select) без каких либо форматирований в json
     as_array (умол: False) - отвечает за формат выходного json ([{}, {}] или [id1: {}, id2: {}])
-    Возвращает: строку с модифицированным запросом
+    Возвращает: запрос SQLAlchemy с полем data
     """
+    query = query.subquery('query')
     if as_array:
-        return f"WITH query as ({query}) SELECT json_agg(query) as data FROM query;"
+        return select(func.json_agg(literal_column('query')).label('data')).select_from(query)
     else:
-        return f"WITH query as ({query}) " \
-               f"SELECT COALESCE(json_object_agg(query.gis_id, " \
-               "row_to_json(query)), '{}'::json) as data FROM query; "
+        return select(func.coalesce(func.json_object_agg(query.c.gis_id, func.row_to_json(literal_column('query'))),
+                                    literal_column("'{}'::json")).label('data')).select_from(query)
+
+
+def stream_json_query(query, geojson=False, has_geom=True):
+    """
+    Описание: функция для преобразования запроса в запрос, возвращающий каждую запись отдельной строкой json
+    query - запрос SQLAlchemy (select) без каких либо форматирований в json
+    geojson (умол: False) - записи в виде GeoJSON Feature, иначе в виде объектов для NDJSON
+    has_geom (умол: True) - есть ли в таблице поле geom
+    Возвращает: запрос SQLAlchemy
+    """
+    query = query.subquery('query')
+    if not geojson:
+        return select(literal_column('row_to_json(query)::text')).select_from(query)
+    geometry = "ST_AsGeoJSON(query.geom)::json" if has_geom else "NULL"
+    return select(literal_column(f"json_build_object('type', 'Feature', 'id', query.gis_id, 'geometry', {geometry}, "
+                                 f"'properties', to_jsonb(query) - 'geom')::text")).select_from(query)
+
+
+def stream_query(query, batch_size=STREAM_BATCH_SIZE):
+    """
+    Описание: генератор, читающий результат запроса пачками через именованный курсор на стороне сервера,
+    поэтому в памяти находится не больше одной пачки записей
+    query - запрос SQLAlchemy
+    batch_size - количество записей в пачке
+    Возвращает: списки записей
+    """
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=batch_size).execute(query)
+        for rows in result.partitions(batch_size):
+            yield rows
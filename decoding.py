@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+import pygeos
+from geopandas import GeoSeries
+from geopandas.array import GeometryArray
+
+
+def decode_geometries(values, geometry_format='wkt', crs='EPSG:4326'):
+    """Decodes a column of WKT strings or WKB (bytes or hex strings) as a whole array in GEOS,
+    without a Python call per record.
+    Returns the GeoSeries of geometries and the mask of the records that have a value which failed to parse,
+    their geometries are None"""
+    data = np.asarray(values, dtype=object)
+    present = ~pd.isna(data) & (data != '')
+
+    if geometry_format == 'wkb':
+        geometries = pygeos.from_wkb(np.where(present, data, None), on_invalid='ignore')
+    else:
+        geometries = pygeos.from_wkt(np.where(present, data, None), on_invalid='ignore')
+
+    failed = present & pygeos.is_missing(geometries)
+    index = values.index if hasattr(values, 'index') else None
+    return GeoSeries(GeometryArray(geometries, crs=crs), index=index), failed
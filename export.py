@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+from config import logger, EXPORT_DIR
+from db import pg_source
+from ogr2ogr import main
+
+# Formats of export: format -> (OGR driver, extension of the file, mimetype, layer creation options)
+EXPORT_FORMATS = {
+    'geojson': ('GeoJSON', 'geojson', 'application/geo+json', ['RFC7946=YES']),
+    'gpkg': ('GPKG', 'gpkg', 'application/geopackage+sqlite3', []),
+    'fgb': ('FlatGeobuf', 'fgb', 'application/octet-stream', []),
+    'csv': ('CSV', 'csv', 'text/csv', ['GEOMETRY=AS_WKT']),
+    'shp': ('ESRI Shapefile', 'zip', 'application/zip', ['ENCODING=UTF-8']),
+}
+
+# The same file is built by one request at a time, the others wait for it: path -> [lock, number of users]
+_build_locks_lock = threading.Lock()
+_build_locks = {}
+
+
+def export_path(table, export_format):
+    """Path of the exported file. It is keyed by the versions of the data and the structure of the table,
+    so a changed table is exported again"""
+    extension = EXPORT_FORMATS[export_format][1]
+    return os.path.join(EXPORT_DIR, str(table.id), f'{table.version}_{table.schema_version}_{export_format}.{extension}')
+
+
+def translate(table, export_format, path):
+    """Exports the table by ogr2ogr reading it from Postgres with a cursor, without loading it in memory"""
+    driver, extension, _, layer_options = EXPORT_FORMATS[export_format]
+    layer_name = table.table_name.split('.')[-1].strip('"')
+    args = ["ogr2ogr", "-f", driver, path, pg_source(),
+            "-sql", f"SELECT * FROM {table.table_name} ORDER BY gis_id", "-nln", layer_name]
+    for option in layer_options:
+        args += ["-lco", option]
+    return main(args)
+
+
+def build_export(table, export_format, path):
+    """Builds the file in a temporary directory and moves it to the cache, so that a parallel
+    download never gets a part of the file"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_dir:
+        if export_format == 'shp':
+            # Shapefile is a set of files, they are given as one zip archive
+            shp_dir = os.path.join(tmp_dir, 'shp')
+            if not translate(table, export_format, shp_dir):
+                return False
+            tmp_path = os.path.join(tmp_dir, 'export.zip')
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for name in os.listdir(shp_dir):
+                    archive.write(os.path.join(shp_dir, name), name)
+        else:
+            tmp_path = os.path.join(tmp_dir, os.path.basename(path))
+            if not translate(table, export_format, tmp_path):
+                return False
+        os.replace(tmp_path, path)
+    return True
+
+
+def remove_old_exports(table, keep):
+    """Removes the files exported from the previous versions of the table"""
+    prefix = f'{table.version}_{table.schema_version}_'
+    directory = os.path.join(EXPORT_DIR, str(table.id))
+    for name in os.listdir(directory):
+        if name != keep and not name.startswith(prefix) and not name.startswith('tmp'):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                continue
+
+
+def get_export(table, export_format):
+    """Returns the path of the exported table, building the file if the cache does not have it.
+    None if ogr2ogr failed"""
+    path = export_path(table, export_format)
+    if os.path.isfile(path):
+        return path
+
+    with _build_locks_lock:
+        entry = _build_locks.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            if not os.path.isfile(path):
+                logger.info(f'export of {table.table_name} to {export_format}')
+                if not build_export(table, export_format, path):
+                    return None
+                remove_old_exports(table, os.path.basename(path))
+    finally:
+        # The lock is removed by the last of the threads using it, also when the build failed,
+        # so a waiting thread and a new one never get different locks for the same path
+        with _build_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0 and _build_locks.get(path) is entry:
+                del _build_locks[path]
+    return path
+
+
+def invalidate_exports(table_id):
+    """Removes all files exported from the table"""
+    shutil.rmtree(os.path.join(EXPORT_DIR, str(table_id)), ignore_errors=True)
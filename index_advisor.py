@@ -0,0 +1,216 @@
+import hashlib
+import re
+import threading
+
+import sqlalchemy
+from sqlalchemy.sql import func, text
+
+from config import logger, INDEX_MIN_HITS, INDEX_AUTO_BUILD
+from db import engine, Session, TableName, TableIndex, get_table
+from utils import split_table_name
+
+# Access methods of Postgres for the kinds of recommended indexes
+INDEX_METHODS = {'btree': 'btree', 'trgm': 'gin', 'gist': 'gist'}
+
+# Usage of fields by read requests, collected in memory and flushed to table_indexes by the background job:
+# (table_id, field, method) -> [number of requests, total time of requests in ms]
+_usage_lock = threading.Lock()
+_usage = {}
+
+
+def record_usage(table_id, usage, elapsed_ms):
+    """Records that the request to the table filtered or sorted by the fields.
+    usage - pairs (field, method), where method is btree, trgm or gist"""
+    with _usage_lock:
+        for field, method in set(usage):
+            counter = _usage.setdefault((table_id, field, method), [0, 0.0])
+            counter[0] += 1
+            counter[1] += elapsed_ms
+
+
+def flush_usage():
+    """Saves the collected usage in table_indexes"""
+    global _usage
+    with _usage_lock:
+        usage, _usage = _usage, {}
+    if not usage:
+        return
+
+    table_ids = {key[0] for key in usage}
+    existing = {(rec.table_id, rec.field, rec.method): rec
+                for rec in TableIndex.query.filter(TableIndex.table_id.in_(table_ids)).all()}
+    known_tables = {rec.id for rec in TableName.query.filter(TableName.id.in_(table_ids),
+                                                             TableName.deleted_at.is_(None)).all()}
+
+    for key, (hits, total_ms) in usage.items():
+        if key[0] not in known_tables:
+            continue
+        rec = existing.get(key)
+        if rec is None:
+            rec = TableIndex(table_id=key[0], field=key[1], method=key[2], hits=0, total_ms=0,
+                             hits_after=0, total_ms_after=0)
+            Session.add(rec)
+        # Latency after the index is built is measured separately to compare it with the latency before
+        if rec.status == 'built':
+            rec.hits_after += hits
+            rec.total_ms_after += total_ms
+        else:
+            rec.hits += hits
+            rec.total_ms += total_ms
+    Session.commit()
+
+
+def index_name(table_name, field, method):
+    name = f'idx_{split_table_name(table_name)[1]}_{field}_{method}'.lower()
+    if len(name) > 63:
+        name = f'{name[:50]}_{hashlib.sha1(name.encode()).hexdigest()[:12]}'
+    return name
+
+
+def references_field(expression, field):
+    """Whether the expression of an index column (pg_get_indexdef) refers to the field.
+    Names of functions and types are not taken for the field"""
+    quoted = re.escape('"{}"'.format(field.replace('"', '""')))
+    plain = re.escape(field)
+    return re.search(rf'{quoted}|(?<![\w":]){plain}(?![\w"(])', expression) is not None
+
+
+def find_index(table_name, field, method):
+    """Returns the name of an existing index of the table whose first column is the field,
+    for a trigram index also an expression of the field like lower(field)"""
+    indexes = Session.execute(text("""SELECT i.relname, a.attname, pg_get_indexdef(x.indexrelid, 1, true)
+                                      FROM pg_index x
+                                      JOIN pg_class i ON i.oid = x.indexrelid
+                                      JOIN pg_am am ON am.oid = i.relam
+                                      JOIN pg_opclass oc ON oc.oid = x.indclass[0]
+                                      LEFT JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = x.indkey[0]
+                                      WHERE x.indrelid = to_regclass(:table_name) AND am.amname = :method
+                                      AND (:method <> 'gin' OR oc.opcname = 'gin_trgm_ops') AND x.indisvalid"""),
+                              {"table_name": table_name, "method": INDEX_METHODS[method]})
+    for name, column, expression in indexes:
+        if column == field:
+            return name
+        # The first key of an expression index is 0. A trigram index serves the pattern filters of the field
+        # through an expression like (field)::text or lower(field), other indexes serve only the column itself
+        if column is None and method == 'trgm' and references_field(expression, field):
+            return name
+    return None
+
+
+def index_definition(table_name, field, method, name):
+    if method == 'gist':
+        return f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON {table_name} USING gist ("{field}")'
+    if method == 'trgm':
+        return f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON {table_name} ' \
+               f'USING gin (("{field}"::text) gin_trgm_ops)'
+    # gis_id is added for sorting by the field with keyset pagination
+    return f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON {table_name} ("{field}", gis_id)'
+
+
+def build_index(index_id):
+    """Builds the recommended index. CREATE INDEX CONCURRENTLY runs outside of a transaction
+    and does not lock writes to the table"""
+    rec = TableIndex.query.get(index_id)
+    if rec is None or rec.status in ('building', 'built', 'exists'):
+        return
+    table = get_table(rec.table_id)
+    if table is None:
+        return
+    # An index suitable for the field may have been created since the recommendation
+    existing = find_index(table.table_name, rec.field, rec.method)
+    if existing:
+        rec.status = 'exists'
+        rec.index_name = existing
+        Session.commit()
+        return
+    rec.index_name = index_name(table.table_name, rec.field, rec.method)
+    rec.status = 'building'
+    Session.commit()
+
+    try:
+        with engine.connect() as conn:
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+            if rec.method == 'trgm':
+                conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            conn.execute(index_definition(table.table_name, rec.field, rec.method, rec.index_name))
+    except sqlalchemy.exc.DBAPIError as e:
+        logger.error(f'index {rec.index_name}: {e}')
+        # A failed concurrent build leaves an invalid index
+        with engine.connect() as conn:
+            conn.execution_options(isolation_level='AUTOCOMMIT'). \
+                execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{rec.index_name}"')
+        rec.status = 'failed'
+        rec.message = str(e).split('\n')[0]
+    else:
+        logger.info(f'index {rec.index_name} built')
+        rec.status = 'built'
+        rec.built_at = func.now()
+        rec.message = None
+    Session.commit()
+
+
+def index_state(table_name, name):
+    """True for a valid index, False for an invalid one left by a failed concurrent build, None if it is absent"""
+    schema = split_table_name(table_name)[0]
+    return Session.execute(text("""SELECT x.indisvalid FROM pg_index x
+                                   WHERE x.indexrelid = to_regclass(:name)"""),
+                           {"name": f'{schema}."{name}"'}).scalar()
+
+
+def reset_interrupted_builds():
+    """Builds left in the building state by the previous run of the service will never finish.
+    A concurrent build interrupted by the restart leaves an invalid index, it is dropped
+    and the recommendation is proposed again"""
+    for rec in TableIndex.query.filter(TableIndex.status == 'building').all():
+        table = TableName.query.get(rec.table_id)
+        valid = index_state(table.table_name, rec.index_name) if rec.index_name else None
+        if valid:
+            rec.status = 'built'
+            rec.built_at = func.now()
+        else:
+            if valid is False:
+                with engine.connect() as conn:
+                    conn.execution_options(isolation_level='AUTOCOMMIT'). \
+                        execute(f'DROP INDEX CONCURRENTLY IF EXISTS '
+                                f'{split_table_name(table.table_name)[0]}."{rec.index_name}"')
+                logger.info(f'invalid index {rec.index_name} dropped')
+            rec.status = 'proposed'
+            rec.message = 'build interrupted by restart'
+        Session.commit()
+    Session.remove()
+
+
+def advise_indexes():
+    """Background job: flushes the usage and checks the fields used often enough.
+    If the table already has a suitable index, the recommendation is marked exists,
+    otherwise it stays proposed or is built when INDEX_AUTO_BUILD is on"""
+    flush_usage()
+    proposed = TableIndex.query.filter(TableIndex.status == 'proposed', TableIndex.hits >= INDEX_MIN_HITS).all()
+    for rec in proposed:
+        table = get_table(rec.table_id)
+        if table is None:
+            continue
+        existing = find_index(table.table_name, rec.field, rec.method)
+        if existing:
+            rec.status = 'exists'
+            rec.index_name = existing
+            Session.commit()
+        elif INDEX_AUTO_BUILD:
+            build_index(rec.id)
+
+
+def index_info(rec):
+    return {
+        "id": rec.id,
+        "table_id": rec.table_id,
+        "field": rec.field,
+        "method": rec.method,
+        "status": rec.status,
+        "index_name": rec.index_name,
+        "hits": rec.hits,
+        "latency_before_ms": rec.total_ms / rec.hits if rec.hits else None,
+        "hits_after": rec.hits_after,
+        "latency_after_ms": rec.total_ms_after / rec.hits_after if rec.hits_after else None,
+        "built_at": f"{rec.built_at:%Y-%m-%dT%H:%M:%S%z}" if rec.built_at else None,
+        "message": rec.message
+    }
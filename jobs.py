@@ -0,0 +1,129 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from sqlalchemy.sql import func
+
+from config import logger, IMPORT_WORKERS, IMPORT_QUEUE_SIZE
+from db import Session, ImportJob
+
+
+class QueueFull(Exception):
+    """All workers are busy and the queue of jobs is full"""
+
+
+class JobPool:
+    """Bounded pool of worker processes for long jobs like imports.
+    The web process keeps only the futures, the state of a job is kept in its table"""
+
+    def __init__(self, max_workers, queue_size):
+        self.max_workers = max_workers
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Workers are not forked from the threaded web process, where a lock (logging, caches)
+                # may be held by another thread at the moment of the fork. They import the modules anew,
+                # so the pool of database connections of a worker starts empty
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('forkserver'))
+            return self._executor
+
+    def submit(self, fn, job_id, callback=None):
+        """Runs fn(job_id) in a worker process. callback(job_id) is called in the web process after the job"""
+        return self.submit_many(fn, [job_id], callback)[0]
+
+    def submit_many(self, fn, job_ids, callback=None):
+        """Runs fn(job_id) for every job in worker processes. All jobs are queued or, when there are not
+        enough free places, none of them is. Returns the futures in the order of the jobs"""
+        with self._lock:
+            # Places are taken under the lock, so two files do not take them partly and reject each other
+            acquired = 0
+            while acquired < len(job_ids) and self._slots.acquire(blocking=False):
+                acquired += 1
+            if acquired < len(job_ids):
+                for _ in range(acquired):
+                    self._slots.release()
+                raise QueueFull()
+
+        futures = []
+        try:
+            for job_id in job_ids:
+                futures.append(self._submit(fn, job_id, callback))
+        except Exception:
+            # Places of the jobs which were not submitted are freed, submitted jobs free their own
+            for _ in range(len(job_ids) - len(futures)):
+                self._slots.release()
+            raise
+        return futures
+
+    def _submit(self, fn, job_id, callback):
+        future = self._get_executor().submit(fn, job_id)
+
+        def done(f):
+            self._slots.release()
+            if f.exception():
+                logger.error(f'job {job_id}: {f.exception()}')
+                if isinstance(f.exception(), BrokenProcessPool):
+                    # A worker died, the next job starts a new pool
+                    with self._lock:
+                        self._executor = None
+                fail_job(job_id, str(f.exception()))
+            if callback:
+                callback(job_id)
+        future.add_done_callback(done)
+        return future
+
+
+def update_job(job_id, **values):
+    """Saves the state of the job in a separate short transaction"""
+    Session.query(ImportJob).filter(ImportJob.id == job_id).update(values, synchronize_session=False)
+    Session.commit()
+
+
+def fail_job(job_id, message):
+    try:
+        update_job(job_id, status='failed', message=message, finished_at=func.now())
+    finally:
+        Session.remove()
+
+
+def fail_interrupted_jobs():
+    """Jobs left unfinished by the previous run of the service will never finish"""
+    Session.query(ImportJob).filter(ImportJob.status.in_(('queued', 'running'))). \
+        update({'status': 'failed', 'message': 'interrupted by restart', 'finished_at': func.now()},
+               synchronize_session=False)
+    Session.commit()
+    Session.remove()
+
+
+def job_info(job):
+    return {
+        "id": job.id,
+        "layer": job.layer,
+        "status": job.status,
+        "phase": job.phase,
+        "progress": round(job.progress or 0, 1),
+        "rows_read": job.rows_read,
+        "rows_written": job.rows_written,
+        "rows_per_second": job.rows_per_second,
+        "rows_failed": job.rows_failed,
+        "encoding": job.encoding,
+        "key_field": job.key_field,
+        "rows_inserted": job.rows_inserted,
+        "rows_updated": job.rows_updated,
+        "rows_deleted": job.rows_deleted,
+        "table_id": job.table_id,
+        "message": job.message,
+        "created_at": f"{job.created_at:%Y-%m-%dT%H:%M:%S%z}" if job.created_at else None,
+        "started_at": f"{job.started_at:%Y-%m-%dT%H:%M:%S%z}" if job.started_at else None,
+        "finished_at": f"{job.finished_at:%Y-%m-%dT%H:%M:%S%z}" if job.finished_at else None,
+        "seconds": (job.finished_at - job.started_at).total_seconds() if job.finished_at and job.started_at else None
+    }
+
+
+import_pool = JobPool(IMPORT_WORKERS, IMPORT_QUEUE_SIZE)
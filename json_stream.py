@@ -0,0 +1,105 @@
+import json
+
+WHITESPACE = ' \t\n\r'
+
+# A literal or an escape cut by the end of the buffer fails at its start, at most this far from the end
+CUT_MARGIN = 6
+
+
+class JsonStream:
+    """Incremental reader of a large JSON document. Elements of the top level array, or of the array
+    "features" of a top level object, are decoded one at a time from a buffered text stream,
+    so the document is never loaded in memory as a whole.
+    Members of the top level object met before "features" are kept in members"""
+
+    def __init__(self, f, buffer_size=1 << 20):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.members = {}
+        # array or object, the kind of the top level value
+        self.kind = None
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self, size=None):
+        """Reads the next part of the stream, dropping the part of the buffer already decoded"""
+        data = self.f.read(size or self.buffer_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _skip(self):
+        """Skips whitespace and returns the next character or '' at the end of the stream"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._skip()
+        if char not in chars or not char:
+            raise ValueError(f'expected {chars!r} at {self.pos}, got {char!r}')
+        self.pos += 1
+        return char
+
+    def _cut(self, e):
+        """The value failed because the end of the buffer cut it, not because of a syntax error"""
+        return not self.eof and (e.pos >= len(self.buffer) - CUT_MARGIN or e.msg.startswith('Unterminated string'))
+
+    def _more(self):
+        """Reads more data for a cut value. The value is decoded from its start again, so the read part grows
+        with the value and a large value is decoded a logarithmic number of times"""
+        return self._fill(max(self.buffer_size, len(self.buffer) - self.pos))
+
+    def _value(self):
+        """Decodes the next value. A value touching the end of the buffer may be cut (a number),
+        it is decoded again with more data. A syntax error inside the buffer is raised at once"""
+        self._skip()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                if self._cut(e) and self._more():
+                    continue
+                raise
+            if end == len(self.buffer) and not self.eof and self._more():
+                continue
+            self.pos = end
+            return value
+
+    def _array(self):
+        if self._skip() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def __iter__(self):
+        """Yields the elements of the top level array or of "features" of the top level object"""
+        if self._expect('[{') == '[':
+            self.kind = 'array'
+            yield from self._array()
+            return
+        self.kind = 'object'
+        if self._skip() == '}':
+            raise ValueError('the object does not have features')
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'features':
+                self._expect('[')
+                yield from self._array()
+                return
+            self.members[key] = self._value()
+            if self._expect(',}') == '}':
+                raise ValueError('the object does not have features')
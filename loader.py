@@ -0,0 +1,222 @@
+import io
+import time
+
+import pandas as pd
+from shapely import wkb
+from shapely.geometry import MultiPoint, MultiLineString, MultiPolygon
+
+from config import logger, DB_SCHEMA
+from db import engine
+
+# Geometries promoted to the multi type when a layer mixes them
+MULTI_TYPES = {'Point': MultiPoint, 'LineString': MultiLineString, 'Polygon': MultiPolygon}
+
+# NULL marker of COPY, so that empty strings stay empty strings
+COPY_NULL = '\\N'
+
+
+def column_type(dtype):
+    """Type of Postgres for the dtype of the column of the dataframe"""
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'boolean'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'bigint'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'double precision'
+    if pd.api.types.is_datetime64tz_dtype(dtype):
+        return 'timestamptz'
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return 'timestamp'
+    return 'text'
+
+
+# Types of Postgres for the kinds of values of object columns
+OBJECT_TYPES = {'boolean': 'boolean', 'integer': 'bigint', 'floating': 'double precision',
+                'mixed-integer-float': 'double precision'}
+
+
+def series_type(series):
+    """Type of Postgres for the values of a column of a chunk, None if the chunk has no values in it.
+    Floats without a fractional part fit an integer column"""
+    values = series.dropna()
+    if values.empty:
+        return None
+    type_ = column_type(series.dtype)
+    if series.dtype == object:
+        # Missing values keep booleans and integers of JSON in an object column
+        type_ = OBJECT_TYPES.get(pd.api.types.infer_dtype(values, skipna=True), 'text')
+    if type_ == 'double precision':
+        numbers = values.astype(float)
+        if ((numbers == numbers.round()) & (numbers.abs() < 2 ** 63)).all():
+            return 'bigint'
+    return type_
+
+
+def widen_type(current, new):
+    """Type of a column holding the values of both types: integers widen to floats, anything else to text"""
+    if new is None or new == current:
+        return current
+    if {current, new} == {'bigint', 'double precision'}:
+        return 'double precision'
+    return 'text'
+
+
+def frame_columns(gdf):
+    """Pairs (name, type) of the attribute columns of the dataframe"""
+    return [(name, series_type(gdf[name]) or column_type(dtype)) for name, dtype in gdf.dtypes.items()
+            if name != 'geom']
+
+
+def geometry_type(geometries):
+    """Type of the geometry column for the geometries: the common type, its multi type if the layer mixes
+    single and multi geometries, or GEOMETRY. Z is added for 3D geometries"""
+    geometries = geometries[geometries.notna()]
+    types = set(geometries.geom_type)
+    if not types:
+        return None
+    if len(types) == 1:
+        common = types.pop()
+    elif len(types) == 2 and any(f'Multi{name}' in types for name in types):
+        common = next(name for name in types if name.startswith('Multi'))
+    else:
+        common = 'Geometry'
+    return f'{common}Z'.upper() if geometries.has_z.any() else common.upper()
+
+
+def to_ewkb(geom, column_geom_type, srid):
+    """Hex EWKB of the geometry, promoted to the multi type of the column if it is single"""
+    if geom is None or geom.is_empty:
+        return None
+    if column_geom_type.startswith('MULTI') and geom.geom_type in MULTI_TYPES:
+        geom = MULTI_TYPES[geom.geom_type]([geom])
+    return wkb.dumps(geom, hex=True, srid=srid)
+
+
+class CopyLoader:
+    """Writes dataframes to a new table through COPY FROM STDIN in one transaction.
+    The table is created with the gis_id key, the GIST index is built after the data is loaded"""
+
+    def __init__(self, table_name, schema=DB_SCHEMA, srid=4326):
+        self.table_name = f'{schema}."{table_name}"'
+        self.index_name = f'idx_{table_name}_geom'
+        self.srid = srid
+        self.columns = None
+        self.types = None
+        self.geom_type = None
+        self.rows = 0
+        self.copy_seconds = 0.0
+        self._started = None
+        self._conn = None
+
+    def __enter__(self):
+        self._conn = engine.raw_connection()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is not None:
+                self._conn.rollback()
+        finally:
+            self._conn.close()
+        return False
+
+    def create(self, columns, geom_type):
+        """Creates the table. columns - pairs (name, type), geom_type - type of the geometry or None"""
+        self.columns = [name for name, _ in columns]
+        self.types = dict(columns)
+        self.geom_type = geom_type
+        definitions = ['gis_id serial PRIMARY KEY'] + [f'"{name}" {type_}' for name, type_ in columns]
+        if geom_type:
+            definitions.append(f'geom geometry({geom_type}, {self.srid})')
+        with self._conn.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE {self.table_name} ({", ".join(definitions)})')
+
+    def add_columns(self, columns):
+        """Adds the columns which appeared in a chunk after the table was created"""
+        with self._conn.cursor() as cursor:
+            for name, type_ in columns:
+                cursor.execute(f'ALTER TABLE {self.table_name} ADD COLUMN "{name}" {type_}')
+                self.columns.append(name)
+                self.types[name] = type_
+
+    def widen_columns(self, gdf):
+        """Types are inferred from the first chunk, a column whose values in a later chunk do not fit
+        its type is widened"""
+        with self._conn.cursor() as cursor:
+            for name in self.columns:
+                if name not in gdf.columns:
+                    continue
+                type_ = widen_type(self.types[name], series_type(gdf[name]))
+                if type_ != self.types[name]:
+                    cursor.execute(f'ALTER TABLE {self.table_name} ALTER COLUMN "{name}" '
+                                   f'TYPE {type_} USING "{name}"::{type_}')
+                    self.types[name] = type_
+
+    def alter_geometry(self, geometries):
+        """Chunks are loaded without looking ahead, so the geometry column is added when the first
+        geometries appear, and a single type is promoted to the multi type when multi geometries appear"""
+        chunk_type = geometry_type(geometries)
+        if chunk_type is None or chunk_type == self.geom_type:
+            return
+        with self._conn.cursor() as cursor:
+            if self.geom_type is None:
+                cursor.execute(f'ALTER TABLE {self.table_name} ADD COLUMN geom geometry({chunk_type}, {self.srid})')
+                self.geom_type = chunk_type
+            elif chunk_type == f'MULTI{self.geom_type}':
+                cursor.execute(f'ALTER TABLE {self.table_name} ALTER COLUMN geom '
+                               f'TYPE geometry({chunk_type}, {self.srid}) USING ST_Multi(geom)')
+                self.geom_type = chunk_type
+
+    def coerce(self, frame):
+        """Integer columns of a chunk with empty values are read as float or object, they are written as integers"""
+        for name, type_ in self.types.items():
+            if type_ == 'bigint' and not pd.api.types.is_integer_dtype(frame[name].dtype):
+                frame[name] = pd.to_numeric(frame[name]).astype('Int64')
+        return frame
+
+    def write(self, gdf):
+        """Copies the records of the dataframe, creating the table by the first one"""
+        if self.columns is None:
+            self.create(frame_columns(gdf), geometry_type(gdf.geometry) if 'geom' in gdf.columns else None)
+        else:
+            self.add_columns([column for column in frame_columns(gdf) if column[0] not in self.types])
+            self.widen_columns(gdf)
+            if 'geom' in gdf.columns:
+                self.alter_geometry(gdf.geometry)
+        started = time.perf_counter()
+
+        # Records of some sources (JSON) do not have all the columns
+        frame = self.coerce(pd.DataFrame(gdf.reindex(columns=self.columns)))
+        copy_columns = [f'"{name}"' for name in self.columns]
+        if self.geom_type:
+            frame['geom'] = [to_ewkb(geom, self.geom_type, self.srid) for geom in gdf['geom']]
+            copy_columns.append('geom')
+
+        if copy_columns and len(frame):
+            buffer = io.StringIO()
+            frame.to_csv(buffer, header=False, index=False, na_rep=COPY_NULL)
+            buffer.seek(0)
+            with self._conn.cursor() as cursor:
+                cursor.copy_expert(f"COPY {self.table_name} ({', '.join(copy_columns)}) "
+                                   f"FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", buffer)
+
+        self.rows += len(frame)
+        self.copy_seconds += time.perf_counter() - started
+        return len(frame)
+
+    def finish(self):
+        """Builds the spatial index, commits the transaction and returns the statistics of the load"""
+        with self._conn.cursor() as cursor:
+            if self.geom_type:
+                cursor.execute(f'CREATE INDEX "{self.index_name}" ON {self.table_name} USING gist (geom)')
+            cursor.execute(f'ANALYZE {self.table_name}')
+        self._conn.commit()
+
+        seconds = time.perf_counter() - self._started
+        stats = {"rows": self.rows,
+                 "seconds": round(seconds, 3),
+                 "rows_per_second": round(self.rows / self.copy_seconds) if self.copy_seconds else None}
+        logger.info(f'{self.table_name}: {self.rows} rows loaded in {seconds:.1f} s, '
+                    f'{stats["rows_per_second"]} rows/s')
+        return stats
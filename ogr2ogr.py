@@ -35,6 +35,8 @@
 # Note : this is the most direct port of ogr2ogr.cpp possible
 # It could be made much more Python'ish !
 
+import contextlib
+import copy
 import sys
 import os
 import stat
@@ -118,10 +120,58 @@ class AssociatedLayers:
 #                                main()
 #**********************************************************************
 
-bSkipFailures = False
-nGroupTransactions = 200
-bPreserveFID = False
-nFIDToFetch = ogr.NullFID
+class Translator:
+    """Translation of ogr2ogr with the options of its own. The options given to the constructor
+    are defaults, every run works on a copy of them changed by its arguments, so one translator
+    can run in parallel threads or worker processes"""
+
+    def __init__(self, bSkipFailures = False, nGroupTransactions = 200, bPreserveFID = False,
+                 nFIDToFetch = ogr.NullFID):
+        self.bSkipFailures = bSkipFailures
+        self.nGroupTransactions = nGroupTransactions
+        self.bPreserveFID = bPreserveFID
+        self.nFIDToFetch = nFIDToFetch
+
+    def run(self, args = None, progress_func = TermProgress, progress_data = None):
+        args, config = split_config_options(sys.argv if args is None else args)
+        with thread_config_options(config):
+            return translate(copy.copy(self), args, progress_func, progress_data)
+
+# Options of GDAL set by translate() itself, restored after every run
+TRANSLATE_CONFIG_OPTIONS = ("OGR_INTERLEAVED_READING",)
+
+# Thread-local options keep the options of translations running in parallel threads apart.
+# Bindings without them fall back to the options of the process
+_set_config_option = getattr(gdal, "SetThreadLocalConfigOption", gdal.SetConfigOption)
+_get_config_option = getattr(gdal, "GetThreadLocalConfigOption", gdal.GetConfigOption)
+
+def split_config_options(args):
+    """Takes the pairs --config KEY VALUE out of the arguments, GeneralCmdLineProcessor would set them
+    for the whole process. Returns the rest of the arguments and the options"""
+    rest = []
+    config = {}
+    i = 0
+    while i < len(args):
+        if EQUAL(args[i], "--config") and i + 2 < len(args):
+            config[args[i + 1]] = args[i + 2]
+            i += 3
+        else:
+            rest.append(args[i])
+            i += 1
+    return rest, config
+
+@contextlib.contextmanager
+def thread_config_options(config):
+    """Sets the options of GDAL for the current thread during a translation and restores them after it"""
+    keys = list(config) + [key for key in TRANSLATE_CONFIG_OPTIONS if key not in config]
+    previous = {key: _get_config_option(key, None) for key in keys}
+    try:
+        for key, value in config.items():
+            _set_config_option(key, value)
+        yield
+    finally:
+        for key, value in previous.items():
+            _set_config_option(key, value)
 
 class Enum(set):
     def __getattr__(self, name):
@@ -132,11 +182,9 @@ class Enum(set):
 GeomOperation = Enum(["NONE", "SEGMENTIZE", "SIMPLIFY_PRESERVE_TOPOLOGY"])
 
 def main(args = None, progress_func = TermProgress, progress_data = None):
+    return Translator().run(args, progress_func, progress_data)
 
-    global bSkipFailures
-    global nGroupTransactions
-    global bPreserveFID
-    global nFIDToFetch
+def translate(options, args = None, progress_func = TermProgress, progress_data = None):
 
     pszFormat = "ESRI Shapefile"
     pszDataSource = None
@@ -214,11 +262,11 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
             papszLCO.append(args[iArg] )
 
         elif EQUAL(args[iArg],"-preserve_fid"):
-            bPreserveFID = True
+            options.bPreserveFID = True
 
         elif len(args[iArg]) >= 5 and EQUAL(args[iArg][0:5], "-skip"):
-            bSkipFailures = True
-            nGroupTransactions = 1 # #2409
+            options.bSkipFailures = True
+            options.nGroupTransactions = 1 # #2409
 
         elif EQUAL(args[iArg],"-append"):
             bAppend = True
@@ -233,7 +281,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
 
         elif EQUAL(args[iArg],"-fid") and iArg < nArgc-1:
             iArg = iArg + 1
-            nFIDToFetch = int(args[iArg])
+            options.nFIDToFetch = int(args[iArg])
 
         elif EQUAL(args[iArg],"-sql") and iArg < nArgc-1:
             iArg = iArg + 1
@@ -298,7 +346,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
         elif (EQUAL(args[iArg],"-tg") or \
                 EQUAL(args[iArg],"-gt")) and iArg < nArgc-1:
             iArg = iArg + 1
-            nGroupTransactions = int(args[iArg])
+            options.nGroupTransactions = int(args[iArg])
 
         elif EQUAL(args[iArg],"-s_srs") and iArg < nArgc-1:
             iArg = iArg + 1
@@ -501,7 +549,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
     if pszDataSource is None:
         return Usage()
 
-    if bPreserveFID and bExplodeCollections:
+    if options.bPreserveFID and bExplodeCollections:
         print("FAILURE: cannot use -preserve_fid and -explodecollections at the same time\n\n")
         return Usage()
 
@@ -698,7 +746,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
                     pass
 
 
-            psInfo = SetupTargetLayer(  poDS, \
+            psInfo = SetupTargetLayer( options, poDS, \
                                         poResultSet,
                                         poODS, \
                                         papszLCO, \
@@ -717,7 +765,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
 
             poResultSet.ResetReading()
 
-            if psInfo is None or not TranslateLayer( psInfo, poDS, poResultSet, poODS, \
+            if psInfo is None or not TranslateLayer( options, psInfo, poDS, poResultSet, poODS, \
                                 poOutputSRS, bNullifyOutputSRS, \
                                 eGType, bPromoteToMulti, nCoordDim, \
                                 eGeomOp, dfGeomOpParam, \
@@ -738,9 +786,9 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
 # --------------------------------------------------------------------
 #      Special case for layer interleaving mode.
 # --------------------------------------------------------------------
-    elif bSrcIsOSM and gdal.GetConfigOption("OGR_INTERLEAVED_READING", None) is None:
+    elif bSrcIsOSM and _get_config_option("OGR_INTERLEAVED_READING", None) is None:
 
-        gdal.SetConfigOption("OGR_INTERLEAVED_READING", "YES")
+        _set_config_option("OGR_INTERLEAVED_READING", "YES")
 
         #if (bSplitListFields)
         #{
@@ -807,13 +855,13 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
                 if pszWHERE is not None:
                     if poLayer.SetAttributeFilter( pszWHERE ) != 0:
                         print("FAILURE: SetAttributeFilter(%s) on layer '%s' failed.\n" % (pszWHERE, poLayer.GetName()) )
-                        if not bSkipFailures:
+                        if not options.bSkipFailures:
                             return False
 
                 if poSpatialFilter is not None:
                     poLayer.SetSpatialFilter( poSpatialFilter )
 
-                psInfo = SetupTargetLayer( poDS, \
+                psInfo = SetupTargetLayer( options, poDS, \
                                            poLayer, \
                                            poODS, \
                                            papszLCO, \
@@ -830,7 +878,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
                                            pszZField, \
                                            pszWHERE )
 
-                if psInfo is None and not bSkipFailures:
+                if psInfo is None and not options.bSkipFailures:
                     return False
 
                 pasAssocLayers[iLayer].psInfo = psInfo
@@ -850,7 +898,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
                 anReadFeatureCount = [0]
 
                 if psInfo is not None:
-                    if not TranslateLayer(psInfo, poDS, poLayer, poODS, \
+                    if not TranslateLayer( options, psInfo, poDS, poLayer, poODS, \
                                         poOutputSRS, bNullifyOutputSRS,  \
                                         eGType, bPromoteToMulti, nCoordDim, \
                                         eGeomOp, dfGeomOpParam,  \
@@ -860,7 +908,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
                                         nSrcFileSize,  \
                                         anReadFeatureCount, \
                                         pfnProgress, pProgressArg ) \
-                        and not bSkipFailures:
+                        and not options.bSkipFailures:
                         print(
                                 "Terminating translation prematurely after failed\n" + \
                                 "translation of layer " + poLayer.GetName() + " (use -skipfailures to skip errors)")
@@ -929,7 +977,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
             if pszWHERE is not None:
                 if poLayer.SetAttributeFilter( pszWHERE ) != 0:
                     print("FAILURE: SetAttributeFilter(%s) failed." % pszWHERE)
-                    if not bSkipFailures:
+                    if not options.bSkipFailures:
                         return False
 
             if poSpatialFilter is not None:
@@ -975,7 +1023,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
                     pass
 
 
-            psInfo = SetupTargetLayer( poDS, \
+            psInfo = SetupTargetLayer( options, poDS, \
                                        poLayer, \
                                        poODS, \
                                        papszLCO, \
@@ -995,7 +1043,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
             poLayer.ResetReading()
 
             if (psInfo is None or \
-                not TranslateLayer( psInfo, poDS, poLayer, poODS, \
+                not TranslateLayer( options, psInfo, poDS, poLayer, poODS, \
                                     poOutputSRS, bNullifyOutputSRS, \
                                     eGType, bPromoteToMulti, nCoordDim, \
                                     eGeomOp, dfGeomOpParam, \
@@ -1004,7 +1052,7 @@ def main(args = None, progress_func = TermProgress, progress_data = None):
                                     bExplodeCollections, \
                                     nSrcFileSize, None, \
                                     pfnProgress, pProgressArg )) \
-                and not bSkipFailures:
+                and not options.bSkipFailures:
                 print(
                         "Terminating translation prematurely after failed\n" + \
                         "translation of layer " + poLayer.GetLayerDefn().GetName() + " (use -skipfailures to skip errors)")
@@ -1185,7 +1233,7 @@ def SetZ (poGeom, dfZ ):
 #                         SetupTargetLayer()
 #**********************************************************************
 
-def SetupTargetLayer( poSrcDS, poSrcLayer, poDstDS, papszLCO, pszNewLayerName, \
+def SetupTargetLayer( options, poSrcDS, poSrcLayer, poDstDS, papszLCO, pszNewLayerName, \
                     bTransform,  poOutputSRS, bNullifyOutputSRS, poSourceSRS, papszSelFields, \
                     bAppend, eGType, bPromoteToMulti, nCoordDim, bOverwrite, \
                     papszFieldTypesToString, bWrapDateline, \
@@ -1390,7 +1438,7 @@ def SetupTargetLayer( poSrcDS, poSrcLayer, poDstDS, papszLCO, pszNewLayerName, \
 
             else:
                 print("Field '" + papszSelFields[iField] + "' not found in source layer.")
-                if not bSkipFailures:
+                if not options.bSkipFailures:
                     return None
 
         # --------------------------------------------------------------------
@@ -1489,7 +1537,7 @@ def SetupTargetLayer( poSrcDS, poSrcLayer, poDstDS, papszLCO, pszNewLayerName, \
 #                           TranslateLayer()
 #**********************************************************************
 
-def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
+def TranslateLayer( options, psInfo, poSrcDS, poSrcLayer, poDstDS,  \
                     poOutputSRS, bNullifyOutputSRS, \
                     eGType, bPromoteToMulti, nCoordDim, eGeomOp, dfGeomOpParam, \
                     nCountLayerFeatures, \
@@ -1522,17 +1570,17 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
     nFeaturesInTransaction = 0
     nCount = 0
 
-    if nGroupTransactions > 0:
+    if options.nGroupTransactions > 0:
         poDstLayer.StartTransaction()
 
     while True:
         poDstFeature = None
 
-        if nFIDToFetch != ogr.NullFID:
+        if options.nFIDToFetch != ogr.NullFID:
 
             #// Only fetch feature on first pass.
             if nFeaturesInTransaction == 0:
-                poFeature = poSrcLayer.GetFeature(nFIDToFetch)
+                poFeature = poSrcLayer.GetFeature(options.nFIDToFetch)
             else:
                 poFeature = None
 
@@ -1559,7 +1607,7 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
 
         for iPart in range(nIters):
             nFeaturesInTransaction = nFeaturesInTransaction + 1
-            if nFeaturesInTransaction == nGroupTransactions:
+            if nFeaturesInTransaction == options.nGroupTransactions:
                 poDstLayer.CommitTransaction()
                 poDstLayer.StartTransaction()
                 nFeaturesInTransaction = 0
@@ -1569,14 +1617,14 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
 
             if poDstFeature.SetFromWithMap( poFeature, 1, panMap ) != 0:
 
-                if nGroupTransactions > 0:
+                if options.nGroupTransactions > 0:
                     poDstLayer.CommitTransaction()
 
                 print("Unable to translate feature %d from layer %s" % (poFeature.GetFID() , poSrcLayer.GetName() ))
 
                 return False
 
-            if bPreserveFID:
+            if options.bPreserveFID:
                 poDstFeature.SetFID( poFeature.GetFID() )
 
             poDstGeometry = poDstFeature.GetGeometryRef()
@@ -1624,11 +1672,11 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
                 if poCT is not None:
                     eErr = poDstGeometry.Transform( poCT )
                     if eErr != 0:
-                        if nGroupTransactions > 0:
+                        if options.nGroupTransactions > 0:
                             poDstLayer.CommitTransaction()
 
                         print("Failed to reproject feature %d (geometry probably out of source or destination SRS)." % poFeature.GetFID())
-                        if not bSkipFailures:
+                        if not options.bSkipFailures:
                             return False
 
                 elif poOutputSRS is not None:
@@ -1654,8 +1702,8 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
                     poDstFeature.SetGeometryDirectly(ogr.ForceToMultiLineString(poDstGeometry))
 
             gdal.ErrorReset()
-            if poDstLayer.CreateFeature( poDstFeature ) != 0 and not bSkipFailures:
-                if nGroupTransactions > 0:
+            if poDstLayer.CreateFeature( poDstFeature ) != 0 and not options.bSkipFailures:
+                if options.nGroupTransactions > 0:
                     poDstLayer.RollbackTransaction()
 
                 return False
@@ -1679,7 +1727,7 @@ def TranslateLayer( psInfo, poSrcDS, poSrcLayer, poDstDS,  \
         if pnReadFeatureCount is not None:
             pnReadFeatureCount[0] = nCount
 
-    if nGroupTransactions > 0:
+    if options.nGroupTransactions > 0:
         poDstLayer.CommitTransaction()
 
     return True
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import or_, select
+
+from config import logger, RECLAIM_BATCH_SIZE, RECLAIM_WORKERS
+from db import Session, TableName, TableFile, CommentTable
+from export import invalidate_exports
+from utils import tile_cache
+
+# Set by the endpoints which delete tables or records, so the worker starts without waiting for its interval
+reclaim_requested = threading.Event()
+
+# Statistics of the last run of the worker
+_last_run = {}
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # The row of the document is removed anyway, otherwise the worker would retry it forever
+        logger.error(f'reclamation of {path}: {e}')
+
+
+def purge_documents(condition, executor):
+    """Removes the documents matching the condition in batches: the files in parallel, then their rows.
+    Returns the number of removed documents"""
+    purged = 0
+    while True:
+        docs = Session.query(TableFile.id, TableFile.path).filter(condition).limit(RECLAIM_BATCH_SIZE).all()
+        if not docs:
+            return purged
+        list(executor.map(remove_file, [doc.path for doc in docs if doc.path]))
+        Session.query(TableFile).filter(TableFile.id.in_([doc.id for doc in docs])). \
+            delete(synchronize_session=False)
+        Session.commit()
+        purged += len(docs)
+
+
+def purge_comments(condition):
+    """Removes the comments matching the condition in batches. Returns the number of removed comments"""
+    purged = 0
+    while True:
+        ids = [rec.id for rec in Session.query(CommentTable.id).filter(condition).limit(RECLAIM_BATCH_SIZE)]
+        if not ids:
+            return purged
+        Session.query(CommentTable).filter(CommentTable.id.in_(ids)).delete(synchronize_session=False)
+        Session.commit()
+        purged += len(ids)
+
+
+def reclaim_table(table, executor):
+    """Removes the deleted table: its documents and comments in batches, then the table itself
+    and its record in the registry. Returns the numbers of removed documents and comments"""
+    documents = purge_documents(TableFile.table_id == table.id, executor)
+    comments = purge_comments(CommentTable.table_id == table.id)
+
+    # The table is not read since it was deleted, so the lock of DROP is short
+    Session.execute(f'DROP TABLE IF EXISTS {table.table_name}')
+    Session.delete(table)
+    Session.commit()
+    tile_cache.invalidate(table.id)
+    invalidate_exports(table.id)
+    return documents, comments
+
+
+def reclaim():
+    """Background job: removes the deleted tables and the comments and documents of deleted records"""
+    started = time.perf_counter()
+    counts = {"tables": 0, "documents": 0, "comments": 0, "failed_tables": 0}
+
+    with ThreadPoolExecutor(RECLAIM_WORKERS) as executor:
+        tables = TableName.query.filter(TableName.deleted_at.isnot(None)).order_by(TableName.deleted_at).all()
+        for table in tables:
+            try:
+                documents, comments = reclaim_table(table, executor)
+            except Exception as e:
+                # The table is tried again by the next run
+                Session.rollback()
+                logger.error(f'reclamation of {table.table_name}: {e}')
+                counts['failed_tables'] += 1
+                continue
+            counts['tables'] += 1
+            counts['documents'] += documents
+            counts['comments'] += comments
+
+        counts['documents'] += purge_documents(TableFile.deleted_at.isnot(None), executor)
+        counts['comments'] += purge_comments(CommentTable.deleted_at.isnot(None))
+
+    seconds = time.perf_counter() - started
+    if counts['tables'] or counts['documents'] or counts['comments']:
+        logger.info(f'reclamation: {counts} in {seconds:.1f} s')
+    _last_run.update(counts, seconds=round(seconds, 3), finished_at=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+
+
+def reclamation_status():
+    """Deleted tables and the numbers of documents and comments waiting for the reclamation"""
+    tables = TableName.query.filter(TableName.deleted_at.isnot(None)).order_by(TableName.deleted_at).all()
+    deleted_tables = select(TableName.id).where(TableName.deleted_at.isnot(None))
+    documents = TableFile.query.filter(or_(TableFile.deleted_at.isnot(None),
+                                           TableFile.table_id.in_(deleted_tables))).count()
+    comments = CommentTable.query.filter(or_(CommentTable.deleted_at.isnot(None),
+                                             CommentTable.table_id.in_(deleted_tables))).count()
+    return {
+        "tables": [{"id": table.id,
+                    "table_name": table.table_name,
+                    "deleted_at": f"{table.deleted_at:%Y-%m-%dT%H:%M:%S%z}"} for table in tables],
+        "documents": documents,
+        "comments": comments,
+        "last_run": _last_run or None
+    }
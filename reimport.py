@@ -0,0 +1,138 @@
+from sqlalchemy.sql import text
+
+from config import logger, DB_SCHEMA
+from db import Session, TableName
+from utils import bump_table_version, delete_attachments, expand_extent_box
+
+# Columns of GIS tables which are not attributes of the source
+SERVICE_COLUMNS = ('gis_id', 'geom')
+
+
+class MergeError(Exception):
+    """The staging table can not be merged into the target table"""
+
+
+def quoted(names):
+    return [f'"{name}"' for name in names]
+
+
+def table_columns(table_name):
+    """Pairs (name, type) of the columns of the table in their order, types as they are written in DDL"""
+    return Session.execute(text("""SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+                                   WHERE attrelid = CAST(:name AS regclass) AND attnum > 0 AND NOT attisdropped
+                                   ORDER BY attnum"""), {"name": table_name}).all()
+
+
+def check_unique(table_name, key, where):
+    """Rows are matched by the key, so it must be present and unique in the file and in the table"""
+    if Session.execute(f'SELECT 1 FROM {table_name} WHERE "{key}" IS NULL LIMIT 1').first():
+        raise MergeError(f'{key} is empty in some rows of the {where}')
+    duplicate = Session.execute(f'SELECT "{key}" FROM {table_name} GROUP BY "{key}" '
+                                f'HAVING count(*) > 1 LIMIT 1').first()
+    if duplicate:
+        raise MergeError(f'{key} is not unique in the {where}: {duplicate[0]}')
+
+
+def geometry_value(table, geom_type):
+    """Expression of the geometry of the staging table in the type of the geometry column of the target.
+    The staging table is loaded in 4326"""
+    value = 's.geom'
+    if table.srid and table.srid != 4326:
+        value = f'ST_Transform({value}, {table.srid})'
+    if 'multi' in geom_type.lower():
+        value = f'ST_Multi({value})'
+    return f'{value}::{geom_type}'
+
+
+def write_rows(statement, with_geom):
+    """Runs the UPDATE or INSERT statement of the table aliased t.
+    Returns the number of written rows and the box of their geometries"""
+    geom = 't.geom' if with_geom else 'NULL::geometry'
+    row = Session.execute(f"""WITH w AS ({statement} RETURNING {geom} AS geom)
+                               SELECT n, ST_XMin(ext), ST_YMin(ext), ST_XMax(ext), ST_YMax(ext)
+                               FROM (SELECT count(*) AS n, ST_Extent(geom) AS ext FROM w) f""").first()
+    return row[0], tuple(row[1:])
+
+
+def merge(table, staging, key):
+    """Applies the difference between the staging table and the target table: rows with keys absent from
+    the file are deleted, rows whose attributes or geometry changed are updated and new keys are inserted.
+    Rows are compared by the hash of their values, unchanged rows are not written.
+    The stored extent grows by the written geometries, deleted rows mark it stale for the background refresh"""
+    if key in SERVICE_COLUMNS:
+        raise MergeError(f'{key} can not be the key')
+    target_columns = dict(table_columns(table.table_name))
+    staging_columns = dict(table_columns(staging))
+    if key not in target_columns:
+        raise MergeError(f'{key} not found in the table')
+    if key not in staging_columns:
+        raise MergeError(f'{key} not found in the file')
+
+    # Columns absent from the file keep their values, columns absent from the table are ignored
+    columns = [name for name in target_columns if name in staging_columns and name not in SERVICE_COLUMNS]
+    ignored = [name for name in staging_columns if name not in target_columns and name not in SERVICE_COLUMNS]
+    if ignored:
+        logger.info(f'{table.table_name}: columns {ignored} of the file are not in the table')
+
+    values = {name: f's."{name}"::{target_columns[name]}' for name in columns}
+    if 'geom' in target_columns and 'geom' in staging_columns:
+        columns.append('geom')
+        values['geom'] = geometry_value(table, target_columns['geom'])
+
+    def row_hash(alias):
+        return 'md5(ROW({})::text)'.format(', '.join(
+            f'ST_AsEWKB({alias}.geom)' if name == 'geom' else f'{alias}."{name}"' for name in columns))
+
+    check_unique(staging, key, 'file')
+    check_unique(table.table_name, key, 'table')
+    Session.execute(f'ANALYZE {staging}')
+
+    names = ', '.join(quoted(columns))
+    # The values of the file in the types of the table, the key is compared in the type of the table too
+    source = '(SELECT {} AS _key, {} FROM {} s)'.format(
+        values[key], ', '.join(f'{values[name]} AS "{name}"' for name in columns), staging)
+
+    deleted = [row[0] for row in Session.execute(
+        f'DELETE FROM {table.table_name} t WHERE NOT EXISTS (SELECT 1 FROM {source} v WHERE v._key = t."{key}") '
+        f'RETURNING t.gis_id')]
+    # Without the geometry column in the file the written rows do not change the extent
+    with_geom = 'geom' in columns
+    updated, updated_box = write_rows(
+        f'UPDATE {table.table_name} t SET ({names}) = ROW({", ".join(f"v.{name}" for name in quoted(columns))}) '
+        f'FROM {source} v WHERE t."{key}" = v._key AND {row_hash("t")} <> {row_hash("v")}', with_geom)
+    inserted, inserted_box = write_rows(
+        f'INSERT INTO {table.table_name} AS t ({names}) SELECT {names} FROM {source} v '
+        f'WHERE NOT EXISTS (SELECT 1 FROM {table.table_name} e WHERE e."{key}" = v._key)', with_geom)
+
+    expand_extent_box(table, updated_box)
+    expand_extent_box(table, inserted_box)
+    if deleted and table.geom_type:
+        # Whether the deleted rows held the border is not known, the extent is recalculated in the background
+        Session.query(TableName).filter(TableName.id == table.id). \
+            update({TableName.extent_updated_at: None}, synchronize_session=False)
+
+    # Comments and documents of the deleted rows are not needed, the rows are gone
+    delete_attachments(table.id, deleted)
+    if deleted or updated or inserted:
+        bump_table_version(table.id)
+    return {"inserted": inserted, "updated": updated, "deleted": len(deleted)}
+
+
+def merge_staging(table, staging_name, key):
+    """Merges the imported staging table into the existing table by the key column in one transaction
+    and drops the staging table. Returns the counts of inserted, updated and deleted rows"""
+    staging = f'{DB_SCHEMA}."{staging_name}"'
+    try:
+        if table is None or table.is_folder:
+            raise MergeError('table not found')
+        counts = merge(table, staging, key)
+        Session.commit()
+    except Exception:
+        Session.rollback()
+        raise
+    finally:
+        Session.execute(f'DROP TABLE IF EXISTS {staging}')
+        Session.commit()
+
+    logger.info(f'{table.table_name} merged by {key}: {counts}')
+    return counts
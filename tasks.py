@@ -0,0 +1,36 @@
+import threading
+import time
+
+from config import logger, GEOM_REFRESH_INTERVAL, INDEX_ADVISOR_INTERVAL, RECLAIM_INTERVAL
+from db import Session
+from index_advisor import advise_indexes
+from reclamation import reclaim, reclaim_requested
+from utils import refresh_geom_catalog
+
+
+def start_periodic(name, interval, func, wake=None):
+    """Runs the function in a daemon thread of the web process every interval seconds.
+    Setting the event wake runs it without waiting for the interval"""
+    def run():
+        while True:
+            try:
+                func()
+            except Exception as e:
+                logger.error(f'{name}: {e}')
+            finally:
+                Session.remove()
+            if wake is None:
+                time.sleep(interval)
+            else:
+                wake.wait(interval)
+                wake.clear()
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def start_background_tasks():
+    start_periodic('geom_catalog', GEOM_REFRESH_INTERVAL, refresh_geom_catalog)
+    start_periodic('index_advisor', INDEX_ADVISOR_INTERVAL, advise_indexes)
+    start_periodic('reclamation', RECLAIM_INTERVAL, reclaim, reclaim_requested)
@@ -0,0 +1,91 @@
+import pytest
+from sqlalchemy import Table, Column, Integer, Float, String, Boolean, DateTime, MetaData
+
+from batch import BatchError, validate_operations, group_operations
+
+table = Table('geotable', MetaData(),
+              Column('gis_id', Integer, primary_key=True),
+              Column('name', String),
+              Column('created', DateTime),
+              Column('floors', Integer),
+              Column('area', Float),
+              Column('public', Boolean),
+              Column('geom', String))
+
+POINT = {"type": "Point", "coordinates": [60.6, 56.8]}
+
+
+def test_validate_operations():
+    operations = validate_operations([
+        {"op": "insert", "data": {"name": "a", "geom": POINT}},
+        {"op": "update", "id": 3, "data": {"created": 0}},
+        {"op": "delete", "id": 4},
+    ], table.columns, 'Point')
+    assert [operation.op for operation in operations] == ['insert', 'update', 'delete']
+    assert operations[0].fields == ('_geom', 'name')
+    assert operations[1].record == {"created": '1970-01-01T00:00:00+00:00'}
+    assert operations[2].gis_id == 4
+
+
+def test_validate_operations_errors():
+    with pytest.raises(BatchError) as e:
+        validate_operations([
+            {"op": "upsert"},
+            {"op": "update", "data": {"name": "a"}},
+            {"op": "insert", "data": {"unknown": 1}},
+            {"op": "insert", "data": {"gis_id": 1}},
+            {"op": "insert", "data": {"geom": {"type": "LineString", "coordinates": []}}},
+            {"op": "update", "id": 1, "data": {}},
+            {"op": "delete", "id": 1},
+        ], table.columns, 'Point')
+    assert [error['index'] for error in e.value.errors] == [0, 1, 2, 3, 4, 5]
+
+
+def test_validate_operations_types():
+    operations = validate_operations([
+        {"op": "insert", "data": {"floors": "5", "area": "12.5", "public": True, "created": "2022-05-01T10:00:00Z"}},
+        {"op": "update", "id": 1, "data": {"floors": 3.0, "area": 7, "name": 15, "created": None}},
+    ], table.columns, None)
+    assert operations[0].record == {"floors": 5, "area": 12.5, "public": True, "created": "2022-05-01T10:00:00Z"}
+    assert operations[1].record == {"floors": 3, "area": 7, "name": 15, "created": None}
+
+
+def test_validate_operations_type_errors():
+    with pytest.raises(BatchError) as e:
+        validate_operations([
+            {"op": "insert", "data": {"name": "a"}},
+            {"op": "insert", "data": {"floors": "abc"}},
+            {"op": "update", "id": 1, "data": {"floors": 2.5}},
+            {"op": "insert", "data": {"area": "many"}},
+            {"op": "insert", "data": {"public": "yes"}},
+            {"op": "insert", "data": {"created": "2022-13-01"}},
+            {"op": "insert", "data": {"created": "yesterday"}},
+            {"op": "insert", "data": {"name": {"text": "a"}}},
+        ], table.columns, None)
+    assert [error['index'] for error in e.value.errors] == [1, 2, 3, 4, 5, 6, 7]
+    assert e.value.errors[0]['message'] == 'floors must be an integer'
+
+
+def test_validate_operations_multi_geometry():
+    operations = validate_operations([{"op": "insert", "data": {"geom": POINT}}], table.columns, 'MultiPoint')
+    assert operations[0].fields == ('_geom',)
+
+
+def test_group_operations():
+    operations = validate_operations([
+        {"op": "insert", "data": {"name": "a"}},
+        {"op": "insert", "data": {"name": "b"}},
+        {"op": "insert", "data": {"name": "c", "geom": POINT}},
+        {"op": "update", "id": 1, "data": {"name": "d"}},
+        {"op": "update", "id": 2, "data": {"name": "e"}},
+        {"op": "update", "id": 1, "data": {"name": "f"}},
+        {"op": "delete", "id": 1},
+        {"op": "delete", "id": 2},
+    ], table.columns, None)
+    groups = group_operations(operations)
+    assert [[operation.index for operation in group] for group in groups] == [[0, 1], [2], [3, 4], [5], [6, 7]]
+
+
+def test_group_operations_chunk_size():
+    operations = validate_operations([{"op": "delete", "id": i} for i in range(5)], table.columns, None)
+    assert [len(group) for group in group_operations(operations, chunk_size=2)] == [2, 2, 1]
@@ -0,0 +1,35 @@
+import os
+
+from cache import TileCache
+
+
+def test_invalidate_keeps_current_version(tmp_path):
+    cache = TileCache(str(tmp_path))
+    cache.set(1, 3, 'layer', 0, 0, 0, b'old')
+    cache.set(1, 4, 'layer', 0, 0, 0, b'new')
+
+    cache.invalidate(1, 4)
+    assert cache.get(1, 3, 'layer', 0, 0, 0) is None
+    assert cache.get(1, 4, 'layer', 0, 0, 0) == b'new'
+    assert os.listdir(tmp_path / '1') == ['4']
+
+    # A parallel request which read the table before the change does not bring the old version back
+    cache.set(1, 3, 'layer', 0, 0, 1, b'old')
+    assert cache.get(1, 3, 'layer', 0, 0, 1) is None
+    assert os.listdir(tmp_path / '1') == ['4']
+
+
+def test_invalidate_all(tmp_path):
+    cache = TileCache(str(tmp_path))
+    cache.set(1, 3, 'layer', 0, 0, 0, b'tile')
+    cache.invalidate(1)
+    assert cache.get(1, 3, 'layer', 0, 0, 0) is None
+    assert not os.path.exists(tmp_path / '1')
+
+
+def test_set_without_directory(tmp_path):
+    cache = TileCache(str(tmp_path / 'file'))
+    (tmp_path / 'file').write_bytes(b'')
+    # The tile can not be written to disk, it is kept in memory
+    cache.set(1, 3, 'layer', 0, 0, 0, b'tile')
+    assert cache.get(1, 3, 'layer', 0, 0, 0) == b'tile'
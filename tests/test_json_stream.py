@@ -0,0 +1,65 @@
+import io
+import json
+
+import pytest
+
+from json_stream import JsonStream
+
+records = [{"gis_id": i, "name": "Газетная" * i, "area": 12345678.125} for i in range(100)]
+
+
+@pytest.mark.parametrize('buffer_size', [1, 7, 64, 1 << 20])
+def test_array(buffer_size):
+    stream = JsonStream(io.StringIO(json.dumps(records, ensure_ascii=False)), buffer_size)
+    assert list(stream) == records
+    assert stream.kind == 'array'
+
+
+@pytest.mark.parametrize('buffer_size', [1, 7, 64, 1 << 20])
+def test_feature_collection(buffer_size):
+    collection = {"type": "FeatureCollection", "crs": {"properties": {"name": "EPSG:3857"}}, "features": records}
+    stream = JsonStream(io.StringIO(json.dumps(collection, indent=2)), buffer_size)
+    assert list(stream) == records
+    assert stream.kind == 'object'
+    assert stream.members == {"type": "FeatureCollection", "crs": {"properties": {"name": "EPSG:3857"}}}
+
+
+def test_numbers_on_buffer_border():
+    assert list(JsonStream(io.StringIO('[1, 23456, 7.5e10]'), 2)) == [1, 23456, 7.5e10]
+
+
+def test_empty_array():
+    assert list(JsonStream(io.StringIO(' [ ] '))) == []
+
+
+@pytest.mark.parametrize('document', ['{"type": "Feature"}', '{}', '"text"', '[1, 2', '[1 2]'])
+def test_not_valid(document):
+    with pytest.raises(ValueError):
+        list(JsonStream(io.StringIO(document), 4))
+
+
+def test_values_cut_by_buffer():
+    document = json.dumps([True, False, None, "Газетная\\u0022", -1.5e-3, {"a": [1, 2]}], ensure_ascii=False)
+    for buffer_size in range(1, 12):
+        assert list(JsonStream(io.StringIO(document), buffer_size)) == \
+               [True, False, None, 'Газетная\\u0022', -1.5e-3, {"a": [1, 2]}]
+
+
+def test_syntax_error_does_not_read_the_rest():
+    stream = JsonStream(io.StringIO('[1, x' + ' ' * 100000 + ']'), 64)
+    with pytest.raises(ValueError):
+        list(stream)
+    assert len(stream.buffer) == 64
+
+
+def test_large_value_read_by_growing_parts():
+    reads = []
+
+    class CountingReader(io.StringIO):
+        def read(self, size=-1):
+            reads.append(size)
+            return super().read(size)
+
+    value = {"name": "x" * 100000}
+    assert list(JsonStream(CountingReader(json.dumps([value])), 64)) == [value]
+    assert len(reads) < 20
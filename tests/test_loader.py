@@ -0,0 +1,68 @@
+import pandas as pd
+
+from loader import CopyLoader, series_type, widen_type
+
+
+class RecordingConnection:
+    """Connection which keeps the statements and the COPY data instead of sending them"""
+
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, statement):
+        self.statements.append(statement)
+
+    def copy_expert(self, statement, buffer):
+        self.copied.append(buffer.read())
+
+
+def test_series_type():
+    assert series_type(pd.Series([1, 2])) == 'bigint'
+    assert series_type(pd.Series([1.0, None])) == 'bigint'
+    assert series_type(pd.Series([1.5, None])) == 'double precision'
+    assert series_type(pd.Series([True, None], dtype=object)) == 'boolean'
+    assert series_type(pd.Series(['a', 1], dtype=object)) == 'text'
+    assert series_type(pd.Series([None, None], dtype=object)) is None
+
+
+def test_widen_type():
+    assert widen_type('bigint', None) == 'bigint'
+    assert widen_type('bigint', 'double precision') == 'double precision'
+    assert widen_type('double precision', 'bigint') == 'double precision'
+    assert widen_type('bigint', 'text') == 'text'
+    assert widen_type('text', 'bigint') == 'text'
+    assert widen_type('boolean', 'bigint') == 'text'
+
+
+def test_type_change_across_chunks():
+    loader = CopyLoader('geotable_test')
+    loader._conn = RecordingConnection()
+
+    loader.write(pd.DataFrame({'code': [1, 2], 'name': ['a', 'b']}))
+    assert loader.types == {'code': 'bigint', 'name': 'text'}
+
+    # Fractional numbers in a later chunk widen the integer column
+    loader.write(pd.DataFrame({'code': [2.5, None], 'name': ['c', None]}))
+    assert loader.types['code'] == 'double precision'
+
+    # Strings widen it to text
+    loader.write(pd.DataFrame({'code': ['x', '7'], 'name': ['d', 'e']}))
+    assert loader.types['code'] == 'text'
+
+    # A chunk without the column writes empty values
+    loader.write(pd.DataFrame({'name': ['f', 'g']}))
+
+    alters = [statement for statement in loader._conn.statements if 'ALTER COLUMN' in statement]
+    assert [statement.split(' TYPE ')[1].split(' USING')[0] for statement in alters] == ['double precision', 'text']
+    assert loader._conn.copied[1].splitlines() == ['2.5,c', '\\N,\\N']
+    assert loader.rows == 8
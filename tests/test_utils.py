@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy import Table, Column, Integer, String, MetaData
+from sqlalchemy.dialects import postgresql
+
+from utils import encode_cursor, decode_cursor, keyset_condition, get_filter_set, add_filters
+
+table = Table('test_filters', MetaData(),
+              Column('gis_id', Integer, primary_key=True),
+              Column('abbrev', String),
+              Column('passengers', Integer))
+
+
+def to_sql(expression):
+    return str(expression.compile(dialect=postgresql.dialect()))
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor('ул. Газетная', 15)) == ('ул. Газетная', 15)
+    assert decode_cursor(encode_cursor(None, 1)) == (None, 1)
+
+
+def test_cursor_not_valid():
+    with pytest.raises(ValueError):
+        decode_cursor('not a cursor')
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor('abc', 'abc'))
+
+
+def test_keyset_condition():
+    assert to_sql(keyset_condition(table.c, None, False, (None, 10))) == 'test_filters.gis_id > %(gis_id_1)s'
+    assert to_sql(keyset_condition(table.c, 'abbrev', True, ('ABJ', 10))).startswith('test_filters.abbrev <')
+
+
+def test_filter_set_keyset():
+    filter_set = get_filter_set({'sortby': '-abbrev', 'limit': '20',
+                                 'after': encode_cursor('ABJ', 10)}.items(), 50, table.c)
+    assert filter_set['limit'] == 20
+    assert filter_set['offset'] is None
+    assert filter_set['sort_desc'] is True
+    assert len(filter_set['keyset']) == 1
+
+
+def test_filter_set_unknown_field():
+    with pytest.raises(ValueError):
+        get_filter_set({'sortby': 'unknown'}.items(), 50, table.c)
+
+
+def test_add_filters_bound_parameters():
+    first = to_sql(add_filters([{'field': 'abbrev', 'op': '==', 'value': 'ABJ'}], table.c)[0])
+    second = to_sql(add_filters([{'field': 'abbrev', 'op': '==', 'value': 'SSE'}], table.c)[0])
+    assert first == second == 'test_filters.abbrev = %(abbrev_1)s'
+
+
+def test_add_filters_operators():
+    usage = []
+    conditions = add_filters([
+        {'field': 'passengers', 'op': 'between', 'value': [10, 20]},
+        {'or': [{'field': 'abbrev', 'op': 'in', 'value': ['ABJ', 'SSE']},
+                {'field': 'abbrev', 'op': 'is null'}]}
+    ], table.c, usage)
+    assert 'BETWEEN' in to_sql(conditions[0])
+    assert ' OR ' in to_sql(conditions[1])
+    assert ('passengers', 'btree') in usage
+
+
+def test_add_filters_not_valid():
+    with pytest.raises(ValueError):
+        add_filters([{'field': 'abbrev', 'op': 'regexp', 'value': 'A'}], table.c)
+    with pytest.raises(ValueError):
+        add_filters([{'field': 'abbrev', 'op': 'between', 'value': 'A'}], table.c)
+    with pytest.raises(ValueError):
+        add_filters([{'field': 'unknown', 'op': '=', 'value': 'A'}], table.c)
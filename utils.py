@@ -1,122 +1,629 @@
+import base64
+import hashlib
+import json
+import operator
+import threading
+from datetime import datetime, timezone
+
 import sqlalchemy
-from db import Session, TableFolder, Localization
+from flask import Response, request
+from sqlalchemy import select, update, event, and_, or_
+from sqlalchemy.sql import text, func, literal_column
+from cache import LRUCache, TileCache
+from config import COUNT_CACHE_SIZE, TILE_CACHE_DIR, TILE_CACHE_SIZE
+from db import engine, Session, TableFolder, TableName, Localization, TableFile, CommentTable, stream_query, \
+    stream_json_query, get_table_schema, schema_catalog
 
 
 GEOM_TYPE = ['Geometry', 'Point', 'Polygon', 'LineString', 'MultiLineString', 'MultiPolygon',
              'MultiPoint', 'PolyhedralSurface', 'Triangle', 'Tin', 'GeometryCollection']
 
+# Strategies of counting records for pagination
+COUNT_MODES = ('exact', 'estimated', 'cached', 'none')
+
+# Exact counts by (table id, table version, filter hash)
+_count_cache = LRUCache(COUNT_CACHE_SIZE)
+
+# Vector tiles of the tables, invalidated when the version of a table changes
+tile_cache = TileCache(TILE_CACHE_DIR, TILE_CACHE_SIZE)
+
+# Formats of streaming responses and their mimetypes
+STREAM_FORMATS = {'geojson': 'application/geo+json', 'ndjson': 'application/x-ndjson'}
+
+
+def encode_cursor(sort_value, gis_id):
+    """Opaque cursor of keyset pagination: the last value of the sorting field and gis_id of the page"""
+    return base64.urlsafe_b64encode(json.dumps([sort_value, gis_id]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        sort_value, gis_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('not valid cursor')
+    if not isinstance(gis_id, int):
+        raise ValueError('not valid cursor')
+    return sort_value, gis_id
+
+
+def keyset_condition(columns, sort_field, sort_desc, after):
+    """Condition for records after the cursor in the order 'ORDER BY sort_field [DESC], gis_id'.
+    NULL values are last in ascending order and first in descending order, as in Postgres"""
+    sort_value, gis_id = after
+    if sort_field is None:
+        return columns.gis_id > gis_id
+
+    field = columns[sort_field]
+    if sort_value is None:
+        condition = and_(field.is_(None), columns.gis_id > gis_id)
+        if sort_desc:
+            condition = or_(condition, field.isnot(None))
+    elif sort_desc:
+        condition = or_(field < sort_value, and_(field == sort_value, columns.gis_id > gis_id))
+    else:
+        condition = or_(field > sort_value, and_(field == sort_value, columns.gis_id > gis_id), field.is_(None))
+    return condition
+
+
+def next_cursor(rows, filter_set):
+    """Returns the cursor of the next page or None if the page is the last one"""
+    if not rows or filter_set.get('limit') is None:
+        return None
+    rows = rows if isinstance(rows, list) else list(rows.values())
+    if len(rows) < filter_set['limit']:
+        return None
+    last = rows[-1]
+    sort_field = filter_set['sort_field']
+    return encode_cursor(last.get(sort_field) if sort_field else None, last['gis_id'])
 
-def get_filter_set(request_arg, limit_value):
-    """processing filters for a GET request"""
-    query_set = []
-    query_sort = "ORDER BY gis_id"
-    limit = ''
+
+def get_column(columns, field):
+    if field not in columns:
+        raise ValueError(f'not found field {field}')
+    return columns[field]
+
+
+def get_filter_set(request_arg, limit_value, columns):
+    """processing filters for a GET request.
+    Filters are SQLAlchemy expressions with bound parameters, so the SQL text does not depend on values"""
+    conditions = []
+    # Fields used for filtering and sorting with the kind of index which would help them
+    usage = []
+    order_by = [columns.gis_id]
+    sort_field = None
+    sort_desc = False
+    page = None
+    after = None
     as_array = False
     for keys, values in request_arg:
         # Sorting by a specific field. The "-" in the argument is responsible for reverse sorting
         if keys == 'sortby':
-            if values.startswith('-'):
-                values = f'"{values[1:].strip()}" DESC'
-            else:
-                values = f'"{values.strip()}"'
-            query_sort = f'ORDER BY {values}, gis_id'
+            sort_desc = values.startswith('-')
+            sort_field = values[1:].strip() if sort_desc else values.strip()
+            column = get_column(columns, sort_field)
+            order_by = [column.desc() if sort_desc else column, columns.gis_id]
+            usage.append((sort_field, 'btree'))
 
         # Search by mask. Analog of LIKE from SQL
         elif keys == 'mask':
-            field, mask = values.split('=')
-            condition = f'"{field}" LIKE \'{mask}\''
-            query_set.append(condition)
+            field, mask = values.split('=', 1)
+            conditions.append(get_column(columns, field).like(mask))
+            usage.append((field, 'trgm'))
 
         # Arguments for pagination
         elif keys == 'limit':
             limit_value = int(values)
         elif keys == 'page':
             page = int(values)
-            limit = f"LIMIT {limit_value} OFFSET {limit_value * (page - 1)}"
+        # Keyset pagination: the cursor of the previous page, an empty value means the first page
+        elif keys == 'after':
+            after = decode_cursor(values) if values else ()
 
         elif keys == 'as_array':
             as_array = True
 
+    limit = None
+    offset = None
+    keyset = []
+    if after is not None:
+        limit = limit_value
+        if after:
+            keyset.append(keyset_condition(columns, sort_field, sort_desc, after))
+    elif page is not None:
+        limit = limit_value
+        offset = limit_value * (page - 1)
+
     result = {
-        "query_set": query_set,
+        "conditions": conditions,
+        "keyset": keyset,
+        "order_by": order_by,
         "limit_value": limit_value,
         "limit": limit,
-        "query_sort": query_sort,
-        "as_array": as_array
+        "offset": offset,
+        "sort_field": sort_field,
+        "sort_desc": sort_desc,
+        "as_array": as_array,
+        "usage": usage
     }
     return result
 
 
-def get_fields(fields):
-    res = {}
-    for field in fields:
-        if str(field.type) == 'INTEGER' or str(field.type) == 'SMALLINT' or str(field.type) == 'FLOAT':
-            field_type = 'num'
-        else:
-            field_type = 'str'
-        res.update({field.description: field_type})
-    return res
+# Operators of attribute filters. The value of 'in' and 'not in' is a list, of 'between' - a pair
+FILTER_OPERATORS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'like': lambda column, value: column.like(value),
+    'ilike': lambda column, value: column.ilike(value),
+    'in': lambda column, value: column.in_(value),
+    'not in': lambda column, value: column.not_in(value),
+    'between': lambda column, value: column.between(*value),
+    'is null': lambda column, value: column.is_(None),
+    'is not null': lambda column, value: column.isnot(None),
+}
 
 
-def add_filters(args, fields):
-    res = []
+def compile_filter(attr, columns, usage):
+    """Compiles one attribute filter: {"field", "op", "value"} or a group {"or": [...]} / {"and": [...]}"""
+    if not isinstance(attr, dict):
+        raise ValueError('filter must be an object')
+    for group, join in (('or', or_), ('and', and_)):
+        if group in attr:
+            if not isinstance(attr[group], list) or not attr[group]:
+                raise ValueError(f'"{group}" must be a non-empty list of filters')
+            return join(*[compile_filter(item, columns, usage) for item in attr[group]])
+
+    column = get_column(columns, attr.get('field'))
+    op = str(attr.get('op', '=')).lower()
+    if op not in FILTER_OPERATORS:
+        raise ValueError(f'unknown operator {op}')
+    value = attr.get('value')
+    if op in ('in', 'not in') and not (isinstance(value, list) and value):
+        raise ValueError(f'value of "{op}" must be a non-empty list')
+    if op == 'between' and not (isinstance(value, list) and len(value) == 2):
+        raise ValueError('value of "between" must be a list of two values')
+    usage.append((attr['field'], 'btree'))
+    return FILTER_OPERATORS[op](column, value)
+
+
+def add_filters(args, columns, usage=None):
+    """Compiles attribute filters from JSON. Filters of the list are joined by AND"""
+    usage = [] if usage is None else usage
     if not args:
-        return res
-    table_fields = get_fields(fields)
-    for attr in args:
-        if attr['field'] in table_fields:
-            if attr['op'] == '==':
-                attr['op'] = '='
-            if table_fields[attr['field']] == 'num':
-                res.append(f"{attr['field']} {attr['op']} {attr['value']}")
-            else:
-                res.append(f"{attr['field']} {attr['op']} '{attr['value']}'")
-    return res
+        return []
+    if not isinstance(args, list):
+        raise ValueError('attribute must be a list of filters')
+    return [compile_filter(attr, columns, usage) for attr in args]
 
 
-def get_geom_type(table_name):
-    try:
-        geom_type = Session.execute(f"""SELECT type::text
-                                        FROM geometry_columns 
-                                        WHERE f_table_schema = 'public' 
-                                        AND f_table_name = 
-                                        '{table_name.split('.')[1] if '.' in table_name else table_name}' 
-                                        and f_geometry_column = 'geom'""").first()
-    except sqlalchemy.exc.ProgrammingError:
-        geom_type = None
-    if geom_type:
-        geom_type = geom_type[0] if geom_type[0] else None
-        if geom_type == 'GEOMETRY':
-            try:
-                geom_obj = Session.execute(f"""SELECT json(geom) FROM {table_name} LIMIT 1;""").first()
-            except sqlalchemy.exc.ProgrammingError:
-                geom_obj = None
-            if geom_obj:
-                geom_type = geom_obj[0].get('type') if geom_obj[0] else None
-                if str(geom_type).startswith('Multi'):
-                    geom_type = geom_type.replace('Multi', '')
-        else:
-            for type_geom in GEOM_TYPE:
-                if geom_type == type_geom.upper():
-                    geom_type = type_geom
+def spatial_filter(columns, geometry):
+    """Records intersecting the GeoJSON geometry"""
+    return func.ST_Intersects(columns.geom, func.ST_SetSRID(func.ST_GeomFromGeoJSON(json.dumps(geometry)), 4326))
 
-    return geom_type
 
+def literal_sql(stmt):
+    """SQL text of the statement with values. Used for EXPLAIN and as a key of caches, not for execution"""
+    return str(stmt.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
 
-def get_children(table, as_array=False):
-    folder = TableFolder.query.filter(TableFolder.name == table.table_name).first()
-    if folder:
-        children = {
-            child.id: {
-                "id": child.id,
-                "alias": {rec.language: rec.alias
-                          for rec in Localization.query.filter(child.id == Localization.table_id)},
-                "parent_id": table.id,
-                "geom_type": get_geom_type(child.table_name)
-            } for child in folder.children
-        }
-        output_data = list(children.values()) if as_array else children
+
+def bump_table_version(table_id):
+    """Increments the version of the table data. Called in the transaction of the change.
+    Changes made by direct SQL are counted by the trigger of the table (see db.install_version_trigger)"""
+    version = Session.execute(update(TableName).where(TableName.id == table_id).
+                              values(version=TableName.version + 1, modified_at=func.now()).
+                              returning(TableName.version)).scalar()
+    # Tiles are removed after the commit, before it parallel requests still read the previous version
+    versions = Session().info.setdefault('tile_versions', {})
+    versions[table_id] = max(version or 0, versions.get(table_id, 0))
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed_tiles(session):
+    for table_id, version in session.info.pop('tile_versions', {}).items():
+        tile_cache.invalidate(table_id, version)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_rolled_back_tiles(session):
+    session.info.pop('tile_versions', None)
+
+
+def table_etag(table, *parts):
+    """Strong ETag of a resource of the table. It changes with the data, the structure
+    and the descriptions (aliases, comments, documents) of the table"""
+    key = ':'.join(str(part) for part in (table.id, table.version, table.schema_version, table.meta_version, *parts))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def request_etag(table, resource):
+    """ETag of a read request: the resource of the table with the arguments and the body of the request.
+    Last-Modified is not used with it, it would validate any request to the resource"""
+    body = hashlib.sha1(request.get_data()).hexdigest()
+    return table_etag(table, resource, sorted(request.args.items(multi=True)), body)
+
+
+def is_not_modified(etag, last_modified=None):
+    """Checks If-None-Match and, if it is absent, If-Modified-Since"""
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if last_modified and request.if_modified_since:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """Response 304 for a client which already has the current version of the resource"""
+    return set_validators(Response(status=304), etag, last_modified)
+
+
+def bump_meta_version(table_id):
+    """Increments the version of the descriptions of the table: aliases, folder, comments and documents"""
+    Session.query(TableName).filter(TableName.id == table_id). \
+        update({TableName.meta_version: TableName.meta_version + 1, TableName.modified_at: func.now()},
+               synchronize_session=False)
+
+
+def bump_schema_version(table):
+    """Increments the version of the table structure after DDL. Called in the transaction of the change"""
+    Session.query(TableName).filter(TableName.id == table.id). \
+        update({TableName.schema_version: TableName.schema_version + 1, TableName.modified_at: func.now()},
+               synchronize_session=False)
+    schema_catalog.invalidate(table.table_name)
+
+
+def count_records(table, table_obj, conditions, mode='exact'):
+    """Counts records of the table for pagination.
+    Returns the count and its kind: exact, estimated, cached or none"""
+    if mode == 'none':
+        return None, 'none'
+
+    if mode == 'estimated':
+        if not conditions:
+            reltuples = Session.execute(text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)"),
+                                        {"name": table.table_name}).scalar()
+            # The table has never been analyzed, then the planner estimate is used
+            if reltuples and reltuples > 0:
+                return reltuples, 'estimated'
+        stmt = select(literal_column('1')).select_from(table_obj).where(*conditions)
+        plan = Session.execute(text(f"EXPLAIN (FORMAT JSON) {literal_sql(stmt)}")).scalar()
+        return int(plan[0]['Plan']['Plan Rows']), 'estimated'
+
+    stmt = select(func.count()).select_from(table_obj).where(*conditions)
+    key = None
+    if mode == 'cached':
+        filter_hash = hashlib.sha1(literal_sql(stmt).encode()).hexdigest()
+        key = (table.id, table.version, filter_hash)
+        count = _count_cache.get(key)
+        if count is not None:
+            return count, 'cached'
+
+    count = Session.execute(stmt).scalar()
+    if key is not None:
+        _count_cache.set(key, count)
+    return count, 'exact'
+
+
+def stream_records(stmt, stream_format, has_geom):
+    """Generates the response body batch by batch: GeoJSON FeatureCollection or NDJSON"""
+    geojson = stream_format == 'geojson'
+    batches = stream_query(stream_json_query(stmt, geojson, has_geom))
+    if not geojson:
+        for rows in batches:
+            yield ''.join(f'{row[0]}\n' for row in rows)
+        return
+
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for rows in batches:
+        yield separator + ','.join(row[0] for row in rows)
+        separator = ','
+    yield ']}'
+
+
+def split_table_name(table_name):
+    """Splits a registry name like 'public.table' or 'public."table"' into (schema, table)"""
+    schema, _, name = table_name.rpartition('.')
+    return (schema or 'public').strip('"'), name.strip('"')
+
+
+def normalize_geom_type(table_name, geom_type):
+    """Converts the type from geometry_columns to the type shown to the frontend.
+    For generic GEOMETRY columns the type is taken from the first record of the table"""
+    if not geom_type:
+        return None
+    if geom_type == 'GEOMETRY':
+        try:
+            geom_obj = Session.execute(f"""SELECT json(geom) FROM {table_name} LIMIT 1;""").first()
+        except sqlalchemy.exc.ProgrammingError:
+            Session.rollback()
+            geom_obj = None
+        if geom_obj:
+            geom_type = geom_obj[0].get('type') if geom_obj[0] else None
+            if str(geom_type).startswith('Multi'):
+                geom_type = geom_type.replace('Multi', '')
     else:
-        output_data = None
-    return output_data
+        for type_geom in GEOM_TYPE:
+            if geom_type == type_geom.upper():
+                geom_type = type_geom
+    return geom_type
+
+
+def probe_geom_info(table):
+    """Reads type, SRID and dimension of the geom column from the schema catalog.
+    Used only when the data of the table is changed, read endpoints take it from TableName"""
+    try:
+        geom_info = get_table_schema(table).geometry
+    except sqlalchemy.exc.NoSuchTableError:
+        geom_info = None
+    if geom_info is None:
+        return None, None, None
+    return normalize_geom_type(table.table_name, geom_info[0]), geom_info[1], geom_info[2]
+
+
+def update_geom_info(table):
+    """Saves geometry type, SRID and dimension of the table in the registry"""
+    geom_info = probe_geom_info(table)
+    changed = geom_info != (table.geom_type, table.srid, table.coord_dimension)
+    table.geom_type, table.srid, table.coord_dimension = geom_info
+    table.geom_updated_at = func.now()
+    Session.commit()
+    if changed:
+        invalidate_registry()
+    return table.geom_type
+
+
+def refresh_geom_catalog(limit=100):
+    """Background job: fills geometry information for tables imported before it was stored in the registry
+    and recalculates the extents which became stale after deleting records"""
+    live = (TableName.is_folder.isnot(True), TableName.deleted_at.is_(None))
+    tables = TableName.query.filter(*live, TableName.geom_updated_at.is_(None)).limit(limit).all()
+    for table in tables:
+        update_geom_info(table)
+
+    stale = TableName.query.filter(*live, TableName.extent_updated_at.is_(None)).limit(limit).all()
+    for table in stale:
+        refresh_extent(table)
+    return len(tables) + len(stale)
+
+
+def borders_from_box(box):
+    """Borders in the response format of the endpoints"""
+    if box is None or box[0] is None:
+        return None
+    return {"0": box[0], "1": box[1], "2": box[2], "3": box[3]}
+
+
+def refresh_extent(table):
+    """Calculates the extent of the whole table and saves it in the registry"""
+    box = None
+    if table.geom_type:
+        box = Session.execute(f"""SELECT ST_XMin(ext), ST_YMin(ext), ST_XMax(ext), ST_YMax(ext)
+                                  FROM (SELECT ST_Extent(geom) AS ext FROM {table.table_name}) f""").first()
+    table.xmin, table.ymin, table.xmax, table.ymax = box if box else (None, None, None, None)
+    table.extent_updated_at = func.now()
+    Session.commit()
+
+
+def get_table_extent(table):
+    """Borders of the whole table from the registry.
+    While the stored extent is stale, the estimate of the planner statistics is returned"""
+    if table.extent_updated_at is not None:
+        return borders_from_box((table.xmin, table.ymin, table.xmax, table.ymax))
+
+    schema, name = split_table_name(table.table_name)
+    try:
+        box = Session.execute(text("""SELECT ST_XMin(ext), ST_YMin(ext), ST_XMax(ext), ST_YMax(ext)
+                                      FROM ST_EstimatedExtent(:schema, :name, 'geom') AS ext"""),
+                              {"schema": schema, "name": name}).first()
+    except sqlalchemy.exc.DBAPIError:
+        # There are no statistics for the table yet
+        Session.rollback()
+        box = None
+    return borders_from_box(box)
+
+
+def get_filtered_extent(table_obj, conditions):
+    """Borders of the records matching the filters"""
+    extent = select(func.ST_Extent(table_obj.c.geom).label('ext')).where(*conditions).subquery()
+    box = Session.execute(select(func.ST_XMin(extent.c.ext), func.ST_YMin(extent.c.ext),
+                                 func.ST_XMax(extent.c.ext), func.ST_YMax(extent.c.ext))).first()
+    return borders_from_box(box)
+
+
+def get_record_box(table, gis_id):
+    return Session.execute(text(f"""SELECT ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
+                                    FROM {table.table_name} WHERE gis_id = :gis_id"""),
+                           {"gis_id": gis_id}).first()
+
+
+def expand_extent(table, gis_id):
+    """Expands the stored extent by the geometry of the inserted or updated record.
+    Called in the transaction of the change"""
+    Session.execute(text(f"""UPDATE table_names SET
+                                xmin = LEAST(xmin, ST_XMin(rec.geom)), ymin = LEAST(ymin, ST_YMin(rec.geom)),
+                                xmax = GREATEST(xmax, ST_XMax(rec.geom)), ymax = GREATEST(ymax, ST_YMax(rec.geom))
+                             FROM (SELECT geom FROM {table.table_name} WHERE gis_id = :gis_id) rec
+                             WHERE table_names.id = :table_id AND table_names.extent_updated_at IS NOT NULL
+                             AND rec.geom IS NOT NULL"""),
+                    {"gis_id": gis_id, "table_id": table.id})
+
+
+def get_records_box(table, gis_ids):
+    """Box of the geometries of the records"""
+    return Session.execute(text(f"""SELECT ST_XMin(ext), ST_YMin(ext), ST_XMax(ext), ST_YMax(ext)
+                                    FROM (SELECT ST_Extent(geom) AS ext FROM {table.table_name}
+                                          WHERE gis_id = ANY(:gis_ids)) f"""),
+                           {"gis_ids": list(gis_ids)}).first()
+
+
+def expand_extent_box(table, box):
+    """Expands the stored extent by the box of the inserted or updated records.
+    Called in the transaction of the change"""
+    if box is None or box[0] is None:
+        return
+    Session.execute(text("""UPDATE table_names SET
+                               xmin = LEAST(xmin, :xmin), ymin = LEAST(ymin, :ymin),
+                               xmax = GREATEST(xmax, :xmax), ymax = GREATEST(ymax, :ymax)
+                            WHERE id = :table_id AND extent_updated_at IS NOT NULL"""),
+                    {"xmin": box[0], "ymin": box[1], "xmax": box[2], "ymax": box[3], "table_id": table.id})
 
+
+def release_extent(table, box):
+    """The geometry with the box leaves the table. If it lies on the border of the stored extent,
+    the extent is marked stale and recalculated by the background job"""
+    if box is None or box[0] is None or table.extent_updated_at is None or table.xmin is None:
+        return
+    if box[0] <= table.xmin or box[1] <= table.ymin or box[2] >= table.xmax or box[3] >= table.ymax:
+        Session.query(TableName).filter(TableName.id == table.id). \
+            update({TableName.extent_updated_at: None}, synchronize_session=False)
+
+
+def delete_attachments(table_id, row_ids, batch_size=10000):
+    """Marks comments and documents of the records as deleted. They are hidden at once, the rows and
+    the files are removed by the reclamation worker (see reclamation.reclaim).
+    Called in the transaction of the deletion of the records"""
+    row_ids = list(row_ids)
+    for start in range(0, len(row_ids), batch_size):
+        batch = row_ids[start:start + batch_size]
+        TableFile.query.filter(TableFile.table_id == table_id, TableFile.row_id.in_(batch),
+                               TableFile.deleted_at.is_(None)). \
+            update({TableFile.deleted_at: func.now()}, synchronize_session=False)
+        CommentTable.query.filter(CommentTable.table_id == table_id, CommentTable.row_id.in_(batch),
+                                  CommentTable.deleted_at.is_(None)). \
+            update({CommentTable.deleted_at: func.now()}, synchronize_session=False)
+
+
+# Registry of tables (GET /gis/tables) is cached in the process and rebuilt after invalidation.
+# Endpoints that change tables, folders or localization must call invalidate_registry()
+_registry_lock = threading.Lock()
+_registry_generation = 0
+_registry = None
+
+
+def new_folder(alias, language='ru'):
+    """Creates a folder in the table of folders and in the registry of tables.
+    Returns the folder and its entry in the registry"""
+    name = f'folder{datetime.utcnow().strftime("%d_%m_%y_%H_%M_%S_%f")}'
+
+    # Saving folder to the table of folders
+    folder = TableFolder(name=name)
+
+    # Saving folder to the registry of tables
+    table = TableName(table_name=f'{folder.name}', is_folder=True)
+    Session.add_all([folder, table])
+    Session.commit()
+
+    # Saving alias to the registry of tables
+    localization = Localization(language=language, alias=alias, table_id=table.id)
+    Session.add(localization)
+    Session.commit()
+    invalidate_registry()
+    return folder, table
+
+
+def invalidate_registry():
+    global _registry, _registry_generation
+    with _registry_lock:
+        _registry_generation += 1
+        _registry = None
+
+
+def build_registry():
+    """Assembles the registry of tables and folders with one set-based query.
+    Geometry types are stored in TableName, so user tables are not touched"""
+    rows = Session.query(TableName, TableFolder.id, Localization.id, Localization.language, Localization.alias). \
+        outerjoin(TableFolder, (TableName.is_folder.is_(True)) & (TableFolder.name == TableName.table_name)). \
+        outerjoin(Localization, Localization.table_id == TableName.id). \
+        filter(TableName.deleted_at.is_(None)). \
+        order_by(TableName.id, Localization.id).all()
+
+    tables, aliases, folders = {}, {}, {}
+    for table, folder_id, locale_id, language, alias in rows:
+        tables[table.id] = table
+        aliases.setdefault(table.id, {})
+        if locale_id is not None:
+            aliases[table.id][language] = alias
+        if folder_id is not None:
+            folders[folder_id] = table.id
+
+    children = {table_id: {} for table_id in folders.values()}
+    data = {}
+    for table in tables.values():
+        if table.is_folder:
+            data[table.id] = {
+                "id": table.id,
+                "alias": aliases[table.id],
+                "children": children.get(table.id)
+            }
+            continue
+
+        if not table.parent_id:
+            data[table.id] = {
+                "id": table.id,
+                "alias": aliases[table.id],
+                "geom_type": table.geom_type,
+                "parent_id": table.parent_id
+            }
+        elif table.parent_id in folders:
+            folder_table_id = folders[table.parent_id]
+            children[folder_table_id][table.id] = {
+                "id": table.id,
+                "alias": aliases[table.id],
+                "parent_id": folder_table_id,
+                "geom_type": table.geom_type
+            }
+    return data
+
+
+def get_registry_state():
+    """Returns the cached registry of tables with its ETag and build time, building it if necessary"""
+    global _registry
+    state = _registry
+    if state is not None:
+        return state
+    with _registry_lock:
+        if _registry is not None:
+            return _registry
+        generation = _registry_generation
+    data = build_registry()
+    etag = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    state = (data, etag, datetime.now(timezone.utc).replace(microsecond=0))
+    with _registry_lock:
+        # Registry could be changed while it was building, then it is not saved
+        if generation == _registry_generation:
+            _registry = state
+    return state
+
+
+def get_registry():
+    return get_registry_state()[0]
+
+
+def registry_as_array(data):
+    """Converts the registry to the format with lists instead of dicts"""
+    res = []
+    for table in data.values():
+        if table.get('children') is not None:
+            table = dict(table, children=list(table['children'].values()))
+        res.append(table)
+    return res
+
+
+def get_children(table, as_array=False):
+    folder = get_registry().get(table.id)
+    children = folder.get('children') if folder else None
+    if children is None:
+        return None
+    return list(children.values()) if as_array else children